@@ -81,7 +81,7 @@ async def main():
     logger.info(f"📁 Используется БД (Postgres): {dsn}")
 
     # Инициализируем master БД (Postgres)
-    master_db = MasterDatabase(dsn=dsn)
+    master_db = MasterDatabase(dsn=dsn, role="api")
     await master_db.init()
     logger.info("✅ MasterDatabase инициализирована")
 
@@ -8,7 +8,7 @@ import secrets
 import socket
 import subprocess
 import sys
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 from pathlib import Path
 from typing import Dict, List, Optional
 
@@ -33,6 +33,7 @@ from shared import settings
 from shared.database import MasterDatabase
 from shared.models import BotInstance, InstanceStatus
 from shared.security import SecurityManager
+from shared.telegram_session import close_shared_session, get_shared_session
 from shared.webhook_manager import WebhookManager
 from shared.worker_manager import worker_manager
 from worker.main import GraceHubWorker
@@ -78,8 +79,10 @@ class MasterBot:
     ):
         self.bot = Bot(
             token=token,
+            session=get_shared_session(),
             default=DefaultBotProperties(parse_mode=ParseMode.HTML),
         )
+        self._master_username: Optional[str] = None
         self.dp = Dispatcher()
         self.webhook_domain = webhook_domain
         self.webhook_port = int(webhook_port) if webhook_port else 9443
@@ -551,55 +554,19 @@ class MasterBot:
     async def auto_close_tickets_loop(self) -> None:
         """
         Глобальный цикл в мастере для автоматического закрытия тикетов по всем инстансам.
-        Интервал: 3600 сек (1 час). Для каждого инстанса — per-instance hours из БД.
+        Интервал: 3600 сек (1 час). Один UPDATE на все инстансы (часы — per-instance из БД);
+        переименование тем и запрос оценки делают воркеры по команде tickets_autoclosed.
         """
         interval = 3600  # Настройте в settings или БД
         while True:
             try:
-                now = datetime.now(timezone.utc)
-                # Получаем все active инстансы (running, paused и т.д.)
-                instances = (
-                    await self.db.get_all_active_instances()
-                )  # Используйте существующий метод
-                for instance in instances:
-                    instance_id = instance.instance_id
-                    # Тянем hours из instance_settings (per-instance)
-                    settings_row = await self.db.fetchone(
-                        "SELECT autoclose_hours FROM instance_settings WHERE instance_id = $1",
-                        (instance_id,),
-                    )
-                    hours = settings_row["autoclose_hours"] if settings_row else 12  # Дефолт 12
-
-                    cutoff = now - timedelta(hours=hours)
-
-                    # Находим тикеты для закрытия
-                    rows = await self.db.fetchall(
-                        """
-                        SELECT id
-                        FROM tickets
-                        WHERE instance_id = $1
-                        AND status IN ('inprogress', 'answered')
-                        AND last_admin_reply_at IS NOT NULL
-                        AND (
-                            last_user_msg_at IS NULL
-                            OR last_user_msg_at < $2
-                        )
-                        """,
-                        (instance_id, cutoff),
+                closed = await self.db.auto_close_tickets(settings.AUTO_CLOSE_HOURS)
+                if closed:
+                    logger.info(
+                        "Auto-closed %s tickets in %s instances",
+                        sum(closed.values()),
+                        len(closed),
                     )
-
-                    if rows:
-                        ticket_ids = [row["id"] for row in rows]
-                        await self.db.execute(
-                            """
-                            UPDATE tickets
-                            SET status = 'closed',
-                                updated_at = NOW()
-                            WHERE id = ANY($1)
-                            """,
-                            (ticket_ids,),
-                        )
-                        logger.info(f"Auto-closed {len(rows)} tickets for instance {instance_id}")
             except Exception as e:
                 logger.error(f"Global auto-close error: {e}")
             await asyncio.sleep(interval)
@@ -650,7 +617,7 @@ class MasterBot:
             raise ValueError("Неверный формат токена")
 
         # 2) Проверка токена через getMe
-        test_bot = Bot(token=token)
+        test_bot = Bot(token=token, session=get_shared_session())
         try:
             me = await test_bot.get_me()
         finally:
@@ -772,9 +739,11 @@ class MasterBot:
 
 
     async def get_master_bot_username(self) -> str:
-        """Получаем username мастер-бота"""
-        me = await self.bot.get_me()
-        return me.username
+        """Получаем username мастер-бота (getMe один раз на процесс)"""
+        if not self._master_username:
+            me = await self.bot.get_me()
+            self._master_username = me.username
+        return self._master_username
 
     async def handle_menu_callback(self, callback: CallbackQuery):
         """Handle menu callbacks like help, change_language, open_panel etc."""
@@ -1877,7 +1846,7 @@ class MasterBot:
 
         try:
             # Test token by calling getMe
-            test_bot = Bot(token=token)
+            test_bot = Bot(token=token, session=get_shared_session())
             me = await test_bot.get_me()
             await test_bot.session.close()
 
@@ -1993,7 +1962,7 @@ class MasterBot:
                 await self._safe_remove_webhook(instance_id, token)
             return False, reason
 
-        test_bot = Bot(token=token)
+        test_bot = Bot(token=token, session=get_shared_session())
         try:
             await test_bot.get_me()
         except TelegramUnauthorizedError:
@@ -2452,15 +2421,16 @@ class MasterBot:
                             self.workers[instance_id] = worker
                             logger.info(f"✅ Restored GraceHubWorker for {instance_id}")
 
-                            # Setup webhook (idempotent)
+                            # Setup webhook (idempotent); заодно проверяет, что токен жив
                             await self.setup_worker_webhook(instance_id, token)
                             logger.info(f"Webhook setup completed for {instance_id}")
 
-                            # Optional: Health check
-                            await worker.bot.get_me()  # Raises if bot dead
-                            logger.info(f"Bot.get_me() successful for {instance_id}")
-
-                            logger.info("Restored worker for instance %s", instance_id)
+                            # username уже лежит в bot_instances — getMe не нужен
+                            logger.info(
+                                "Restored worker for instance %s (@%s)",
+                                instance_id,
+                                worker.bot_username,
+                            )
                         except TelegramUnauthorizedError as e:
                             logger.error(f"Unauthorized for {instance_id}: {e}")
                             await self.db.update_instance_status(instance_id, InstanceStatus.ERROR)
@@ -2596,36 +2566,32 @@ class MasterBot:
             webhook_secret = instance.webhook_secret
             logger.info(f"Reusing webhook_secret for {instance_id}")
 
-        bot = Bot(token=token)
-        try:
-            for attempt in range(1, 4):
-                # 2) Delete webhook only if explicitly requested
-                if force_reset:
-                    await self.webhook_manager.remove_webhook(token)
-                    logger.info(f"Removed webhook for {instance_id} (attempt {attempt})")
-                    await asyncio.sleep(1)
+        for attempt in range(1, 4):
+            # 2) Delete webhook only if explicitly requested
+            if force_reset:
+                await self.webhook_manager.remove_webhook(token)
+                logger.info(f"Removed webhook for {instance_id} (attempt {attempt})")
+                await asyncio.sleep(1)
 
-                success, reason = await self.webhook_manager.setup_webhook(
-                    token, webhook_url, webhook_secret
-                )
-                if not success:
-                    logger.warning(f"Setup failed on attempt {attempt}: {reason}")
-                    continue
+            success, reason = await self.webhook_manager.setup_webhook(
+                token, webhook_url, webhook_secret
+            )
+            if not success:
+                logger.warning(f"Setup failed on attempt {attempt}: {reason}")
+                continue
 
-                logger.info(f"Webhook set successful on attempt {attempt} for {instance_id}")
-                await self.db.update_instance_webhook(
-                    instance_id, webhook_url, webhook_path, webhook_secret
-                )
-                if instance:
-                    instance.webhook_url = webhook_url
-                    instance.webhook_path = webhook_path
-                    instance.webhook_secret = webhook_secret
-                return True
-
-            logger.error(f"Failed after 3 attempts for {instance_id}")
-            return False
-        finally:
-            await bot.session.close()
+            logger.info(f"Webhook set successful on attempt {attempt} for {instance_id}")
+            await self.db.update_instance_webhook(
+                instance_id, webhook_url, webhook_path, webhook_secret
+            )
+            if instance:
+                instance.webhook_url = webhook_url
+                instance.webhook_path = webhook_path
+                instance.webhook_secret = webhook_secret
+            return True
+
+        logger.error(f"Failed after 3 attempts for {instance_id}")
+        return False
 
     async def remove_worker_webhook(self, instance_id: str, token: str) -> bool:
         if await self.webhook_manager.remove_webhook(token):
@@ -2659,7 +2625,7 @@ async def main():
     except Exception as e:
         logger.error(f"Master bot crashed: {e}", exc_info=True)
     finally:
-        await master_bot.bot.session.close()
+        await close_shared_session()
 
 
 if __name__ == "__main__":
@@ -32,6 +32,7 @@ from pydantic import BaseModel, Field, StrictBool, StrictInt, StrictStr, Validat
 
 from shared import settings
 from shared.models import InstanceStatus
+from shared.telegram_session import close_shared_session
 from worker.main import GraceHubWorker
 
 from .main import MasterBot
@@ -831,6 +832,7 @@ class MiniAppDB:
             GROUP BY LOWER(status)
             """,
             (instance_id, date_from),
+            read_only=True,
         )
 
         status_counts = {
@@ -866,6 +868,7 @@ class MiniAppDB:
             AND created_at >= $2
             """,
             (instance_id, date_from),
+            read_only=True,
         )
         unique_users = uniq_row["uniq_users"] if uniq_row else 0
 
@@ -879,6 +882,7 @@ class MiniAppDB:
             AND last_admin_reply_at IS NOT NULL
             """,
             (instance_id, date_from),
+            read_only=True,
         )
 
         total_delta = 0.0
@@ -962,7 +966,7 @@ class MiniAppDB:
 
         # # Безопасно: where_sql содержит только плейсхолдеры, данные передаются через params
         count_sql = f"SELECT COUNT(*) AS cnt FROM tickets{where_sql}"   # nosec B608
-        row = await self.db.fetchone(count_sql, tuple(params))
+        row = await self.db.fetchone(count_sql, tuple(params), read_only=True)
         total = int(row["cnt"]) if row else 0
         if total == 0:
             return [], 0
@@ -983,7 +987,9 @@ class MiniAppDB:
             ORDER BY created_at DESC
             LIMIT ${len(params) + 1} OFFSET ${len(params) + 2}
             """  # nosec B608
-        rows = await self.db.fetchall(list_sql, tuple(params + [limit, offset]))
+        rows = await self.db.fetchall(
+            list_sql, tuple(params + [limit, offset]), read_only=True
+        )
 
         status_norm_map = {
             "new": "new",
@@ -1243,6 +1249,7 @@ async def lifespan(app: FastAPI):
     """Инициализация и очистка."""
     logger.info("Mini App API запущен")
     yield
+    await close_shared_session()
     logger.info("Mini App API завершает работу")
 
 
@@ -2622,12 +2629,14 @@ def create_miniapp_app(
 
         # 2. Активных ботов: COUNT WHERE status = 'running'
         active_bots_sql = "SELECT COUNT(*) FROM bot_instances WHERE status = 'running'"
-        active_bots_row = await master_bot.db.fetchone(active_bots_sql)
+        active_bots_row = await master_bot.db.fetchone(active_bots_sql, read_only=True)
         active_bots = active_bots_row[0] if active_bots_row else 0
 
         # 3. Платные подписки: инстансы на non-demo планах, не paused
         # Сначала найди demo plan_id
-        demo_plan_row = await master_bot.db.fetchone("SELECT plan_id FROM saas_plans WHERE code = 'demo'")
+        demo_plan_row = await master_bot.db.fetchone(
+            "SELECT plan_id FROM saas_plans WHERE code = 'demo'", read_only=True
+        )
         demo_plan_id = demo_plan_row["plan_id"] if demo_plan_row else 1  # Скорректируйте ID, если нужно
 
         paid_subs_sql = """
@@ -2636,7 +2645,9 @@ def create_miniapp_app(
             JOIN bot_instances bi ON bi.instance_id = ib.instance_id
             WHERE ib.plan_id != $1 AND ib.service_paused = FALSE AND bi.status = 'running'
         """
-        paid_subs_row = await master_bot.db.fetchone(paid_subs_sql, (demo_plan_id,))
+        paid_subs_row = await master_bot.db.fetchone(
+            paid_subs_sql, (demo_plan_id,), read_only=True
+        )
         paid_subscriptions = paid_subs_row[0] if paid_subs_row else 0
 
         # 4. Тикетов за месяц: агрегация из master_db (PostgreSQL), без SQLite
@@ -2647,7 +2658,9 @@ def create_miniapp_app(
             SELECT COUNT(*) FROM tickets 
             WHERE created_at > $1  -- Предполагаем поле created_at в tickets
         """
-        monthly_tickets_row = await master_bot.db.fetchone(monthly_tickets_sql, (thirty_days_ago,))
+        monthly_tickets_row = await master_bot.db.fetchone(
+            monthly_tickets_sql, (thirty_days_ago,), read_only=True
+        )
         monthly_tickets = monthly_tickets_row[0] if monthly_tickets_row else 0
 
         return PlatformMetrics(
@@ -3148,6 +3161,22 @@ def create_miniapp_app(
         metrics = await miniapp_db.db.get_superadmin_metrics()
         return metrics
 
+    @app.get(
+        "/api/superadmin/db-queries",
+        response_model=Dict[str, Any],
+        responses={**COMMON_AUTH_RESPONSES},
+    )
+    async def get_superadmin_db_queries(
+        top: int = Query(50, ge=1, le=500),
+        order_by: str = Query("total_ms", pattern="^(total_ms|count)$"),
+        current_user: Dict[str, Any] = Depends(require_superadmin),
+    ):
+        """
+        Статистика запросов к БД процесса API: латентность (гистограмма, p50/p95/p99),
+        строки, ошибки по каждому запросу и ожидание соединения из пула.
+        """
+        return miniapp_db.db.get_query_stats(top=top, order_by=order_by)
+
     @app.post(
         "/api/billing/ton/cancel",
         response_model=TonInvoiceCancelResponse,
@@ -6,12 +6,15 @@ import os
 import socket
 import subprocess
 import sys
-from typing import Dict, Optional
+from typing import Any, Dict, List, Optional
 
 from aiogram.types import Update
 
 from shared.database import MasterDatabase, get_master_dsn
 from shared.cleanup_tasks import QueueCleanupService
+from shared.models import UpdateQueueItem
+from shared.rate_limiter import RateLimiter
+from shared.telegram_session import close_shared_session
 from worker.main import GraceHubWorker
 
 logger = logging.getLogger("queue_worker")
@@ -56,16 +59,11 @@ async def _get_or_create_worker(
     if w:
         return w
 
-    token = await db.get_decrypted_token(instance_id)
-    if not token:
-        logger.warning(f"No token found for instance {instance_id}")
-        return None
-
-    w = GraceHubWorker(instance_id=instance_id, db=db, token=token)
+    # токен, инстанс и настройки воркер забирает сам одним запросом в initialize()
+    w = GraceHubWorker(instance_id=instance_id, db=db)
 
     try:
         await w.initialize()
-        logger.info(f"✅ Worker {instance_id} initialized successfully (bot: {w.bot_username})")
     except Exception as e:
         logger.error(
             f"❌ Failed to initialize worker {instance_id}: {type(e).__name__}: {e}",
@@ -73,6 +71,15 @@ async def _get_or_create_worker(
         )
         return None
 
+    if w.bot is None:
+        logger.warning(f"No token found for instance {instance_id}")
+        return None
+
+    logger.info(
+        f"✅ Worker {instance_id} initialized successfully (bot: {w.bot_username}, "
+        f"cold start {w.cold_start_timings.get('total')}ms)"
+    )
+
     cache[instance_id] = w
     return w
 
@@ -102,6 +109,102 @@ async def stuck_requeue_loop(
         await asyncio.sleep(interval_seconds)
 
 
+async def _run_instance_commands(
+    db: MasterDatabase,
+    cache: Dict[str, GraceHubWorker],
+    instance_id: str,
+    commands: List[Dict[str, Any]],
+    slots: asyncio.Semaphore,
+) -> None:
+    """
+    Команды одного инстанса — по очереди в порядке id (например, закрытие тикета
+    после создания темы), под общим для всех инстансов ограничением slots.
+    """
+    async with slots:
+        worker = await _get_or_create_worker(cache, db, instance_id)
+        for cmd in commands:
+            if not worker:
+                await db.fail_bot_command(cmd["id"], f"no token for instance_id={instance_id}")
+                continue
+            await worker.run_bot_command(cmd)
+
+
+async def bot_commands_loop(
+    db: MasterDatabase,
+    cache: Dict[str, GraceHubWorker],
+    worker_id: str,
+    wakeup_event: asyncio.Event,
+    *,
+    fallback_seconds: float,
+    concurrency: int = 4,
+) -> None:
+    """
+    Разбирает bot_commands (команды Mini App) по NOTIFY 'bot_command_channel'.
+    Команду выполняет воркер её инстанса из кэша этой реплики; в простое запросов нет,
+    кроме перепроверки раз в fallback_seconds (зависшие claim'ы, потерянные NOTIFY).
+    Заклейменная пачка раскладывается по инстансам: разные инстансы выполняются
+    параллельно (не больше concurrency сразу), медленный тенант не держит остальных.
+    """
+    slots = asyncio.Semaphore(max(1, concurrency))
+    wakeup_event.set()  # при старте разбираем накопившееся
+    while True:
+        try:
+            await asyncio.wait_for(wakeup_event.wait(), timeout=fallback_seconds)
+        except asyncio.TimeoutError:
+            pass
+        wakeup_event.clear()
+
+        try:
+            while True:
+                commands = await db.pick_bot_commands(worker_id)
+                if not commands:
+                    break
+                by_instance: Dict[str, List[Dict[str, Any]]] = {}
+                for cmd in commands:
+                    by_instance.setdefault(cmd["instance_id"], []).append(cmd)
+
+                results = await asyncio.gather(
+                    *(
+                        _run_instance_commands(db, cache, instance_id, cmds, slots)
+                        for instance_id, cmds in by_instance.items()
+                    ),
+                    return_exceptions=True,
+                )
+                for instance_id, result in zip(by_instance, results):
+                    if isinstance(result, Exception):
+                        logger.error(
+                            "❌ Bot commands for instance %s failed: %s",
+                            instance_id,
+                            result,
+                            exc_info=result,
+                        )
+        except Exception:
+            logger.exception("bot_commands_loop failed")
+            await asyncio.sleep(5)
+
+
+async def db_stats_loop(db: MasterDatabase, *, interval_seconds: float) -> None:
+    """Периодически пишет в лог топ запросов к БД по суммарному времени."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            db.query_stats.log_top()
+        except Exception:
+            logger.exception("db_stats_loop failed")
+
+
+async def heartbeat_loop(
+    db: MasterDatabase, executor: RateLimiter, worker_id: str, *, interval_seconds: float
+) -> None:
+    """Продлевает locked_at jobs, ожидающих в лейнах инстансов (см. REQUEUE_STUCK_MINUTES)."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await db.heartbeat_tg_updates(executor.held_job_ids(), worker_id)
+        except Exception:
+            logger.exception("heartbeat_loop failed")
+
+
 async def run_worker() -> None:
     logging.basicConfig(
         level=logging.INFO,
@@ -109,7 +212,7 @@ async def run_worker() -> None:
     )
 
     dsn = get_master_dsn()
-    db = MasterDatabase(dsn=dsn)
+    db = MasterDatabase(dsn=dsn, role="queue")
     await db.init()
 
     wid = _worker_id()
@@ -133,6 +236,16 @@ async def run_worker() -> None:
     no_token_max_attempts = _get_int_env("QUEUE_NO_TOKEN_MAX_ATTEMPTS", 1)
     no_token_retry_seconds = _get_int_env("QUEUE_NO_TOKEN_RETRY_SECONDS", 0)
 
+    # Локальные лейны инстансов: сколько апдейтов держим в памяти на инстанс и всего
+    lane_size = _get_int_env("QUEUE_INSTANCE_LANE_SIZE", 50)
+    max_inflight = _get_int_env("QUEUE_MAX_INFLIGHT", 500)
+    release_delay = _get_float_env("QUEUE_BACKPRESSURE_DELAY_SECONDS", 1.0)
+    db_stats_interval = _get_float_env("QUEUE_DB_STATS_LOG_SECONDS", 300.0)
+    # должен быть заметно меньше REQUEUE_STUCK_MINUTES сервиса очистки
+    heartbeat_interval = _get_float_env("QUEUE_HEARTBEAT_SECONDS", 60.0)
+    # сколько инстансов выполняют команды Mini App одновременно
+    commands_concurrency = _get_int_env("QUEUE_BOT_COMMANDS_CONCURRENCY", 4)
+
     cache: Dict[str, GraceHubWorker] = {}
 
     # 🔥 ЗАПУСКАЕМ СЕРВИС ОЧИСТКИ
@@ -162,29 +275,79 @@ async def run_worker() -> None:
     elif requeue_enabled and cleanup_enabled:
         logger.info("ℹ️ QUEUE_REQUEUE_ENABLED ignored (QueueCleanupService active)")
 
-    # 🔥 LISTEN/NOTIFY setup (всегда включён)
-    listen_conn = None
+    # 🔥 LISTEN/NOTIFY setup (всегда включён) — выделенное соединение вне пула
     wakeup_event = asyncio.Event()
+    commands_event = asyncio.Event()
     
     def on_notify(connection, pid, channel, payload):
         """Callback при получении NOTIFY от PostgreSQL"""
         wakeup_event.set()
+
+    def on_command_notify(connection, pid, channel, payload):
+        commands_event.set()
     
-    try:
-        listen_conn = await db.pool.acquire()
-        await listen_conn.add_listener('tg_update_channel', on_notify)
+    listening = await db.listen('tg_update_channel', on_notify)
+    listening = listening and await db.listen('bot_command_channel', on_command_notify)
+    if listening:
         logger.info("✅ LISTEN/NOTIFY active on 'tg_update_channel' (timeout=%ss)", listen_timeout)
-    except Exception as e:
-        logger.warning("⚠️ Failed to setup LISTEN/NOTIFY: %s. Falling back to polling.", e)
-        if listen_conn:
-            await db.pool.release(listen_conn)
-            listen_conn = None
+    else:
+        logger.warning("⚠️ Failed to setup LISTEN/NOTIFY. Falling back to polling.")
+
+    async def on_update(instance_id: str, update: Update) -> None:
+        await cache[instance_id].process_update(update)
+
+    async def on_done(item: UpdateQueueItem, error: Optional[BaseException]) -> None:
+        if error is None:
+            await db.ack_tg_update(item.job_id)
+            return
+        await db.fail_tg_update(
+            item.job_id,
+            f"{type(error).__name__}: {error}",
+            max_attempts=fail_max_attempts,
+            retry_seconds=fail_retry_seconds,
+        )
+
+    # Апдейты исполняются параллельно по инстансам, внутри инстанса — по приоритету
+    executor = RateLimiter(
+        on_update,
+        on_done=on_done,
+        on_capacity=wakeup_event.set,
+        lane_size=lane_size,
+        max_inflight=max_inflight,
+    )
+    logger.info("✅ Instance lanes: lane_size=%s max_inflight=%s", lane_size, max_inflight)
+
+    # Команды от API: без LISTEN — хотя бы перепроверка с интервалом idle_sleep * 10
+    commands_task = asyncio.create_task(
+        bot_commands_loop(
+            db,
+            cache,
+            wid,
+            commands_event,
+            fallback_seconds=listen_timeout if listening else max(1.0, idle_sleep * 10),
+            concurrency=commands_concurrency,
+        )
+    )
+
+    stats_task = (
+        asyncio.create_task(db_stats_loop(db, interval_seconds=db_stats_interval))
+        if db_stats_interval > 0
+        else None
+    )
+    heartbeat_task = asyncio.create_task(
+        heartbeat_loop(db, executor, wid, interval_seconds=heartbeat_interval)
+    )
 
     try:
         while True:
-            job = await db.pick_tg_update(worker_id=wid)
+            await executor.wait_for_capacity()
+            # инстансы с заполненными лейнами не берём — их апдейты достанутся другим репликам
+            job = await db.pick_tg_update(
+                worker_id=wid,
+                exclude_instances=executor.saturated_instances(),
+            )
             if not job:
-                if listen_conn:
+                if listening:
                     # 🔥 Ждём NOTIFY от PostgreSQL (вместо polling)
                     try:
                         await asyncio.wait_for(wakeup_event.wait(), timeout=listen_timeout)
@@ -216,10 +379,10 @@ async def run_worker() -> None:
                 if isinstance(payload, str):
                     payload = json.loads(payload)
 
-                update = Update(**payload)
-                await worker.process_update(update)
-
-                await db.ack_tg_update(job_id)
+                executor.attach_limiter(instance_id, worker.ratelimiter)
+                if not executor.add_update(instance_id, payload, job_id=job_id):
+                    # лейн заполнился между выборкой и постановкой — возвращаем без штрафа
+                    await db.release_tg_update(job_id, delay_seconds=release_delay)
 
             except Exception as e:
                 await db.fail_tg_update(
@@ -233,24 +396,40 @@ async def run_worker() -> None:
     except KeyboardInterrupt:
         logger.info("🛑 Received shutdown signal, stopping gracefully...")
     finally:
-        # 🔥 CLEANUP: отключаем LISTEN/NOTIFY
-        if listen_conn:
+        commands_task.cancel()
+        heartbeat_task.cancel()
+        if stats_task is not None:
+            stats_task.cancel()
+
+        # Необработанные апдейты из лейнов — обратно в очередь, не дожидаясь stuck-реквея
+        for item in await executor.shutdown():
             try:
-                await listen_conn.remove_listener('tg_update_channel', on_notify)
-                await db.pool.release(listen_conn)
-                logger.info("✅ LISTEN/NOTIFY connection released")
+                await db.release_tg_update(item.job_id)
             except Exception as e:
-                logger.warning("⚠️ Error releasing LISTEN connection: %s", e)
+                logger.warning("⚠️ Failed to release job %s: %s", item.job_id, e)
+
+        # 🔥 CLEANUP: отключаем LISTEN/NOTIFY
+        await db.unlisten('tg_update_channel', on_notify)
+        await db.unlisten('bot_command_channel', on_command_notify)
         
         # Останавливаем cleanup service
         if cleanup_service:
             logger.info("⏳ Stopping QueueCleanupService...")
             await cleanup_service.stop()
-        
-        # Закрываем пул БД
-        if db.pool:
-            await db.pool.close()
-            logger.info("✅ Database pool closed")
+
+        # Дожидаемся альбомов и отложенных исходящих отправок, пока HTTP-пул и БД открыты
+        for w in list(cache.values()):
+            try:
+                await w.shutdown()
+            except Exception:
+                logger.exception("Worker %s shutdown failed", w.instance_id)
+
+        # Закрываем общий HTTP-пул к Telegram
+        await close_shared_session()
+
+        # Закрываем LISTEN-соединение и пул БД
+        await db.close()
+        logger.info("✅ Database pool closed")
         
         logger.info("👋 Queue worker shutdown complete")
 
@@ -0,0 +1,132 @@
+# src/shared/antiflood.py
+import logging
+import time
+
+from cachetools import TTLCache
+
+from . import settings
+
+logger = logging.getLogger(__name__)
+
+
+class DistributedFloodCounter:
+    """
+    Антифлуд-счётчики, общие для всех реплик воркера одного инстанса.
+
+    - сообщения в минуту: скользящее окно из бакетов в UNLOGGED-таблице
+      worker_flood_counters (upsert + сумма окна за один запрос);
+    - "сессия" (сообщения подряд без ответа оператора): worker_session_counters,
+      атомарный инкремент с проверкой лимита, сброс при ответе оператора.
+
+    Локальный fast-path: пользователь, уже упёршийся в лимит, помнится в памяти
+    до конца текущего бакета, и повторный спам не доходит до БД.
+    """
+
+    WINDOW_SECONDS = 60
+
+    def __init__(self, db, instance_id: str):  # db: MasterDatabase
+        self.db = db
+        self.instance_id = instance_id
+
+        self.bucket_seconds = settings.ANTIFLOOD_BUCKET_SECONDS
+        self.session_block_ttl = settings.ANTIFLOOD_SESSION_BLOCK_TTL
+
+        # user_id -> monotonic-дедлайн, до которого пользователь считается флудящим
+        self._flooding_until: TTLCache = TTLCache(maxsize=10000, ttl=self.WINDOW_SECONDS)
+        self._session_blocked: TTLCache = TTLCache(maxsize=10000, ttl=self.session_block_ttl)
+
+    async def hit(self, user_id: int, limit: int) -> bool:
+        """
+        Учитывает сообщение пользователя. True => превышен лимит сообщений в минуту.
+        """
+        if not limit or limit <= 0:
+            return False
+
+        now_mono = time.monotonic()
+        until = self._flooding_until.get(user_id)
+        if until is not None and now_mono < until:
+            return True
+
+        now = time.time()
+        bucket = int(now // self.bucket_seconds)
+        buckets_in_window = max(1, self.WINDOW_SECONDS // self.bucket_seconds)
+        first_full = bucket - buckets_in_window + 1
+
+        row = await self.db.fetchone(
+            """
+            WITH up AS (
+                INSERT INTO worker_flood_counters (instance_id, user_id, bucket, hits)
+                VALUES ($1, $2, $3, 1)
+                ON CONFLICT (instance_id, user_id, bucket)
+                DO UPDATE SET hits = worker_flood_counters.hits + 1
+                RETURNING hits
+            )
+            SELECT
+                (SELECT hits FROM up) AS current_hits,
+                COALESCE((
+                    SELECT SUM(hits)
+                    FROM worker_flood_counters
+                    WHERE instance_id = $1 AND user_id = $2
+                      AND bucket >= $4 AND bucket < $3
+                ), 0) AS recent_hits,
+                COALESCE((
+                    SELECT hits
+                    FROM worker_flood_counters
+                    WHERE instance_id = $1 AND user_id = $2 AND bucket = $4 - 1
+                ), 0) AS oldest_hits
+            """,
+            (self.instance_id, user_id, bucket, first_full),
+        )
+        if not row:
+            return False
+
+        # самый старый бакет входит в окно частично — взвешиваем по прошедшей доле
+        elapsed = (now % self.bucket_seconds) / self.bucket_seconds
+        total = (
+            int(row["current_hits"] or 0)
+            + int(row["recent_hits"] or 0)
+            + int(row["oldest_hits"] or 0) * (1.0 - elapsed)
+        )
+
+        if total > limit:
+            # до конца текущего бакета счётчик окна меньше не станет
+            self._flooding_until[user_id] = now_mono + (1.0 - elapsed) * self.bucket_seconds
+            return True
+        return False
+
+    async def try_acquire_session(self, user_id: int, limit: int) -> bool:
+        """
+        Атомарно занимает слот "сообщения подряд". False => лимит сессии исчерпан.
+        """
+        if user_id in self._session_blocked:
+            return False
+
+        row = await self.db.fetchone(
+            """
+            INSERT INTO worker_session_counters (instance_id, user_id, messages, updated_at)
+            VALUES ($1, $2, 1, NOW())
+            ON CONFLICT (instance_id, user_id)
+            DO UPDATE SET messages   = worker_session_counters.messages + 1,
+                          updated_at = NOW()
+            WHERE worker_session_counters.messages < $3
+            RETURNING messages
+            """,
+            (self.instance_id, user_id, limit),
+        )
+        if row is None:
+            self._session_blocked[user_id] = True
+            return False
+        return True
+
+    async def reset_session(self, user_id: int) -> None:
+        """
+        Оператор ответил — пользователь снова может писать.
+        """
+        self._session_blocked.pop(user_id, None)
+        await self.db.execute(
+            """
+            DELETE FROM worker_session_counters
+            WHERE instance_id = $1 AND user_id = $2
+            """,
+            (self.instance_id, user_id),
+        )
@@ -2,6 +2,7 @@
 import asyncio
 import logging
 import os
+import time
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 
@@ -22,6 +23,7 @@ class QueueCleanupService:
         self.cleanup_dead_days = int(os.getenv("CLEANUP_DEAD_DAYS", "30"))
         self.cleanup_stale_days = int(os.getenv("CLEANUP_STALE_DAYS", "3"))
         self.requeue_stuck_minutes = int(os.getenv("REQUEUE_STUCK_MINUTES", "5"))
+        self.session_counter_idle_hours = int(os.getenv("SESSION_COUNTER_IDLE_HOURS", "24"))
         
     async def cleanup_done_updates(self, days: Optional[int] = None) -> int:
         """Удаляет успешно обработанные обновления старше N дней"""
@@ -81,6 +83,64 @@ class QueueCleanupService:
             logger.info(f"🧹 Cleaned {deleted} stale pending/retry older than {days}d")
         return deleted
     
+    async def cleanup_flood_counters(self) -> int:
+        """Удаляет бакеты антифлуда вне окна, простаивающие сессионные счётчики и бакеты лимитера"""
+        bucket_seconds = max(1, int(os.getenv("ANTIFLOOD_BUCKET_SECONDS", "10")))
+        # с запасом: окно 60 сек + один частично учитываемый бакет
+        min_bucket = int(time.time() // bucket_seconds) - (120 // bucket_seconds) - 1
+
+        result = await self.db.execute(
+            """
+            DELETE FROM worker_flood_counters
+            WHERE bucket < $1
+            """,
+            (min_bucket,)
+        )
+        deleted = int(result.split()[-1]) if result and result.split() else 0
+
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=self.session_counter_idle_hours)
+        result = await self.db.execute(
+            """
+            DELETE FROM worker_session_counters
+            WHERE updated_at < $1
+            """,
+            (cutoff,)
+        )
+        deleted += int(result.split()[-1]) if result and result.split() else 0
+
+        # Простаивающий час бакет лимитера давно полный — удалённый пересоздастся таким же
+        result = await self.db.execute(
+            """
+            DELETE FROM tg_rate_buckets
+            WHERE refilled_at < clock_timestamp() - interval '1 hour'
+            """
+        )
+        deleted += int(result.split()[-1]) if result and result.split() else 0
+
+        if deleted > 0:
+            logger.info(f"🧹 Cleaned {deleted} stale antiflood counters and rate buckets")
+        return deleted
+
+    async def maintain_message_partitions(self) -> int:
+        """
+        Ретеншн истории: создаёт партиции messages наперёд, дозаливает строки старой
+        таблицы после миграции и удаляет истёкшие партиции целиком
+        """
+        try:
+            created = await self.db.ensure_message_partitions()
+            copied = await self.db.copy_legacy_messages()
+            dropped = await self.db.drop_expired_message_partitions()
+        except Exception as e:
+            logger.warning(f"⚠️ Messages partition maintenance failed: {e}")
+            return 0
+
+        if created or copied or dropped:
+            logger.info(
+                f"🗂 Messages partitions: created={created}, legacy_copied={copied}, "
+                f"dropped={dropped}"
+            )
+        return dropped
+
     async def vacuum_analyze_queue(self):
         """VACUUM ANALYZE для оптимизации таблицы после массовых удалений"""
         try:
@@ -148,6 +208,12 @@ class QueueCleanupService:
                 # 4. Очистка dead (реже всего)
                 deleted_dead = await self.cleanup_dead_updates()
                 await asyncio.sleep(1)
+
+                # 4.1. Антифлуд-счётчики (не входят в total_deleted — это не очередь)
+                await self.cleanup_flood_counters()
+
+                # 4.2. Партиции истории сообщений (DROP истёкших вместо DELETE по строкам)
+                await self.maintain_message_partitions()
                 
                 # 5. VACUUM только ночью (в 3:00-4:00 UTC) и если удалили много
                 total_deleted = deleted_done + deleted_stale + deleted_dead
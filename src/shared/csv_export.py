@@ -0,0 +1,84 @@
+# src/shared/csv_export.py
+import csv
+import gzip
+import io
+import logging
+import os
+import tempfile
+from typing import Any, Iterable, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Лимит Bot API на загрузку документа — 50 МБ, оставляем запас
+DEFAULT_PART_MAX_BYTES = 45 * 1024 * 1024
+
+
+class GzipCsvPartWriter:
+    """
+    Пишет CSV во временные gzip-файлы, начиная новую часть, когда сжатый размер
+    текущей превышает part_max_bytes. Каждая часть — самостоятельный .csv.gz
+    с заголовком. Память — O(одна пачка строк), данные живут на диске.
+
+    Методы синхронные (файловый I/O и сжатие): из asyncio их зовут через
+    asyncio.to_thread. Файлы удаляет cleanup().
+    """
+
+    def __init__(
+        self,
+        header: Sequence[str],
+        prefix: str = "export",
+        part_max_bytes: int = DEFAULT_PART_MAX_BYTES,
+    ):
+        self.header = list(header)
+        self.prefix = prefix
+        self.part_max_bytes = part_max_bytes
+
+        self.paths: List[str] = []
+        self.rows_written = 0
+
+        self._raw = None
+        self._gz: Optional[gzip.GzipFile] = None
+        self._text: Optional[io.TextIOWrapper] = None
+        self._writer = None
+
+    def _open_part(self) -> None:
+        fd, path = tempfile.mkstemp(prefix=f"{self.prefix}_", suffix=".csv.gz")
+        self.paths.append(path)
+        self._raw = os.fdopen(fd, "wb")
+        self._gz = gzip.GzipFile(fileobj=self._raw, mode="wb")
+        self._text = io.TextIOWrapper(self._gz, encoding="utf-8", newline="")
+        self._writer = csv.writer(self._text)
+        self._writer.writerow(self.header)
+
+    def _close_part(self) -> None:
+        if self._text is None:
+            return
+        self._text.close()  # закрывает и gzip-поток
+        self._raw.close()
+        self._raw = self._gz = self._text = self._writer = None
+
+    def write_rows(self, rows: Iterable[Sequence[Any]]) -> None:
+        if self._writer is None:
+            self._open_part()
+
+        for row in rows:
+            self._writer.writerow(row)
+            self.rows_written += 1
+
+        # размер проверяем по уже сжатым байтам на диске — после каждой пачки
+        self._text.flush()
+        if self._raw.tell() >= self.part_max_bytes:
+            self._close_part()
+
+    def finish(self) -> List[str]:
+        self._close_part()
+        return list(self.paths)
+
+    def cleanup(self) -> None:
+        self._close_part()
+        for path in self.paths:
+            try:
+                os.remove(path)
+            except OSError:
+                logger.warning("Failed to remove export file %s", path)
+        self.paths = []
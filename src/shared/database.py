@@ -5,16 +5,22 @@ import json
 import logging
 import os
 import asyncio
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple, Union
 
 import asyncpg
 import base64
 from cachetools import TTLCache
 from cryptography.fernet import Fernet
 
-from . import settings
+from . import message_partitions, settings
+from .db_metrics import QueryStats, register_query, rows_affected
+from .db_pool import DEFAULT_ROLE, DbListener, PoolSize, pool_size_for_role
+from .db_replicas import REPLICA_FALLBACK_ERRORS, ReplicaRouter
+from .migrations import ensure_schema
 from .models import BotInstance, InstanceStatus
 
 logger = logging.getLogger(__name__)
@@ -62,26 +68,252 @@ def get_master_dsn() -> str:
     )
 
 
+# === Именованные запросы горячего пути (метрики по имени, стабильный текст для кэша
+# prepared statements asyncpg). Ad-hoc SQL метрики группируют по отпечатку текста ===
+
+_Q_TG_UPDATE_PICK = register_query(
+    "tg_update.pick",
+    """
+    WITH cte AS (
+        SELECT id
+        FROM tg_update_queue
+        WHERE status IN ('pending', 'retry')
+        AND run_at <= NOW()
+        AND NOT (instance_id = ANY($2::text[]))
+        ORDER BY run_at ASC, id ASC
+        FOR UPDATE SKIP LOCKED
+        LIMIT 1
+    )
+    UPDATE tg_update_queue q
+    SET status = 'processing',
+        attempts = q.attempts + 1,
+        locked_at = NOW(),
+        locked_by = $1,
+        updated_at = NOW()
+    FROM cte
+    WHERE q.id = cte.id
+    RETURNING q.*;
+    """,
+)
+
+_Q_TG_UPDATE_ACK = register_query(
+    "tg_update.ack",
+    """
+    UPDATE tg_update_queue
+    SET status = 'done',
+        locked_at = NULL,
+        locked_by = NULL,
+        updated_at = NOW()
+    WHERE id = $1
+    """,
+)
+
+_Q_TG_UPDATE_RELEASE = register_query(
+    "tg_update.release",
+    """
+    UPDATE tg_update_queue
+    SET status = 'retry',
+        attempts = GREATEST(attempts - 1, 0),
+        run_at = NOW() + ($2::float8 * interval '1 second'),
+        locked_at = NULL,
+        locked_by = NULL,
+        updated_at = NOW()
+    WHERE id = $1::bigint AND status = 'processing'
+    """,
+)
+
+_Q_TG_UPDATE_HEARTBEAT = register_query(
+    "tg_update.heartbeat",
+    """
+    UPDATE tg_update_queue
+    SET locked_at = NOW()
+    WHERE id = ANY($1::bigint[])
+    AND status = 'processing'
+    AND locked_by = $2
+    """,
+)
+
+_Q_TG_UPDATE_FAIL = register_query(
+    "tg_update.fail",
+    """
+    UPDATE tg_update_queue
+    SET status = CASE WHEN attempts < $2::int THEN 'retry' ELSE 'dead' END,
+        run_at  = CASE
+                    WHEN attempts < $2::int
+                    THEN NOW() + ($3::int * interval '1 second')
+                    ELSE run_at
+                END,
+        last_error = $4::text,
+        locked_at = NULL,
+        locked_by = NULL,
+        updated_at = NOW()
+    WHERE id = $1::bigint
+    RETURNING status
+    """,
+)
+
+_Q_RATE_PENALIZE = register_query(
+    "rate_bucket.penalize",
+    """
+    INSERT INTO tg_rate_buckets (bucket_key, tokens, refilled_at)
+    VALUES ($1, -($2::float8 * $3::float8), clock_timestamp())
+    ON CONFLICT (bucket_key) DO UPDATE
+    SET tokens = LEAST(tg_rate_buckets.tokens, EXCLUDED.tokens),
+        refilled_at = clock_timestamp()
+    """,
+)
+
+_Q_RATE_ACQUIRE = register_query(
+    "rate_bucket.acquire",
+    "SELECT tg_rate_acquire($1::text[], $2::float8[], $3::float8[], $4::int[]) AS granted",
+)
+
+# expires_at = сейчас + срок хранения тарифа инстанса: строка сразу ложится
+# в партицию, которую ретеншн потом удалит целиком
+_Q_MESSAGES_INSERT = register_query(
+    "messages.insert",
+    """
+    INSERT INTO messages (
+        instance_id, chat_id, message_id, user_id, direction, content, expires_at
+    )
+    VALUES (
+        $1, $2, $3, $4, $5, $6,
+        NOW() + make_interval(days => COALESCE(
+            (
+                SELECT sp.messages_retention_days
+                FROM instance_billing AS ib
+                JOIN saas_plans AS sp ON sp.plan_id = ib.plan_id
+                WHERE ib.instance_id = $1
+            ),
+            $7
+        ))
+    )
+    """,
+)
+
+_Q_MESSAGES_USER_TIMELINE = register_query(
+    "messages.user_timeline",
+    """
+    SELECT id, chat_id, message_id, user_id, direction, content, created_at
+    FROM messages
+    WHERE instance_id = $1
+      AND user_id = $2
+      AND expires_at > NOW()
+    ORDER BY created_at DESC
+    LIMIT $3
+    """,
+)
+
+
+# Автозакрытие по всем тенантам одним запросом. Часы — из instance_meta (их правит
+# Mini App), затем instance_settings, затем дефолт. Глобальный нижний порог (самый
+# короткий срок среди инстансов, считается один раз) даёт индексный диапазон по
+# idx_tickets_autoclose: читаются только кандидаты на закрытие, а не все тенанты.
+# Закрытые тикеты сразу уходят воркерам одной командой на инстанс
+_Q_TICKETS_AUTOCLOSE = register_query(
+    "tickets.autoclose",
+    """
+    WITH closed AS (
+        UPDATE tickets AS t
+        SET status = 'closed',
+            closed_at = NOW(),
+            updated_at = NOW()
+        FROM bot_instances AS bi
+        LEFT JOIN instance_meta AS im ON im.instance_id = bi.instance_id
+        LEFT JOIN instance_settings AS s ON s.instance_id = bi.instance_id
+        WHERE t.instance_id = bi.instance_id
+          AND bi.status = ANY($2::text[])
+          AND t.status IN ('inprogress', 'answered')
+          AND t.last_admin_reply_at IS NOT NULL
+          AND (
+              t.last_user_msg_at IS NULL
+              OR t.last_user_msg_at < NOW() - make_interval(hours => (
+                  SELECT LEAST(
+                      $1::int,
+                      (SELECT MIN(auto_close_hours) FROM instance_meta),
+                      (SELECT MIN(autoclose_hours) FROM instance_settings)
+                  )
+              ))
+          )
+          AND (
+              t.last_user_msg_at IS NULL
+              OR t.last_user_msg_at < NOW() - make_interval(
+                  hours => COALESCE(im.auto_close_hours, s.autoclose_hours, $1)
+              )
+          )
+        RETURNING t.instance_id, t.id
+    )
+    INSERT INTO bot_commands (instance_id, command, payload)
+    SELECT
+        instance_id,
+        'tickets_autoclosed',
+        jsonb_build_object('ticket_ids', jsonb_agg(id ORDER BY id))
+    FROM closed
+    GROUP BY instance_id
+    RETURNING instance_id, jsonb_array_length(payload -> 'ticket_ids') AS closed
+    """,
+)
+
 class MasterDatabase:
     """
     Master DB на PostgreSQL.
     - Подключение через asyncpg с пулом соединений.
     - Шифрование токенов через Fernet, ключ хранится в settings.ENCRYPTION_KEY_FILE.
+    - Размер пула — по роли процесса из общего бюджета соединений (shared.db_pool),
+      LISTEN — на одном выделенном соединении вне пула (self.listener).
+    - read_only=True / read_connection() — чтение с реплики (если есть и не отстаёт),
+      иначе с primary.
     """
 
-    def __init__(self, dsn: Optional[str] = None):
+    def __init__(
+        self,
+        dsn: Optional[str] = None,
+        role: Optional[str] = None,
+        replica_dsns: Optional[Sequence[str]] = None,
+    ):
         self.dsn: str = dsn or get_master_dsn()
+        self.role: str = role or settings.DB_ROLE or DEFAULT_ROLE
+        # LISTEN и advisory-локи не работают через PgBouncer в transaction-режиме
+        self.direct_dsn: str = settings.DB_DIRECT_URL or self.dsn
         self.pool: Optional[asyncpg.Pool] = None
+        self.listener = DbListener(self.direct_dsn)
+        self.replicas = ReplicaRouter(
+            settings.DB_REPLICA_URLS if replica_dsns is None else replica_dsns,
+            max_lag=settings.DB_REPLICA_MAX_LAG_SECONDS,
+            check_interval=settings.DB_REPLICA_CHECK_INTERVAL,
+        )
         self.cipher: Optional[Fernet] = None
         self.settings_cache = TTLCache(maxsize=100, ttl=60)  # Кэш для платформенных настроек
+        # латентность/строки по запросам тонких обёрток и ожидание соединения из пула
+        self.query_stats = QueryStats(
+            slow_ms=settings.DB_SLOW_QUERY_MS,
+            max_queries=settings.DB_QUERY_STATS_MAX,
+        )
 
-    async def init(self) -> None:
+    async def init(self, *, migrate: Optional[bool] = None) -> None:
         """
         Полная инициализация с AUTOMATIC DB RETRY + graceful cipher fallback.
+        migrate=None — по settings.DB_AUTO_MIGRATE (см. shared.migrations).
         """
         if not self.dsn.startswith("postgresql://"):
             raise RuntimeError("SQLite не поддерживается")
 
+        size = self.pool_size()
+        pool_options: Dict[str, Any] = {}
+        if settings.DB_PGBOUNCER:
+            # transaction pooling: соседний запрос может уйти на другое серверное
+            # соединение — именованные prepared statements asyncpg там не существуют
+            pool_options["statement_cache_size"] = 0
+            if not settings.DB_DIRECT_URL:
+                logger.warning("⚠️ DB_PGBOUNCER=1 without DB_DIRECT_URL: LISTEN will not work")
+        logger.info(
+            "🔗 DB pool for role=%s: min=%s max=%s pgbouncer=%s",
+            self.role,
+            size.min_size,
+            size.max_size,
+            settings.DB_PGBOUNCER,
+        )
+
         # 🔥 DB RETRY LOOP - ждём БД до 30 сек!
         max_retries = 15
         self.pool = None
@@ -90,7 +322,12 @@ class MasterDatabase:
             try:
                 logger.info(f"🔗 DB connect attempt {attempt+1}/{max_retries}")
                 self.pool = await asyncpg.create_pool(
-                    self.dsn, min_size=5, max_size=20, timeout=30, max_inactive_connection_lifetime=300
+                    self.dsn,
+                    min_size=size.min_size,
+                    max_size=size.max_size,
+                    timeout=30,
+                    max_inactive_connection_lifetime=300,
+                    **pool_options,
                 )
                 
                 # 🔥 ТЕСТ подключения!
@@ -108,6 +345,9 @@ class MasterDatabase:
                     await asyncio.sleep(2)
                 else:
                     raise RuntimeError(f"❌ DB timeout after {max_retries*2}s: {e}")
+
+        if self.replicas:
+            await self.replicas.init(max_size=max(1, size.max_size // 2), **pool_options)
         
         # 🔥 CIPHER с graceful fallback
         try:
@@ -120,12 +360,64 @@ class MasterDatabase:
             self.cipher = None  # 🔥 Graceful fallback!
             logger.warning("⚠️ Running WITHOUT encryption")
 
-        # 🔥 Tables + settings (теперь точно работает!)
-        await self.create_tables()
+        # 🔥 Схема: на обычном старте — только сверка версии, DDL один раз за деплой
+        await ensure_schema(
+            self, auto_migrate=settings.DB_AUTO_MIGRATE if migrate is None else migrate
+        )
         await self.ensure_default_platform_settings()
         await self.ensure_env_superadmin_in_db()
         logger.info(f"✅ MasterDatabase fully initialized: {self.dsn}")
 
+    def pool_size(self) -> PoolSize:
+        if settings.DB_POOL_MAX_SIZE > 0:
+            max_size = settings.DB_POOL_MAX_SIZE
+            return PoolSize(min(settings.DB_POOL_MIN_SIZE, max_size), max_size)
+        return pool_size_for_role(
+            self.role,
+            settings.DB_CONNECTION_BUDGET,
+            settings.DB_BUDGET_REPLICAS,
+            reserve=settings.DB_CONNECTION_RESERVE,
+            min_size=settings.DB_POOL_MIN_SIZE,
+            worker_pool_size=settings.DB_WORKER_POOL_SIZE,
+        )
+
+    @asynccontextmanager
+    async def direct_connection(self):
+        """
+        Отдельное соединение напрямую с Postgres (мимо пула и PgBouncer) — для
+        сессионных вещей: advisory-локи миграций и т.п.
+        """
+        conn = await asyncpg.connect(self.direct_dsn)
+        try:
+            yield conn
+        finally:
+            await conn.close()
+
+    async def listen(self, channel: str, callback) -> bool:
+        """
+        Подписка на NOTIFY через общее для процесса LISTEN-соединение.
+        False — подписаться не удалось (вызывающий код остаётся на поллинге).
+        """
+        try:
+            await self.listener.listen(channel, callback)
+            return True
+        except Exception as e:
+            logger.warning("⚠️ LISTEN %s failed: %s", channel, e)
+            return False
+
+    async def unlisten(self, channel: str, callback) -> None:
+        try:
+            await self.listener.unlisten(channel, callback)
+        except Exception as e:
+            logger.warning("⚠️ UNLISTEN %s failed: %s", channel, e)
+
+    async def close(self) -> None:
+        await self.listener.close()
+        await self.replicas.close()
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+
     async def count_instances_for_user(self, userid: int) -> int:
         row = await self.fetchone(
             "SELECT COUNT(*) AS cnt FROM bot_instances WHERE user_id = $1", (userid,)
@@ -150,7 +442,9 @@ class MasterDatabase:
         return {"enabled": enabled, "url": url}
 
     async def count_unique_users(self) -> int:
-        row = await self.fetchone("SELECT COUNT(DISTINCT user_id) AS cnt FROM bot_instances")
+        row = await self.fetchone(
+            "SELECT COUNT(DISTINCT user_id) AS cnt FROM bot_instances", read_only=True
+        )
         return int(row["cnt"]) if row else 0
 
 
@@ -252,6 +546,60 @@ class MasterDatabase:
             (webhook_url, webhook_path, webhook_secret, instance_id),
         )
 
+    async def get_worker_bootstrap(
+        self,
+        instance_id: str,
+        default_settings: Dict[str, str],
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Холодный старт воркера за один запрос: инстанс + токен + worker_settings.
+        Отсутствующие дефолтные настройки дописываются в том же запросе.
+        Ключи и значения агрегируются с одинаковым ORDER BY key, иначе порядок
+        двух независимых array_agg не гарантирован и zip() перепутает пары.
+        Возвращает {"instance", "token", "settings"} или None, если инстанса нет.
+        """
+        keys = list(default_settings.keys())
+        values = [default_settings[k] for k in keys]
+
+        row = await self.fetchone(
+            """
+            WITH ins AS (
+                INSERT INTO worker_settings (instance_id, key, value)
+                SELECT $1, d.key, d.value
+                FROM unnest($2::text[], $3::text[]) AS d(key, value)
+                WHERE EXISTS (SELECT 1 FROM bot_instances WHERE instance_id = $1)
+                ON CONFLICT (instance_id, key) DO NOTHING
+                RETURNING key, value
+            ),
+            s AS (
+                SELECT key, value FROM worker_settings WHERE instance_id = $1
+                UNION ALL
+                SELECT key, value FROM ins
+            )
+            SELECT
+                bi.*,
+                et.encrypted_token,
+                (SELECT array_agg(key ORDER BY key) FROM s)   AS setting_keys,
+                (SELECT array_agg(value ORDER BY key) FROM s) AS setting_values
+            FROM bot_instances bi
+            LEFT JOIN encrypted_tokens et ON et.instance_id = bi.instance_id
+            WHERE bi.instance_id = $1
+            """,
+            (instance_id, keys, values),
+        )
+        if not row:
+            return None
+
+        token = None
+        if row["encrypted_token"] is not None:
+            token = self._decrypt_token(instance_id, row["encrypted_token"])
+
+        return {
+            "instance": self.row_to_instance(row),
+            "token": token,
+            "settings": dict(zip(row["setting_keys"] or [], row["setting_values"] or [])),
+        }
+
     def get_or_create_encryption_key(self) -> bytes:
         keyfile = Path(settings.ENCRYPTION_KEY_FILE)
         keyfile.parent.mkdir(parents=True, exist_ok=True)
@@ -473,7 +821,7 @@ class MasterDatabase:
 
 
     async def get_superadmin_metrics(self) -> Dict[str, Any]:
-        async with self.pool.acquire() as conn:
+        async with self.read_connection() as conn:
             # Активные клиенты: уникальные owner_user_id из bot_instances (или user_id из user_subscription)
             active_clients = await conn.fetchval(
                 "SELECT COUNT(DISTINCT owner_user_id) FROM bot_instances"
@@ -1195,6 +1543,21 @@ class MasterDatabase:
                     )
                     """
                 )
+                # воркер пишет username/added_at — дотягиваем старые схемы
+                await conn.execute(
+                    """
+                    ALTER TABLE blacklist
+                        ADD COLUMN IF NOT EXISTS username TEXT,
+                        ADD COLUMN IF NOT EXISTS added_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                    """
+                )
+                # keyset-пагинация списка в боте: (added_at, user_id) DESC
+                await conn.execute(
+                    """
+                    CREATE INDEX IF NOT EXISTS idx_blacklist_keyset
+                    ON blacklist (instance_id, added_at DESC, user_id DESC)
+                    """
+                )
 
                 # Индексы
                 await conn.execute(
@@ -1394,6 +1757,12 @@ class MasterDatabase:
             )
             """
         )
+        await conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_operators_keyset
+            ON operators (instance_id, last_seen DESC, user_id DESC)
+            """
+        )
 
         # tickets (тикетная история из всех worker-DB)
         await conn.execute(
@@ -1536,6 +1905,110 @@ class MasterDatabase:
             CREATE INDEX IF NOT EXISTS idx_bot_commands_instance_status 
             ON bot_commands(instance_id, status, created_at)
         """)
+
+        # Команды забирают queue-реплики по NOTIFY (claim/ack как у tg_update_queue)
+        await conn.execute("""
+            ALTER TABLE bot_commands
+                ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ,
+                ADD COLUMN IF NOT EXISTS claimed_by TEXT
+        """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_bot_commands_open
+            ON bot_commands(id)
+            WHERE status IN ('pending', 'processing')
+        """)
+        await conn.execute("""
+            CREATE OR REPLACE FUNCTION notify_new_bot_command()
+            RETURNS TRIGGER AS $$
+            BEGIN
+                PERFORM pg_notify('bot_command_channel', NEW.instance_id);
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+        """)
+        await conn.execute("""
+            DROP TRIGGER IF EXISTS bot_command_insert_trigger ON bot_commands;
+            CREATE TRIGGER bot_command_insert_trigger
+            AFTER INSERT ON bot_commands
+            FOR EACH ROW
+            EXECUTE FUNCTION notify_new_bot_command();
+        """)
+
+        # Антифлуд: общие для всех реплик счётчики (UNLOGGED — без WAL, потеря при краше не страшна)
+        await conn.execute(
+            """
+            CREATE UNLOGGED TABLE IF NOT EXISTS worker_flood_counters (
+                instance_id TEXT   NOT NULL,
+                user_id     BIGINT NOT NULL,
+                bucket      BIGINT NOT NULL,
+                hits        INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (instance_id, user_id, bucket)
+            )
+            """
+        )
+        await conn.execute(
+            """
+            CREATE UNLOGGED TABLE IF NOT EXISTS worker_session_counters (
+                instance_id TEXT   NOT NULL,
+                user_id     BIGINT NOT NULL,
+                messages    INTEGER NOT NULL DEFAULT 0,
+                updated_at  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (instance_id, user_id)
+            )
+            """
+        )
+
+        # Общие для всех процессов token bucket'ы Telegram (по боту и по чату бота).
+        # UNLOGGED: после краша бакеты просто начнутся заново полными
+        await conn.execute(
+            """
+            CREATE UNLOGGED TABLE IF NOT EXISTS tg_rate_buckets (
+                bucket_key  TEXT PRIMARY KEY,
+                tokens      DOUBLE PRECISION NOT NULL,
+                refilled_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+            )
+            """
+        )
+        # Выдаёт до want токенов из каждого бакета одним вызовом (ленивое пополнение)
+        await conn.execute(
+            """
+            CREATE OR REPLACE FUNCTION tg_rate_acquire(
+                keys TEXT[], capacities DOUBLE PRECISION[], rates DOUBLE PRECISION[], wants INT[]
+            ) RETURNS INT[] AS $$
+            DECLARE
+                i       INT;
+                t       DOUBLE PRECISION;
+                ts      TIMESTAMPTZ;
+                now_ts  TIMESTAMPTZ := clock_timestamp();
+                avail   DOUBLE PRECISION;
+                granted INT;
+                result  INT[] := '{}';
+            BEGIN
+                FOR i IN 1 .. array_length(keys, 1) LOOP
+                    INSERT INTO tg_rate_buckets (bucket_key, tokens, refilled_at)
+                    VALUES (keys[i], capacities[i], now_ts)
+                    ON CONFLICT (bucket_key) DO NOTHING;
+
+                    SELECT tokens, refilled_at INTO t, ts
+                    FROM tg_rate_buckets WHERE bucket_key = keys[i] FOR UPDATE;
+
+                    avail := LEAST(
+                        capacities[i],
+                        t + GREATEST(EXTRACT(EPOCH FROM now_ts - ts), 0) * rates[i]
+                    );
+                    granted := GREATEST(LEAST(wants[i], FLOOR(avail)::INT), 0);
+
+                    UPDATE tg_rate_buckets
+                    SET tokens = avail - granted, refilled_at = now_ts
+                    WHERE bucket_key = keys[i];
+
+                    result := result || granted;
+                END LOOP;
+                RETURN result;
+            END;
+            $$ LANGUAGE plpgsql;
+            """
+        )
         
 
     async def _create_billing_tables(self, conn) -> None:
@@ -1786,20 +2259,135 @@ class MasterDatabase:
 
     # === Thin async wrappers for miniapp_api and worker ===
 
-    async def execute(self, sql: str, params: Optional[tuple] = None) -> asyncpg.Record:
+    @asynccontextmanager
+    async def _acquire(self):
         assert self.pool is not None
+        t_start = time.perf_counter()
         async with self.pool.acquire() as conn:
-            return await conn.execute(sql, *(params or ()))
+            self.query_stats.observe_acquire(time.perf_counter() - t_start)
+            yield conn
 
-    async def fetchone(self, sql: str, params: Optional[tuple] = None):
-        assert self.pool is not None
-        async with self.pool.acquire() as conn:
-            return await conn.fetchrow(sql, *(params or ()))
+    async def _timed(self, sql: str, params, call, count_rows):
+        t_start = time.perf_counter()
+        try:
+            result = await call
+        except Exception as e:
+            self.query_stats.observe(sql, time.perf_counter() - t_start, params=params, error=e)
+            raise
+        self.query_stats.observe(
+            sql, time.perf_counter() - t_start, rows=count_rows(result), params=params
+        )
+        return result
+
+    async def execute(self, sql: str, params: Optional[tuple] = None) -> asyncpg.Record:
+        async with self._acquire() as conn:
+            return await self._timed(sql, params, conn.execute(sql, *(params or ())), rows_affected)
 
-    async def fetchall(self, sql: str, params: Optional[tuple] = None):
+    async def executemany(self, sql: str, params_list: List[tuple]) -> None:
         assert self.pool is not None
-        async with self.pool.acquire() as conn:
-            return await conn.fetch(sql, *(params or ()))
+        if not params_list:
+            return
+        async with self._acquire() as conn:
+            await self._timed(
+                sql, params_list[0], conn.executemany(sql, params_list), lambda _: len(params_list)
+            )
+
+    async def _run(self, sql: str, params, run, count_rows, read_only: bool, max_lag):
+        if read_only and self.replicas:
+            replica = await self.replicas.pick(max_lag)
+            if replica is not None:
+                try:
+                    async with replica.pool.acquire() as conn:
+                        return await self._timed(sql, params, run(conn), count_rows)
+                except REPLICA_FALLBACK_ERRORS as e:
+                    self.replicas.mark_down(replica, e)
+        async with self._acquire() as conn:
+            return await self._timed(sql, params, run(conn), count_rows)
+
+    async def fetchone(
+        self,
+        sql: str,
+        params: Optional[tuple] = None,
+        *,
+        read_only: bool = False,
+        max_lag: Optional[float] = None,
+    ):
+        """
+        read_only=True — можно читать с реплики, отстающей не больше max_lag секунд
+        (по умолчанию settings.DB_REPLICA_MAX_LAG_SECONDS). Только для запросов,
+        которым не нужно видеть только что записанное этим же процессом.
+        """
+        return await self._run(
+            sql,
+            params,
+            lambda conn: conn.fetchrow(sql, *(params or ())),
+            lambda row: int(row is not None),
+            read_only,
+            max_lag,
+        )
+
+    async def fetchall(
+        self,
+        sql: str,
+        params: Optional[tuple] = None,
+        *,
+        read_only: bool = False,
+        max_lag: Optional[float] = None,
+    ):
+        return await self._run(
+            sql, params, lambda conn: conn.fetch(sql, *(params or ())), len, read_only, max_lag
+        )
+
+    @asynccontextmanager
+    async def read_connection(self, max_lag: Optional[float] = None):
+        """
+        Соединение для серии read-only запросов: реплика, если есть годная, иначе primary.
+        На primary откатываемся только при недоступности реплики, не посреди запросов.
+        """
+        replica = await self.replicas.pick(max_lag) if self.replicas else None
+        if replica is not None:
+            try:
+                conn = await replica.pool.acquire(timeout=2.0)
+            except REPLICA_FALLBACK_ERRORS as e:
+                self.replicas.mark_down(replica, e)
+            else:
+                try:
+                    yield conn
+                finally:
+                    await replica.pool.release(conn)
+                return
+        async with self._acquire() as conn:
+            yield conn
+
+    def get_query_stats(self, top: int = 50, order_by: str = "total_ms") -> Dict[str, Any]:
+        """Топ запросов процесса по суммарному времени (или числу вызовов)."""
+        return self.query_stats.snapshot(top=top, order_by=order_by)
+
+    async def iterate(
+        self,
+        sql: str,
+        params: Optional[tuple] = None,
+        prefetch: int = 1000,
+        *,
+        read_only: bool = False,
+    ) -> AsyncIterator[List[asyncpg.Record]]:
+        """
+        Читает результат серверным курсором пачками по prefetch строк,
+        не загружая всю выборку в память (экспорты больших тенантов).
+        """
+        rows = 0
+        t_start = time.perf_counter()
+        async with (self.read_connection() if read_only else self._acquire()) as conn:
+            async with conn.transaction():
+                cursor = await conn.cursor(sql, *(params or ()))
+                while True:
+                    batch = await cursor.fetch(prefetch)
+                    if not batch:
+                        break
+                    rows += len(batch)
+                    yield batch
+        # время включает обработку пачек вызывающим кодом — курсор открыт всё это время
+        self.query_stats.observe(sql, time.perf_counter() - t_start, rows=rows, params=params)
 
     # === Instance CRUD ===
 
@@ -2121,7 +2709,7 @@ class MasterDatabase:
         Возвращает список клиентов для SuperAdmin (без имён — их нет в БД).
         Возвращает (clients_list, total_count)
         """
-        async with self.pool.acquire() as conn:
+        async with self.read_connection() as conn:
             # Определяем search_id параметр для фильтрации
             search_id = None
             if search:
@@ -2398,52 +2986,38 @@ class MasterDatabase:
         )
         return bool(row)
 
-    async def pick_tg_update(self, worker_id: str) -> Optional[dict]:
+    async def pick_tg_update(
+        self,
+        worker_id: str,
+        exclude_instances: Optional[Sequence[str]] = None,
+    ) -> Optional[dict]:
         """
         Atomically claims one job and returns full row as dict, or None.
+        exclude_instances — инстансы, чьи локальные очереди заполнены (backpressure):
+        их апдейты остаются в очереди для других реплик.
         """
-        assert self.pool is not None
-
-        async with self.pool.acquire() as conn:
-            async with conn.transaction():
-                row = await conn.fetchrow(
-                    """
-                    WITH cte AS (
-                        SELECT id
-                        FROM tg_update_queue
-                        WHERE status IN ('pending', 'retry')
-                        AND run_at <= NOW()
-                        ORDER BY run_at ASC, id ASC
-                        FOR UPDATE SKIP LOCKED
-                        LIMIT 1
-                    )
-                    UPDATE tg_update_queue q
-                    SET status = 'processing',
-                        attempts = q.attempts + 1,
-                        locked_at = NOW(),
-                        locked_by = $1,
-                        updated_at = NOW()
-                    FROM cte
-                    WHERE q.id = cte.id
-                    RETURNING q.*;
-                    """,
-                    worker_id,
-                )
-                return dict(row) if row else None
+        # один UPDATE ... FROM (SELECT ... FOR UPDATE SKIP LOCKED) атомарен и без явной транзакции
+        row = await self.fetchone(_Q_TG_UPDATE_PICK, (worker_id, list(exclude_instances or ())))
+        return dict(row) if row else None
 
 
     async def ack_tg_update(self, job_id: int) -> None:
-        await self.execute(
-            """
-            UPDATE tg_update_queue
-            SET status = 'done',
-                locked_at = NULL,
-                locked_by = NULL,
-                updated_at = NOW()
-            WHERE id = $1
-            """,
-            (int(job_id),),
-        )
+        await self.execute(_Q_TG_UPDATE_ACK, (int(job_id),))
+
+    async def release_tg_update(self, job_id: int, *, delay_seconds: float = 0) -> None:
+        """
+        Возвращает взятый job в очередь, не засчитывая попытку
+        (локальная очередь инстанса переполнена или воркер останавливается).
+        """
+        await self.execute(_Q_TG_UPDATE_RELEASE, (int(job_id), float(delay_seconds)))
+
+    async def heartbeat_tg_updates(self, job_ids: Sequence[int], worker_id: str) -> None:
+        """
+        Продлевает locked_at взятых, но ещё не обработанных jobs (стоят в лейнах
+        инстансов), чтобы реквей зависших не вернул их в очередь второй раз.
+        """
+        if job_ids:
+            await self.execute(_Q_TG_UPDATE_HEARTBEAT, ([int(j) for j in job_ids], worker_id))
 
     async def fail_tg_update(
         self,
@@ -2458,26 +3032,86 @@ class MasterDatabase:
         """
         error = (error or "")[:2000]  # чтобы не раздувать last_error
 
-        row = await self.fetchone(
+        row = await self.fetchone(_Q_TG_UPDATE_FAIL, (job_id, max_attempts, retry_seconds, error))
+        return (row["status"] if row else "dead")
+
+
+    async def pick_bot_commands(
+        self,
+        worker_id: str,
+        *,
+        instance_id: Optional[str] = None,
+        limit: int = 10,
+        stuck_seconds: int = 300,
+    ) -> List[dict]:
+        """
+        Атомарно забирает pending-команды (и зависшие в processing дольше stuck_seconds).
+        instance_id=None — команды любых инстансов (queue-реплики).
+        """
+        rows = await self.fetchall(
             """
-            UPDATE tg_update_queue
-            SET status = CASE WHEN attempts < $2::int THEN 'retry' ELSE 'dead' END,
-                run_at  = CASE
-                            WHEN attempts < $2::int
-                            THEN NOW() + ($3::int * interval '1 second')
-                            ELSE run_at
-                        END,
-                last_error = $4::text,
-                locked_at = NULL,
-                locked_by = NULL,
-                updated_at = NOW()
-            WHERE id = $1::bigint
-            RETURNING status
+            WITH cte AS (
+                SELECT id
+                FROM bot_commands
+                WHERE (status = 'pending'
+                       OR (status = 'processing'
+                           AND claimed_at < NOW() - ($3::int * interval '1 second')))
+                  AND ($2::text IS NULL OR instance_id = $2::text)
+                ORDER BY id ASC
+                FOR UPDATE SKIP LOCKED
+                LIMIT $4
+            )
+            UPDATE bot_commands c
+            SET status = 'processing',
+                claimed_at = NOW(),
+                claimed_by = $1
+            FROM cte
+            WHERE c.id = cte.id
+            RETURNING c.id, c.instance_id, c.command, c.payload
             """,
-            (job_id, max_attempts, retry_seconds, error),
+            (worker_id, instance_id, stuck_seconds, limit),
+        )
+        return [dict(r) for r in rows]
+
+    async def complete_bot_command(self, command_id: int) -> None:
+        await self.execute(
+            """
+            UPDATE bot_commands
+            SET status = 'completed', completed_at = NOW()
+            WHERE id = $1
+            """,
+            (int(command_id),),
         )
-        return (row["status"] if row else "dead")
 
+    async def fail_bot_command(self, command_id: int, error: str) -> None:
+        await self.execute(
+            """
+            UPDATE bot_commands
+            SET status = 'failed', error = $1
+            WHERE id = $2
+            """,
+            ((error or "")[:500], int(command_id)),
+        )
+
+    async def acquire_rate_tokens(
+        self,
+        keys: List[str],
+        capacities: List[float],
+        rates: List[float],
+        wants: List[int],
+    ) -> List[int]:
+        """
+        Берёт токены из общих token bucket'ов (tg_rate_buckets) — по каждому ключу
+        сколько выдано (0..want). Бакеты с отрицательным остатком — штраф после 429.
+        """
+        row = await self.fetchone(_Q_RATE_ACQUIRE, (keys, capacities, rates, wants))
+        return list(row["granted"]) if row else [0] * len(keys)
+
+    async def penalize_rate_bucket(self, key: str, seconds: float, rate: float) -> None:
+        """
+        Опустошает бакет на seconds вперёд (retry_after от Telegram) для всех процессов.
+        """
+        await self.execute(_Q_RATE_PENALIZE, (key, seconds, rate))
 
     async def requeue_stuck_tg_updates(self, *, stuck_seconds: int = 300) -> int:
         rows = await self.fetchall(
@@ -2511,6 +3145,17 @@ class MasterDatabase:
         )
         return [self.row_to_instance(r) for r in rows]
 
+    async def auto_close_tickets(self, default_hours: int) -> Dict[str, int]:
+        """
+        Закрывает отвеченные тикеты без ответа пользователя дольше срока инстанса
+        и ставит воркерам команды tickets_autoclosed. Возвращает {instance_id: закрыто}.
+        """
+        rows = await self.fetchall(
+            _Q_TICKETS_AUTOCLOSE,
+            (default_hours, [InstanceStatus.RUNNING.value, InstanceStatus.STARTING.value]),
+        )
+        return {row["instance_id"]: row["closed"] for row in rows}
+
     async def update_instance_status(
         self,
         instance_id: str,
@@ -2553,8 +3198,11 @@ class MasterDatabase:
         )
         if not row:
             return None
-        
-        encrypted_data = bytes(row["encrypted_token"])
+
+        return self._decrypt_token(instance_id, row["encrypted_token"])
+
+    def _decrypt_token(self, instance_id: str, encrypted_token) -> Optional[str]:
+        encrypted_data = bytes(encrypted_token)
         
         # 🔥 Graceful fallback!
         if self.cipher is None:
@@ -2647,6 +3295,69 @@ class MasterDatabase:
             (instance_id, user_id, state, data),
         )
 
+    # === История сообщений (messages, партиции по expires_at) ===
+
+    async def store_messages(self, rows: List[tuple]) -> None:
+        """rows: (instance_id, chat_id, message_id, user_id, direction, content)"""
+        default_days = settings.MESSAGES_RETENTION_DEFAULT_DAYS
+        await self.executemany(_Q_MESSAGES_INSERT, [(*row, default_days) for row in rows])
+
+    async def get_user_messages(
+        self, instance_id: str, user_id: int, limit: int = 50
+    ) -> List[Dict[str, Any]]:
+        """Последние limit сообщений пользователя в хронологическом порядке."""
+        rows = await self.fetchall(
+            _Q_MESSAGES_USER_TIMELINE, (instance_id, user_id, limit), read_only=True
+        )
+        return [dict(row) for row in reversed(rows)]
+
+    async def max_messages_retention_days(self, conn: asyncpg.Connection) -> int:
+        days = await conn.fetchval(
+            "SELECT MAX(messages_retention_days) FROM saas_plans WHERE is_active"
+        )
+        return max(int(days or 0), settings.MESSAGES_RETENTION_DEFAULT_DAYS)
+
+    async def ensure_message_partitions(self, conn: Optional[asyncpg.Connection] = None) -> int:
+        """
+        Партиции messages на всё окно, куда может попасть expires_at новой строки:
+        от текущего месяца до now + max(срок хранения) + запас. Возвращает число созданных.
+        """
+        if conn is None:
+            async with self._acquire() as conn:
+                return await self.ensure_message_partitions(conn)
+
+        now = datetime.now(timezone.utc)
+        max_days = await self.max_messages_retention_days(conn)
+        ahead = timedelta(days=max_days + 31 * settings.MESSAGES_PARTITIONS_AHEAD_MONTHS)
+        created = await message_partitions.ensure_partitions(conn, now, now + ahead)
+        return len(created)
+
+    async def copy_legacy_messages(self, batch_size: Optional[int] = None) -> int:
+        """
+        Дозаливка истории после миграции 2: строки messages_legacy переносятся в
+        партиции пачками по batch_size, опустевшая таблица удаляется.
+        Возвращает число обработанных строк.
+        """
+        batch_size = batch_size or settings.MESSAGES_LEGACY_COPY_BATCH
+        total = 0
+        async with self._acquire() as conn:
+            while True:
+                count = await message_partitions.copy_legacy_batch(
+                    conn, batch_size, settings.MESSAGES_RETENTION_DEFAULT_DAYS
+                )
+                if count is None:
+                    return total
+                if not count:
+                    await message_partitions.drop_legacy_table(conn)
+                    return total
+                total += count
+
+    async def drop_expired_message_partitions(self) -> int:
+        """Ретеншн: DROP партиций, все строки которых истекли. Возвращает число удалённых."""
+        async with self._acquire() as conn:
+            dropped, _ = await message_partitions.drop_expired_partitions(conn)
+        return len(dropped)
+
     # === Billing helpers ===
 
     async def get_instance_billing(self, instance_id: str) -> Optional[dict]:
@@ -0,0 +1,230 @@
+# src/shared/db_metrics.py
+import bisect
+import hashlib
+import logging
+import re
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы латентности, мс (последняя корзина — всё, что дольше)
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_WS_RE = re.compile(r"\s+")
+
+
+class NamedQuery(str):
+    """
+    SQL-строка с именем. Это обычный str — его можно передать в любой
+    execute/fetch*, — но метрики MasterDatabase пишутся под именем, а текст
+    запроса стабилен и переиспользует кэш prepared statements asyncpg.
+    """
+
+    name: str
+
+    def __new__(cls, name: str, sql: str) -> "NamedQuery":
+        obj = super().__new__(cls, sql)
+        obj.name = name
+        return obj
+
+
+_REGISTRY: Dict[str, NamedQuery] = {}
+
+
+def register_query(name: str, sql: str) -> NamedQuery:
+    """Регистрирует именованный запрос (имена уникальны в пределах процесса)."""
+    existing = _REGISTRY.get(name)
+    if existing is not None and str(existing) != sql:
+        raise ValueError(f"Query {name!r} is already registered with different SQL")
+    query = _REGISTRY[name] = NamedQuery(name, sql)
+    return query
+
+
+def registered_queries() -> Dict[str, NamedQuery]:
+    return dict(_REGISTRY)
+
+
+def normalize_sql(sql: str) -> str:
+    return _WS_RE.sub(" ", sql).strip()
+
+
+def query_name(sql: str) -> str:
+    """Имя запроса: из реестра или отпечаток текста для ad-hoc SQL."""
+    name = getattr(sql, "name", None)
+    if name:
+        return name
+    digest = hashlib.sha1(normalize_sql(sql).encode("utf-8")).hexdigest()[:12]
+    return f"sql:{digest}"
+
+
+def rows_affected(status: Any) -> int:
+    """'UPDATE 5' / 'INSERT 0 1' -> 5 / 1"""
+    if isinstance(status, str):
+        tail = status.rsplit(" ", 1)[-1]
+        if tail.isdigit():
+            return int(tail)
+    return 0
+
+
+class LatencyHistogram:
+    __slots__ = ("count", "total_ms", "max_ms", "buckets")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, ms: float) -> None:
+        self.count += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Верхняя граница корзины, в которую попадает квантиль q (оценка сверху)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return float(LATENCY_BUCKETS_MS[i]) if i < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "total_ms": round(self.total_ms, 2),
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else None,
+            "max_ms": round(self.max_ms, 2),
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+            "buckets": {
+                **{f"le_{b}": n for b, n in zip(LATENCY_BUCKETS_MS, self.buckets)},
+                "inf": self.buckets[-1],
+            },
+        }
+
+
+class _QueryStat:
+    __slots__ = ("name", "sql", "latency", "rows", "errors", "last_slow_log")
+
+    def __init__(self, name: str, sql: str) -> None:
+        self.name = name
+        self.sql = normalize_sql(sql)[:300]
+        self.latency = LatencyHistogram()
+        self.rows = 0
+        self.errors = 0
+        self.last_slow_log = 0.0
+
+
+class QueryStats:
+    """
+    Метрики запросов одного MasterDatabase (одного процесса): гистограмма латентности,
+    строки, ошибки по каждому запросу; ожидание соединения из пула; лог медленных
+    запросов с параметрами (не чаще одного раза в slow_log_interval на запрос).
+    """
+
+    OVERFLOW_NAME = "sql:other"
+
+    def __init__(
+        self,
+        slow_ms: float = 200.0,
+        max_queries: int = 500,
+        slow_log_interval: float = 10.0,
+    ) -> None:
+        self.slow_ms = slow_ms
+        self.max_queries = max_queries
+        self.slow_log_interval = slow_log_interval
+
+        self.queries: Dict[str, _QueryStat] = {}
+        self.pool_acquire = LatencyHistogram()
+        self.started_at = time.time()
+
+    def _stat(self, sql: str) -> _QueryStat:
+        name = query_name(sql)
+        stat = self.queries.get(name)
+        if stat is None:
+            if len(self.queries) >= self.max_queries and not isinstance(sql, NamedQuery):
+                # динамически собранный SQL не должен раздувать реестр без предела
+                name = self.OVERFLOW_NAME
+                stat = self.queries.get(name)
+            if stat is None:
+                stat = self.queries[name] = _QueryStat(name, sql)
+        return stat
+
+    def observe_acquire(self, seconds: float) -> None:
+        self.pool_acquire.observe(seconds * 1000)
+
+    def observe(
+        self,
+        sql: str,
+        seconds: float,
+        *,
+        rows: int = 0,
+        params: Optional[Sequence[Any]] = None,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        stat = self._stat(sql)
+        ms = seconds * 1000
+        stat.latency.observe(ms)
+        stat.rows += rows
+        if error is not None:
+            stat.errors += 1
+
+        if ms >= self.slow_ms:
+            now = time.monotonic()
+            if now - stat.last_slow_log >= self.slow_log_interval:
+                stat.last_slow_log = now
+                logger.warning(
+                    "🐢 Slow query %s: %.1fms rows=%s params=%.200r sql=%.200s",
+                    stat.name,
+                    ms,
+                    rows,
+                    tuple(params or ()),
+                    stat.sql,
+                )
+
+    def snapshot(self, top: int = 50, order_by: str = "total_ms") -> Dict[str, Any]:
+        stats = sorted(
+            self.queries.values(),
+            key=lambda s: s.latency.total_ms if order_by == "total_ms" else s.latency.count,
+            reverse=True,
+        )
+        total_ms = sum(s.latency.total_ms for s in self.queries.values()) or 1.0
+        return {
+            "since": self.started_at,
+            "slow_ms": self.slow_ms,
+            "pool_acquire": self.pool_acquire.to_dict(),
+            "queries": [
+                {
+                    "name": s.name,
+                    "sql": s.sql,
+                    "rows": s.rows,
+                    "errors": s.errors,
+                    "share": round(s.latency.total_ms / total_ms, 4),
+                    **s.latency.to_dict(),
+                }
+                for s in stats[:top]
+            ],
+        }
+
+    def log_top(self, top: int = 10) -> None:
+        snap = self.snapshot(top=top)
+        lines: List[str] = [
+            f"{q['name']}: {q['count']} calls, {q['total_ms']}ms total "
+            f"({q['share']:.0%}), p95≤{q['p95_ms']}ms, rows={q['rows']}"
+            for q in snap["queries"]
+        ]
+        acquire = snap["pool_acquire"]
+        logger.info(
+            "📊 DB top queries (pool acquire p95≤%sms, max %sms):\n  %s",
+            acquire["p95_ms"],
+            acquire["max_ms"],
+            "\n  ".join(lines) or "—",
+        )
@@ -0,0 +1,155 @@
+# src/shared/db_pool.py
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Mapping, Optional
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+# Доля бюджета на один процесс роли (вес). queue-реплики разбирают весь входящий поток,
+# API — миниапп и вебхуки оплат, master — мониторинг и крон
+ROLE_WEIGHTS: Dict[str, int] = {
+    "master": 2,
+    "api": 3,
+    "queue": 4,
+}
+DEFAULT_ROLE = "master"
+# Docker-воркеры тенантов появляются и исчезают на ходу, поэтому в деление по весам
+# не входят: каждый получает фиксированный слот, слоты резервируются заранее
+WORKER_ROLE = "worker"
+MAX_POOL_SIZE = 20  # больше одному процессу asyncio не нужно
+
+
+@dataclass(frozen=True)
+class PoolSize:
+    min_size: int
+    max_size: int
+
+
+def pool_size_for_role(
+    role: str,
+    budget: int,
+    replicas: Mapping[str, int],
+    *,
+    reserve: int = 3,
+    min_size: int = 1,
+    worker_pool_size: int = 2,
+) -> PoolSize:
+    """
+    Делит глобальный бюджет соединений (max_connections за вычетом reserve для
+    админских сессий) между ролями по весам и числу процессов каждой роли.
+    Каждый процесс дополнительно держит одно соединение под LISTEN — оно тоже
+    вычитается из бюджета.
+
+    replicas["worker"] — сколько слотов по worker_pool_size (+ LISTEN) отложить под
+    воркеров тенантов; сам воркер берёт ровно свой слот.
+    """
+    worker_pool_size = max(1, worker_pool_size)
+    if role == WORKER_ROLE:
+        return PoolSize(min_size=max(0, min(min_size, worker_pool_size)), max_size=worker_pool_size)
+
+    role = role if role in ROLE_WEIGHTS else DEFAULT_ROLE
+    counts = {r: max(0, int(replicas.get(r, 0))) for r in ROLE_WEIGHTS}
+    counts[role] = max(1, counts[role])
+    worker_slots = max(0, int(replicas.get(WORKER_ROLE, 0))) * (worker_pool_size + 1)
+
+    processes = sum(counts.values())
+    available = max(processes, budget - reserve - worker_slots - processes)
+    total_weight = sum(ROLE_WEIGHTS[r] * n for r, n in counts.items())
+
+    per_process = available * ROLE_WEIGHTS[role] // total_weight
+    max_size = max(1, min(MAX_POOL_SIZE, per_process))
+    return PoolSize(min_size=max(0, min(min_size, max_size)), max_size=max_size)
+
+
+ListenerCallback = Callable[[Any, int, str, str], None]
+
+
+class DbListener:
+    """
+    Одно выделенное соединение на процесс под LISTEN — не из пула: пул не теряет
+    соединение навсегда, а через PgBouncer в transaction-режиме LISTEN всё равно
+    не работает (поэтому dsn здесь — прямой до Postgres).
+
+    При обрыве соединение переподключается с backoff и заново подписывается на
+    все каналы; подписчики получают пустой payload — NOTIFY за время обрыва
+    потеряны, пусть перепроверят очередь.
+    """
+
+    RECONNECT_MAX_DELAY = 30.0
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self._conn: Optional[asyncpg.Connection] = None
+        self._callbacks: Dict[str, List[ListenerCallback]] = {}
+        self._lock = asyncio.Lock()
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    @property
+    def active(self) -> bool:
+        return self._conn is not None and not self._conn.is_closed()
+
+    async def _connect(self) -> asyncpg.Connection:
+        conn = await asyncpg.connect(self.dsn)
+        conn.add_termination_listener(self._on_terminated)
+        for channel, callbacks in self._callbacks.items():
+            for callback in callbacks:
+                await conn.add_listener(channel, callback)
+        return conn
+
+    async def listen(self, channel: str, callback: ListenerCallback) -> None:
+        async with self._lock:
+            if not self.active:
+                self._conn = await self._connect()
+            await self._conn.add_listener(channel, callback)
+            self._callbacks.setdefault(channel, []).append(callback)
+
+    async def unlisten(self, channel: str, callback: ListenerCallback) -> None:
+        async with self._lock:
+            callbacks = self._callbacks.get(channel, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self._callbacks.pop(channel, None)
+            if self.active:
+                await self._conn.remove_listener(channel, callback)
+
+    def _on_terminated(self, conn: asyncpg.Connection) -> None:
+        if self._closed or conn is not self._conn:
+            return
+        logger.warning("⚠️ LISTEN connection lost, reconnecting...")
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        delay = 1.0
+        while not self._closed:
+            try:
+                async with self._lock:
+                    self._conn = await self._connect()
+                logger.info("✅ LISTEN connection restored (%s channels)", len(self._callbacks))
+                break
+            except Exception as e:
+                logger.warning("⏳ LISTEN reconnect failed: %s (retry in %.0fs)", e, delay)
+                await asyncio.sleep(delay)
+                delay = min(self.RECONNECT_MAX_DELAY, delay * 2)
+
+        # уведомления за время обрыва потеряны — будим подписчиков
+        for channel, callbacks in list(self._callbacks.items()):
+            for callback in list(callbacks):
+                try:
+                    callback(self._conn, 0, channel, "")
+                except Exception:
+                    logger.exception("LISTEN callback failed after reconnect")
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        if self._conn is not None and not self._conn.is_closed():
+            await self._conn.close()
+        self._conn = None
+        self._callbacks.clear()
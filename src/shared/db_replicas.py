@@ -0,0 +1,142 @@
+# src/shared/db_replicas.py
+import asyncio
+import itertools
+import logging
+import time
+from typing import List, Optional, Sequence
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, после которых запрос можно повторить на primary: реплика недоступна,
+# перегружена или отменила запрос из-за конфликта с применением WAL
+REPLICA_FALLBACK_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.InterfaceError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.TooManyConnectionsError,
+    asyncpg.SerializationError,  # canceling statement due to conflict with recovery
+)
+
+# Отставание реплики, сек. Равенство receive/replay LSN означает «догнала» только пока
+# WAL-приёмник стримит: при оборванной репликации LSN тоже равны, а реплика отстаёт всё
+# больше, поэтому без streaming-приёмника лаг бесконечный. status в pg_stat_wal_receiver
+# виден роли с pg_read_all_stats (pg_monitor); без неё реплика не используется — безопасно
+_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0::float8
+        WHEN NOT EXISTS (
+            SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming'
+        ) THEN 'Infinity'::float8
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0::float8
+        ELSE COALESCE(
+            EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())::float8,
+            'Infinity'::float8
+        )
+    END
+"""
+
+
+class Replica:
+    __slots__ = ("dsn", "pool", "lag", "checked_at", "down_until")
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.pool: Optional[asyncpg.Pool] = None
+        self.lag = float("inf")
+        self.checked_at = 0.0
+        self.down_until = 0.0
+
+
+class ReplicaRouter:
+    """
+    Маршрутизация read-only запросов на реплики с ограничением устаревания.
+
+    Реплика годится, если её пул поднят, она не на «карантине» после ошибки и её
+    отставание (перепроверяется не чаще check_interval) не больше max_lag.
+    Годные реплики чередуются по кругу; если годных нет — pick() возвращает None,
+    и запрос идёт на primary.
+    """
+
+    def __init__(
+        self,
+        dsns: Sequence[str],
+        *,
+        max_lag: float = 5.0,
+        check_interval: float = 5.0,
+        down_seconds: float = 30.0,
+    ):
+        self.replicas: List[Replica] = [Replica(dsn) for dsn in dsns if dsn]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.down_seconds = down_seconds
+        self._rr = itertools.count()
+
+    def __bool__(self) -> bool:
+        return bool(self.replicas)
+
+    async def init(self, *, max_size: int, **pool_options) -> None:
+        for replica in self.replicas:
+            try:
+                replica.pool = await asyncpg.create_pool(
+                    replica.dsn,
+                    min_size=0,
+                    max_size=max_size,
+                    timeout=5,
+                    max_inactive_connection_lifetime=300,
+                    **pool_options,
+                )
+                logger.info("✅ Read replica pool ready (max=%s)", max_size)
+            except Exception as e:
+                # без реплики читаем с primary — старт не валим
+                logger.warning("⚠️ Read replica unavailable at startup: %s", e)
+                replica.down_until = time.monotonic() + self.down_seconds
+
+    async def _refresh_lag(self, replica: Replica, now: float) -> None:
+        was_streaming = replica.lag != float("inf") or replica.checked_at == 0.0
+        replica.checked_at = now
+        try:
+            async with replica.pool.acquire(timeout=1.0) as conn:
+                replica.lag = float(await conn.fetchval(_LAG_SQL, timeout=1.0))
+        except Exception as e:
+            self.mark_down(replica, e)
+            return
+        if was_streaming and replica.lag == float("inf"):
+            logger.warning("⚠️ Read replica is not streaming WAL, reading from primary")
+
+    async def pick(self, max_lag: Optional[float] = None) -> Optional[Replica]:
+        if not self.replicas:
+            return None
+        max_lag = self.max_lag if max_lag is None else max_lag
+        now = time.monotonic()
+
+        start = next(self._rr)
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            if replica.pool is None or now < replica.down_until:
+                continue
+            if now - replica.checked_at >= self.check_interval:
+                await self._refresh_lag(replica, now)
+                if now < replica.down_until:
+                    continue
+            if replica.lag <= max_lag:
+                return replica
+        return None
+
+    def mark_down(self, replica: Replica, error: BaseException) -> None:
+        replica.down_until = time.monotonic() + self.down_seconds
+        replica.lag = float("inf")
+        logger.warning(
+            "⚠️ Read replica disabled for %ss, reading from primary: %r",
+            self.down_seconds,
+            error,
+        )
+
+    async def close(self) -> None:
+        for replica in self.replicas:
+            if replica.pool is not None:
+                await replica.pool.close()
+                replica.pool = None
@@ -0,0 +1,186 @@
+# src/shared/fsm_storage.py
+import json
+import logging
+import weakref
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+logger = logging.getLogger(__name__)
+
+# (state, data) одного пользователя
+_Entry = Tuple[Optional[str], Dict[str, Any]]
+
+
+class PostgresFSMStorage(BaseStorage):
+    """
+    FSM-хранилище aiogram поверх таблицы worker_user_states.
+
+    - состояние общее для всех реплик queue-worker (без sticky-роутинга);
+    - прочитанное кэшируется только до конца апдейта (flush() сбрасывает кэш):
+      FSM-middleware и хэндлер читают БД один раз, а следующий апдейт этого
+      пользователя — уже на другой реплике — видит свежее состояние;
+    - записи копятся в памяти и сбрасываются одним UPSERT/DELETE на ключ
+      в flush() — воркер вызывает его после обработки каждого апдейта.
+
+    Ключ в таблице — (instance_id, user_id): админские сценарии воркера
+    живут в личке, поэтому chat_id/thread_id в ключ не входят.
+    """
+
+    def __init__(self, db, instance_id: str):  # db: MasterDatabase
+        self.db = db
+        self.instance_id = instance_id
+
+        self._cache: Dict[int, _Entry] = {}
+        self._dirty: Dict[int, _Entry] = {}
+
+    async def _load(self, user_id: int) -> _Entry:
+        if user_id in self._dirty:
+            return self._dirty[user_id]
+
+        cached = self._cache.get(user_id)
+        if cached is not None:
+            return cached
+
+        row = await self.db.fetchone(
+            """
+            SELECT state, data
+            FROM worker_user_states
+            WHERE instance_id = $1 AND user_id = $2
+            """,
+            (self.instance_id, user_id),
+        )
+
+        entry: _Entry = (None, {})
+        if row:
+            try:
+                data = json.loads(row["data"]) if row["data"] else {}
+            except (TypeError, ValueError):
+                logger.warning(
+                    "FSM: broken data for instance=%s user=%s, resetting",
+                    self.instance_id,
+                    user_id,
+                )
+                data = {}
+            entry = (row["state"] or None, data)
+
+        self._cache[user_id] = entry
+        return entry
+
+    def _put(self, user_id: int, entry: _Entry) -> None:
+        self._dirty[user_id] = entry
+        self._cache[user_id] = entry
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state_str = state.state if isinstance(state, State) else state
+        _, data = await self._load(key.user_id)
+        self._put(key.user_id, (state_str, data))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(key.user_id)
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        state, _ = await self._load(key.user_id)
+        self._put(key.user_id, (state, dict(data)))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(key.user_id)
+        return dict(data)
+
+    async def flush(self) -> None:
+        """
+        Сбрасывает накопленные изменения в БД: пустые записи удаляются,
+        остальные upsert'ятся одним executemany. Кэш чтений апдейта сбрасывается.
+        """
+        self._cache.clear()
+        if not self._dirty:
+            return
+
+        dirty, self._dirty = self._dirty, {}
+
+        to_delete = []
+        to_upsert = []
+        for user_id, (state, data) in dirty.items():
+            if state is None and not data:
+                to_delete.append(user_id)
+            else:
+                payload = json.dumps(data, ensure_ascii=False) if data else None
+                to_upsert.append((self.instance_id, user_id, state or "", payload))
+
+        try:
+            if to_delete:
+                await self.db.execute(
+                    """
+                    DELETE FROM worker_user_states
+                    WHERE instance_id = $1 AND user_id = ANY($2::bigint[])
+                    """,
+                    (self.instance_id, to_delete),
+                )
+            if to_upsert:
+                await self.db.executemany(
+                    """
+                    INSERT INTO worker_user_states (instance_id, user_id, state, data)
+                    VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (instance_id, user_id)
+                    DO UPDATE SET state = EXCLUDED.state, data = EXCLUDED.data
+                    """,
+                    to_upsert,
+                )
+        except Exception:
+            # не теряем изменения: вернём их в очередь, если их не перезаписали новее
+            for user_id, entry in dirty.items():
+                self._dirty.setdefault(user_id, entry)
+            logger.exception("FSM: failed to flush states for instance %s", self.instance_id)
+            raise
+
+    async def close(self) -> None:
+        await self.flush()
+
+
+class TenantFSMStorage(BaseStorage):
+    """
+    FSM-хранилище общего Dispatcher'а: маршрутизирует ключ в хранилище
+    тенанта по StorageKey.bot_id. Для незарегистрированного бота состояние
+    пустое, а запись игнорируется (такой апдейт всё равно отбрасывается).
+    """
+
+    def __init__(self) -> None:
+        self._storages: "weakref.WeakValueDictionary[int, BaseStorage]" = (
+            weakref.WeakValueDictionary()
+        )
+
+    def register(self, bot_id: int, storage: BaseStorage) -> None:
+        self._storages[bot_id] = storage
+
+    def unregister(self, bot_id: int) -> None:
+        self._storages.pop(bot_id, None)
+
+    def _get(self, key: StorageKey) -> Optional[BaseStorage]:
+        storage = self._storages.get(key.bot_id)
+        if storage is None:
+            logger.warning("FSM: no storage registered for bot_id=%s", key.bot_id)
+        return storage
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage = self._get(key)
+        if storage is not None:
+            await storage.set_state(key, state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        storage = self._get(key)
+        return await storage.get_state(key) if storage is not None else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage = self._get(key)
+        if storage is not None:
+            await storage.set_data(key, data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        storage = self._get(key)
+        return await storage.get_data(key) if storage is not None else {}
+
+    async def close(self) -> None:
+        for storage in list(self._storages.values()):
+            await storage.close()
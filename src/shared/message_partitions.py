@@ -0,0 +1,195 @@
+# src/shared/message_partitions.py
+"""
+Партиции таблицы messages.
+
+messages партиционирована по RANGE(expires_at) помесячно: expires_at = created_at +
+срок хранения тарифа инстанса (saas_plans.messages_retention_days) на момент записи.
+Поэтому ретеншн по тарифам — это DROP целых партиций, у которых верхняя граница уже
+в прошлом, без DELETE по строкам и без раздувания таблицы.
+
+Партиции создаются заранее — на max(срок хранения) + запас вперёд; DEFAULT-партиции
+нет намеренно: строка не должна тихо осесть там, откуда её не удалить DROP-ом.
+
+messages_legacy — старая непартиционированная таблица после миграции 2: её строки
+переносятся пачками в фоне, пустая таблица удаляется.
+"""
+import logging
+import re
+from datetime import date, datetime, timezone
+from typing import List, Optional, Tuple
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+PARENT_TABLE = "messages"
+LEGACY_TABLE = "messages_legacy"
+_PARTITION_RE = re.compile(r"^messages_p(\d{4})(\d{2})$")
+
+
+def month_start(value: datetime) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(value: date, months: int) -> date:
+    index = value.year * 12 + value.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"{PARENT_TABLE}_p{month.year:04d}{month.month:02d}"
+
+
+def partition_month(name: str) -> Optional[date]:
+    """messages_p202610 -> 2026-10-01 (None для чужих таблиц)"""
+    m = _PARTITION_RE.match(name)
+    if not m:
+        return None
+    return date(int(m.group(1)), int(m.group(2)), 1)
+
+
+def partition_months(start: datetime, end: datetime) -> List[date]:
+    """Месяцы, партиции которых покрывают expires_at из [start, end]."""
+    months = []
+    month = month_start(start)
+    last = month_start(end)
+    while month <= last:
+        months.append(month)
+        month = add_months(month, 1)
+    return months
+
+
+def expired_partitions(names: List[str], now: datetime) -> List[str]:
+    """Партиции, все строки которых уже истекли (верхняя граница <= now)."""
+    current = month_start(now)
+    expired = []
+    for name in names:
+        month = partition_month(name)
+        if month is not None and add_months(month, 1) <= current:
+            expired.append(name)
+    return sorted(expired)
+
+
+async def list_partitions(conn: asyncpg.Connection) -> List[str]:
+    rows = await conn.fetch(
+        """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = $1::regclass
+        """,
+        PARENT_TABLE,
+    )
+    return [row["relname"] for row in rows]
+
+
+async def ensure_partitions(
+    conn: asyncpg.Connection, start: datetime, end: datetime
+) -> List[str]:
+    """Создаёт недостающие помесячные партиции на [start, end]. Возвращает созданные."""
+    existing = set(await list_partitions(conn))
+    created = []
+    for month in partition_months(start, end):
+        name = partition_name(month)
+        if name in existing:
+            continue
+        await conn.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {name}
+            PARTITION OF {PARENT_TABLE}
+            FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')
+            """
+        )
+        created.append(name)
+    if created:
+        logger.info("🗂 Created messages partitions: %s", ", ".join(created))
+    return created
+
+
+async def drop_expired_partitions(
+    conn: asyncpg.Connection,
+    now: Optional[datetime] = None,
+    *,
+    lock_timeout: str = "5s",
+) -> Tuple[List[str], List[str]]:
+    """
+    DROP партиций с истёкшими строками. DROP берёт короткий эксклюзивный лок на
+    родителя, поэтому ждём его не дольше lock_timeout — не дождались, значит
+    следующий цикл. Возвращает (удалённые, отложенные).
+    """
+    now = now or datetime.now(timezone.utc)
+    dropped: List[str] = []
+    deferred: List[str] = []
+    for name in expired_partitions(await list_partitions(conn), now):
+        try:
+            async with conn.transaction():
+                await conn.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+                await conn.execute(f"DROP TABLE IF EXISTS {name}")
+            dropped.append(name)
+        except asyncpg.LockNotAvailableError:
+            deferred.append(name)
+    if dropped:
+        logger.info("🧹 Dropped expired messages partitions: %s", ", ".join(dropped))
+    if deferred:
+        logger.warning("⏳ Messages partitions busy, drop deferred: %s", ", ".join(deferred))
+    return dropped, deferred
+
+
+async def copy_legacy_batch(
+    conn: asyncpg.Connection, batch_size: int, default_days: int
+) -> Optional[int]:
+    """
+    Переносит пачку строк messages_legacy в messages (expires_at = created_at + срок
+    тарифа; истёкшие просто удаляются) одной короткой транзакцией — локи только на
+    строках пачки. Возвращает число обработанных строк, None — таблицы уже нет.
+    """
+    if await conn.fetchval("SELECT to_regclass($1)", LEGACY_TABLE) is None:
+        return None
+    async with conn.transaction():
+        return await conn.fetchval(
+            f"""
+            WITH batch AS (
+                DELETE FROM {LEGACY_TABLE}
+                WHERE (instance_id, id) IN (
+                    SELECT instance_id, id
+                    FROM {LEGACY_TABLE}
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING instance_id, id, chat_id, message_id, user_id, direction,
+                          content, created_at
+            ),
+            live AS (
+                SELECT
+                    b.*,
+                    b.created_at + make_interval(
+                        days => COALESCE(sp.messages_retention_days, $2)
+                    ) AS expires_at
+                FROM batch AS b
+                LEFT JOIN instance_billing AS ib ON ib.instance_id = b.instance_id
+                LEFT JOIN saas_plans AS sp ON sp.plan_id = ib.plan_id
+            ),
+            copied AS (
+                INSERT INTO {PARENT_TABLE} (
+                    instance_id, id, chat_id, message_id, user_id, direction, content,
+                    created_at, expires_at
+                )
+                SELECT * FROM live WHERE expires_at > NOW()
+            )
+            SELECT COUNT(*) FROM batch
+            """,
+            batch_size,
+            default_days,
+        )
+
+
+async def drop_legacy_table(conn: asyncpg.Connection, *, lock_timeout: str = "5s") -> bool:
+    """DROP опустевшей messages_legacy; лок ждём не дольше lock_timeout."""
+    try:
+        async with conn.transaction():
+            await conn.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+            await conn.execute(f"DROP TABLE IF EXISTS {LEGACY_TABLE}")
+    except asyncpg.LockNotAvailableError:
+        return False
+    logger.info("🧹 Legacy messages table copied and dropped")
+    return True
@@ -0,0 +1,275 @@
+# src/shared/migrations.py
+"""
+Версионированные миграции схемы master-БД.
+
+Применённые версии лежат в schema_migrations. Миграции выполняет один процесс —
+тот, кто первым возьмёт advisory lock (или отдельный шаг деплоя:
+`python -m shared.migrations`); остальные ждут на локе и затем видят актуальную
+версию. Обычный старт процесса — один SELECT версии, без DDL.
+
+Новая DDL — новая Migration в конце MIGRATIONS, а не правка create_tables():
+baseline к существующей базе применяется ровно один раз.
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Awaitable, Callable, List
+
+import asyncpg
+
+from . import settings
+
+if TYPE_CHECKING:
+    from .database import MasterDatabase
+
+logger = logging.getLogger(__name__)
+
+# ключ pg_advisory_lock: мигрирует один процесс на всю БД
+MIGRATION_LOCK_KEY = 0x4748_4D49_4752  # "GHMIGR"
+
+MigrationFn = Callable[["MasterDatabase", asyncpg.Connection], Awaitable[None]]
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    apply: MigrationFn
+    # False — миграция сама управляет транзакциями/соединениями
+    # (CREATE INDEX CONCURRENTLY, большие бэкфиллы, baseline)
+    transactional: bool = True
+
+
+async def _baseline(db: "MasterDatabase", conn: asyncpg.Connection) -> None:
+    # раньше эта идемпотентная DDL выполнялась на каждом старте каждого процесса;
+    # для существующих баз это дотягивание до текущей схемы, для новых — создание
+    await db.create_tables()
+
+
+async def _partition_messages(db: "MasterDatabase", conn: asyncpg.Connection) -> None:
+    """
+    messages -> RANGE(expires_at) помесячно + индексы под реальные выборки.
+
+    Здесь только быстрая подмена таблиц (DDL, без чтения строк): старая уходит в
+    messages_legacy, её строки QueueCleanupService переносит пачками уже после
+    (MasterDatabase.copy_legacy_messages) — до того в истории видны только новые.
+    expires_at со значением по умолчанию: процессы старой версии при rolling-деплое
+    пишут в messages без него и получают срок хранения по умолчанию.
+    """
+    await conn.execute(
+        "ALTER TABLE saas_plans ADD COLUMN IF NOT EXISTS messages_retention_days INTEGER"
+    )
+    for code, days in settings.MESSAGES_RETENTION_DAYS.items():
+        await conn.execute(
+            """
+            UPDATE saas_plans SET messages_retention_days = $2
+            WHERE code = $1 AND messages_retention_days IS NULL
+            """,
+            code,
+            days,
+        )
+
+    await conn.execute("ALTER TABLE messages RENAME TO messages_legacy")
+    await conn.execute("ALTER INDEX messages_pkey RENAME TO messages_legacy_pkey")
+
+    # identity-последовательность принадлежит старой таблице и уйдёт вместе с ней;
+    # продолжаем с её позиции — без MAX(id) по всей таблице под эксклюзивным локом
+    await conn.execute("CREATE SEQUENCE messages_row_id_seq AS BIGINT")
+    await conn.execute(
+        """
+        SELECT setval(
+            'messages_row_id_seq',
+            nextval(pg_get_serial_sequence('messages_legacy', 'id')),
+            false
+        )
+        """
+    )
+    await conn.execute(
+        """
+        CREATE TABLE messages (
+            instance_id TEXT NOT NULL,
+            id          BIGINT NOT NULL DEFAULT nextval('messages_row_id_seq'),
+
+            chat_id     BIGINT NOT NULL,
+            message_id  BIGINT NOT NULL,
+
+            user_id     BIGINT,     -- может быть NULL для системных/ботовых событий
+            direction   TEXT NOT NULL,
+            content     TEXT,
+            created_at  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            -- created_at + срок хранения тарифа на момент записи; ключ партиционирования
+            expires_at  TIMESTAMPTZ NOT NULL DEFAULT (NOW() + make_interval(days => {days})),
+
+            PRIMARY KEY (instance_id, id, expires_at),
+
+            CONSTRAINT fk_messages_instance
+                FOREIGN KEY (instance_id)
+                REFERENCES bot_instances(instance_id)
+                ON DELETE CASCADE
+        ) PARTITION BY RANGE (expires_at)
+        """.format(days=int(settings.MESSAGES_RETENTION_DEFAULT_DAYS))
+    )
+    await conn.execute("ALTER SEQUENCE messages_row_id_seq OWNED BY messages.id")
+
+    # лента тикета/пользователя, лента чата и последние сообщения инстанса
+    await conn.execute(
+        """
+        CREATE INDEX idx_messages_user_timeline
+        ON messages (instance_id, user_id, created_at DESC)
+        WHERE user_id IS NOT NULL
+        """
+    )
+    await conn.execute(
+        """
+        CREATE INDEX idx_messages_chat_timeline
+        ON messages (instance_id, chat_id, created_at DESC)
+        """
+    )
+    await conn.execute(
+        "CREATE INDEX idx_messages_instance_recent ON messages (instance_id, created_at DESC)"
+    )
+
+    await db.ensure_message_partitions(conn)
+
+
+async def _tickets_autoclose_index(db: "MasterDatabase", conn: asyncpg.Connection) -> None:
+    # только открытые отвеченные тикеты — индекс маленький, как бы ни росла таблица;
+    # CONCURRENTLY — не блокируем запись в tickets на больших базах
+    await conn.execute(
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_tickets_autoclose
+        ON tickets (last_user_msg_at)
+        WHERE status IN ('inprogress', 'answered') AND last_admin_reply_at IS NOT NULL
+        """
+    )
+
+
+async def _tickets_topic_title(db: "MasterDatabase", conn: asyncpg.Connection) -> None:
+    # последнее применённое название темы — общее для всех реплик воркеров
+    await conn.execute("ALTER TABLE tickets ADD COLUMN IF NOT EXISTS topic_title TEXT")
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "baseline", _baseline, transactional=False),
+    Migration(2, "partition_messages", _partition_messages),
+    Migration(3, "tickets_autoclose_index", _tickets_autoclose_index, transactional=False),
+    Migration(4, "tickets_topic_title", _tickets_topic_title),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+async def get_schema_version(conn: asyncpg.Connection) -> int:
+    try:
+        version = await conn.fetchval("SELECT MAX(version) FROM schema_migrations")
+    except asyncpg.UndefinedTableError:
+        return 0
+    return int(version or 0)
+
+
+async def _record(conn: asyncpg.Connection, migration: Migration, duration_ms: int) -> None:
+    await conn.execute(
+        """
+        INSERT INTO schema_migrations (version, name, duration_ms)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (version) DO NOTHING
+        """,
+        migration.version,
+        migration.name,
+        duration_ms,
+    )
+
+
+async def migrate(db: "MasterDatabase") -> int:
+    """
+    Применяет недостающие миграции под advisory lock. Возвращает число применённых.
+    Лок сессионный, поэтому соединение прямое, мимо пула (и PgBouncer).
+    """
+    async with db.direct_connection() as conn:
+        await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_KEY)
+        try:
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version     INTEGER PRIMARY KEY,
+                    name        TEXT NOT NULL,
+                    duration_ms INTEGER NOT NULL DEFAULT 0,
+                    applied_at  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                )
+                """
+            )
+            # пока ждали лок, миграции мог применить другой процесс
+            current = await get_schema_version(conn)
+            applied = 0
+            for migration in MIGRATIONS:
+                if migration.version <= current:
+                    continue
+
+                logger.info("🛠 Applying migration %s_%s", migration.version, migration.name)
+                t_start = time.perf_counter()
+                if migration.transactional:
+                    async with conn.transaction():
+                        await migration.apply(db, conn)
+                        duration_ms = int((time.perf_counter() - t_start) * 1000)
+                        await _record(conn, migration, duration_ms)
+                else:
+                    await migration.apply(db, conn)
+                    duration_ms = int((time.perf_counter() - t_start) * 1000)
+                    await _record(conn, migration, duration_ms)
+
+                logger.info(
+                    "✅ Migration %s_%s applied in %sms",
+                    migration.version,
+                    migration.name,
+                    duration_ms,
+                )
+                applied += 1
+            return applied
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_KEY)
+
+
+async def ensure_schema(db: "MasterDatabase", *, auto_migrate: bool = True) -> int:
+    """
+    Сверяет версию схемы с кодом. Если база отстаёт — мигрирует (auto_migrate)
+    или падает с подсказкой. Возвращает версию схемы после проверки.
+    """
+    assert db.pool is not None
+    async with db.pool.acquire() as conn:
+        current = await get_schema_version(conn)
+
+    if current == SCHEMA_VERSION:
+        logger.info("✅ DB schema is up to date (version %s)", current)
+        return current
+
+    if current > SCHEMA_VERSION:
+        # rolling deploy: новая версия кода уже мигрировала базу, старая ещё работает
+        logger.warning("⚠️ DB schema version %s is newer than code (%s)", current, SCHEMA_VERSION)
+        return current
+
+    if not auto_migrate:
+        raise RuntimeError(
+            f"DB schema version {current} < {SCHEMA_VERSION}: "
+            "запустите `python -m shared.migrations` (или DB_AUTO_MIGRATE=1)"
+        )
+
+    applied = await migrate(db)
+    logger.info("✅ DB schema migrated to version %s (%s applied)", SCHEMA_VERSION, applied)
+    return SCHEMA_VERSION
+
+
+async def _main() -> None:
+    from .database import MasterDatabase
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(name)s %(levelname)s - %(message)s",
+    )
+    db = MasterDatabase()
+    await db.init(migrate=True)
+    await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
 from enum import Enum
 from typing import Any, Dict, Optional
@@ -155,7 +155,8 @@ class UpdateQueueItem:
     instance_id: str
     updated_ata: Dict[str, Any]
     priority: int = 0
-    created_at: datetime = datetime.now()
+    created_at: datetime = field(default_factory=datetime.now)
+    job_id: Optional[int] = None  # id строки tg_update_queue (для ack/fail)
 
     # alias for updated_ata to keep current callers intact if needed
     @property
@@ -1,87 +1,401 @@
 import asyncio
 import logging
 import time
+from array import array
 from collections import defaultdict, deque
+from contextvars import ContextVar
 from datetime import datetime, timedelta
-from typing import Awaitable, Callable, Dict, Optional
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
 
 from aiogram import types
-
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from cachetools import TTLCache
+
+from . import settings
 from .models import UpdateQueueItem
 
+if TYPE_CHECKING:
+    from aiogram import Bot
+
 logger = logging.getLogger(__name__)
 
 
 class TokenBucket:
     """Token bucket for rate limiting"""
 
+    __slots__ = ("capacity", "tokens", "refill_rate", "last_refill")
+
     def __init__(self, capacity: int, refill_rate: float):
         self.capacity = capacity
-        self.tokens = capacity
+        self.tokens = float(capacity)
         self.refill_rate = refill_rate  # tokens per second
-        self.last_refill = time.time()
-        self.lock = asyncio.Lock()
+        self.last_refill = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        # ленивое пополнение; без await внутри, поэтому в asyncio лок не нужен
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_rate)
+        self.last_refill = now
 
     async def consume(self, tokens: int = 1) -> bool:
         """Try to consume tokens from bucket"""
-        async with self.lock:
-            now = time.time()
+        return self.try_consume(tokens)
 
-            # Refill tokens
-            time_passed = now - self.last_refill
-            self.tokens = min(self.capacity, self.tokens + (time_passed * self.refill_rate))
-            self.last_refill = now
-
-            # Check if we have enough tokens
-            if self.tokens >= tokens:
-                self.tokens -= tokens
-                return True
-
-            return False
+    def try_consume(self, tokens: int = 1, now: Optional[float] = None) -> bool:
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
 
     async def wait_for_tokens(self, tokens: int = 1) -> float:
         """Calculate wait time for tokens"""
-        async with self.lock:
-            if self.tokens >= tokens:
-                return 0.0
+        return self.wait_time(tokens)
+
+    def wait_time(self, tokens: int = 1, now: Optional[float] = None) -> float:
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.refill_rate
+
+
+class ChatBucketTable:
+    """
+    Token bucket'ы всех чатов бота в плоских массивах: слот = (токены, время
+    последнего пополнения), chat_id -> номер слота. Пополнение ленивое, по
+    time.monotonic(), без локов (операции синхронные).
+
+    Бакет, простоявший capacity / refill_rate секунд, снова полон — он ничем не
+    отличается от отсутствующего, поэтому такие слоты освобождаются и
+    переиспользуются. Простой отслеживает грубое колесо таймеров: чат лежит в
+    одной ячейке колеса, при проворачивании ячейки ещё активные чаты
+    перекладываются дальше. Память пропорциональна числу чатов, активных за
+    последние capacity / refill_rate секунд, а не всем чатам за время жизни.
+    """
+
+    __slots__ = (
+        "capacity",
+        "refill_rate",
+        "idle_ttl",
+        "_slot_of",
+        "_tokens",
+        "_stamps",
+        "_free",
+        "_wheel",
+        "_tick",
+        "_wheel_pos",
+        "_wheel_time",
+    )
+
+    def __init__(self, capacity: float, refill_rate: float, wheel_size: int = 64):
+        self.capacity = float(capacity)
+        self.refill_rate = refill_rate
+        self.idle_ttl = self.capacity / refill_rate
+
+        self._slot_of: Dict[int, int] = {}
+        self._tokens = array("d")
+        self._stamps = array("d")
+        self._free: List[int] = []
+
+        self._wheel: List[List[int]] = [[] for _ in range(wheel_size)]
+        self._tick = max(1.0, self.idle_ttl / (wheel_size - 1))
+        self._wheel_pos = 0
+        self._wheel_time = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._slot_of)
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self._slot_of
+
+    def _schedule(self, chat_id: int, delay: float) -> None:
+        offset = min(len(self._wheel) - 1, max(1, int(delay // self._tick) + 1))
+        self._wheel[(self._wheel_pos + offset) % len(self._wheel)].append(chat_id)
+
+    def _advance(self, now: float) -> None:
+        """Проворачивает колесо до now, освобождая слоты простаивающих чатов."""
+        size = len(self._wheel)
+        steps = 0
+        while now - self._wheel_time >= self._tick:
+            self._wheel_time += self._tick
+            self._wheel_pos = (self._wheel_pos + 1) % size
+            steps += 1
+            due, self._wheel[self._wheel_pos] = self._wheel[self._wheel_pos], []
+            for chat_id in due:
+                slot = self._slot_of.get(chat_id)
+                if slot is None:
+                    continue
+                idle = now - self._stamps[slot]
+                if idle >= self.idle_ttl:
+                    del self._slot_of[chat_id]
+                    self._free.append(slot)
+                else:
+                    self._schedule(chat_id, self.idle_ttl - idle)
+            if steps >= size:
+                # долгий простой: все ячейки уже просмотрены один раз
+                self._wheel_time = now
+                break
+
+    def _slot(self, chat_id: int, now: float) -> int:
+        self._advance(now)
+        slot = self._slot_of.get(chat_id)
+        if slot is not None:
+            tokens = self._tokens[slot] + (now - self._stamps[slot]) * self.refill_rate
+            self._tokens[slot] = min(self.capacity, tokens)
+            self._stamps[slot] = now
+            return slot
+
+        if self._free:
+            slot = self._free.pop()
+            self._tokens[slot] = self.capacity
+            self._stamps[slot] = now
+        else:
+            slot = len(self._tokens)
+            self._tokens.append(self.capacity)
+            self._stamps.append(now)
+        self._slot_of[chat_id] = slot
+        self._schedule(chat_id, self.idle_ttl)
+        return slot
+
+    def tokens(self, chat_id: int, now: Optional[float] = None) -> float:
+        now = time.monotonic() if now is None else now
+        slot = self._slot_of.get(chat_id)
+        if slot is None:
+            return self.capacity
+        tokens = self._tokens[slot] + (now - self._stamps[slot]) * self.refill_rate
+        return min(self.capacity, tokens)
+
+    def try_consume(self, chat_id: int, tokens: int = 1, now: Optional[float] = None) -> bool:
+        slot = self._slot(chat_id, time.monotonic() if now is None else now)
+        if self._tokens[slot] >= tokens:
+            self._tokens[slot] -= tokens
+            return True
+        return False
+
+    def wait_time(self, chat_id: int, tokens: int = 1, now: Optional[float] = None) -> float:
+        available = self.tokens(chat_id, now)
+        if available >= tokens:
+            return 0.0
+        return (tokens - available) / self.refill_rate
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "chats": len(self._slot_of),
+            "slots": len(self._tokens),
+            "free_slots": len(self._free),
+        }
+
 
-            needed = tokens - self.tokens
-            wait_time = needed / self.refill_rate
-            return wait_time
+class SharedTokenBuckets:
+    """
+    Бакеты бота, общие для всех процессов (tg_rate_buckets в Postgres): глобальный и
+    бакеты "общих" чатов.
+
+    Процесс берёт токены пачками и тратит локально; неизрасходованный остаток сгорает
+    через lease_ttl, чтобы простаивающий процесс не держал чужую квоту. Один и тот же
+    чат обслуживают лейны OutboundScheduler в каждой реплике queue-worker, поэтому
+    горячие чаты (OpenChat-группа тенанта) регистрируются в shared_chats и получают
+    бакет в БД — токены чата и глобальные берутся одним вызовом tg_rate_acquire.
+    Остальные чаты (личка клиента) лимитируются локально (ChatBucketTable).
+    Штраф после 429 (penalize) видят все реплики.
+    """
+
+    def __init__(
+        self,
+        db,  # db: MasterDatabase
+        bot_key: str,
+        global_capacity: float,
+        global_rate: float,
+        global_batch: int = 5,
+        lease_ttl: float = 1.0,
+        chat_capacity: float = 20,
+        chat_rate: float = 20 / 60.0,
+        chat_batch: int = 1,
+    ):
+        self.db = db
+        self.bot_key = bot_key
+        self.global_capacity = global_capacity
+        self.global_rate = global_rate
+        self.global_batch = max(1, global_batch)
+        self.lease_ttl = lease_ttl
+        self.chat_capacity = chat_capacity
+        self.chat_rate = chat_rate
+        self.chat_batch = max(1, chat_batch)
+
+        self.shared_chats: Set[int] = set()
+
+        # локальный остаток пачки: токены и monotonic-срок годности
+        self._global_lease = 0
+        self._global_lease_until = 0.0
+        # chat_id -> [токены, monotonic-срок годности]
+        self._chat_leases: Dict[int, List[float]] = {}
+        self._lock = asyncio.Lock()
+
+    def chat_key(self, chat_id: int) -> str:
+        return f"{self.bot_key}:chat:{chat_id}"
+
+    def _lease_available(self, now: float) -> bool:
+        return self._global_lease > 0 and now < self._global_lease_until
+
+    def _chat_lease_available(self, chat_id: int, now: float) -> bool:
+        lease = self._chat_leases.get(chat_id)
+        return lease is not None and lease[0] > 0 and now < lease[1]
+
+    def _take(self, chat_id: Optional[int], now: float) -> bool:
+        if not self._lease_available(now):
+            return False
+        if chat_id is not None and not self._chat_lease_available(chat_id, now):
+            return False
+        self._global_lease -= 1
+        if chat_id is not None:
+            self._chat_leases[chat_id][0] -= 1
+        return True
+
+    async def try_acquire(self, chat_id: Optional[int] = None) -> bool:
+        # токены чата берём только для общих чатов, остальные — локальная забота
+        if chat_id not in self.shared_chats:
+            chat_id = None
+
+        # быстрый путь без лока и без БД — токены из уже взятых пачек
+        if self._take(chat_id, time.monotonic()):
+            return True
+
+        async with self._lock:
+            now = time.monotonic()
+            keys, capacities, rates, wants = [], [], [], []
+            if not self._lease_available(now):
+                keys.append(self.bot_key)
+                capacities.append(self.global_capacity)
+                rates.append(self.global_rate)
+                wants.append(self.global_batch)
+            need_chat = chat_id is not None and not self._chat_lease_available(chat_id, now)
+            if need_chat:
+                keys.append(self.chat_key(chat_id))
+                capacities.append(self.chat_capacity)
+                rates.append(self.chat_rate)
+                wants.append(self.chat_batch)
+
+            if keys:
+                granted = await self.db.acquire_rate_tokens(keys, capacities, rates, wants)
+                if keys[0] == self.bot_key:
+                    self._global_lease = granted[0]
+                    self._global_lease_until = now + self.lease_ttl
+                if need_chat:
+                    self._chat_leases[chat_id] = [granted[-1], now + self.lease_ttl]
+            return self._take(chat_id, now)
+
+    def estimated_wait(self, chat_id: Optional[int] = None) -> float:
+        now = time.monotonic()
+        wait = 0.0 if self._lease_available(now) else 1.0 / self.global_rate
+        if chat_id in self.shared_chats and not self._chat_lease_available(chat_id, now):
+            wait = max(wait, 1.0 / self.chat_rate)
+        return wait
+
+    async def penalize(self, seconds: float) -> None:
+        async with self._lock:
+            self._global_lease = 0
+        await self.db.penalize_rate_bucket(self.bot_key, seconds, self.global_rate)
 
 
 class BotRateLimiter:
     """Rate limiter for individual bot instances"""
 
-    def __init__(self, bot_token: str):
+    # Лимиты Telegram: GLOBAL_RATE_LIMIT запросов в секунду на бота (бакет — на секунду
+    # всплеска) и CHAT_RATE_LIMIT сообщений в минуту на чат
+    GLOBAL_CAPACITY = settings.GLOBAL_RATE_LIMIT
+    GLOBAL_RATE = float(settings.GLOBAL_RATE_LIMIT)
+    CHAT_CAPACITY = settings.CHAT_RATE_LIMIT
+    CHAT_RATE = settings.CHAT_RATE_LIMIT / 60.0
+
+    # Адаптивная скорость (AIMD): 429 режет глобальную скорость вдвое,
+    # каждые RATE_RECOVERY_SUCCESSES успешных запросов возвращают RATE_RECOVERY_STEP
+    MIN_RATE_FACTOR = 0.1
+    RATE_RECOVERY_SUCCESSES = 50
+    RATE_RECOVERY_STEP = 0.1
+    MIN_WAIT = 0.05
+
+    def __init__(self, bot_token: str, db=None):
         self.bot_token = bot_token
 
         # Global bot rate limits (Telegram API limits)
-        self.global_bucket = TokenBucket(capacity=30, refill_rate=1.0)  # 30 req/sec
-
-        # Per-chat rate limits
-        self.chat_buckets: Dict[int, TokenBucket] = defaultdict(
-            lambda: TokenBucket(capacity=20, refill_rate=0.5)  # 20 req/40sec per chat
-        )
+        self.global_bucket = TokenBucket(capacity=self.GLOBAL_CAPACITY, refill_rate=self.GLOBAL_RATE)
+
+        # Per-chat rate limits (слоты простаивающих чатов освобождаются сами)
+        self.chat_buckets = ChatBucketTable(capacity=self.CHAT_CAPACITY, refill_rate=self.CHAT_RATE)
+
+        # Общие для всех реплик бакеты (ключ — id бота из токена, сам токен в БД не пишем)
+        self.shared: Optional[SharedTokenBuckets] = None
+        if db is not None and settings.RATE_LIMITER_BACKEND == "postgres":
+            self.shared = SharedTokenBuckets(
+                db,
+                bot_key=f"tg:{bot_token.split(':', 1)[0]}",
+                global_capacity=self.GLOBAL_CAPACITY,
+                global_rate=self.GLOBAL_RATE,
+                global_batch=(
+                    settings.RATE_LIMITER_GLOBAL_BATCH or max(1, self.GLOBAL_CAPACITY // 3)
+                ),
+                lease_ttl=settings.RATE_LIMITER_LEASE_TTL,
+                chat_capacity=self.CHAT_CAPACITY,
+                chat_rate=self.CHAT_RATE,
+                chat_batch=settings.RATE_LIMITER_CHAT_BATCH,
+            )
+        self._shared_failed_at = 0.0
 
         # Request history for backoff
         self.error_history = deque(maxlen=100)
         self.backoff_until: Optional[datetime] = None
 
+        self.rate_factor = 1.0
+        self._successes_since_429 = 0
+
+    def share_chat(self, chat_id: int) -> None:
+        """Лимит чата — общий для всех реплик (чат, куда пишут лейны нескольких процессов)"""
+        if self.shared is not None and chat_id:
+            self.shared.shared_chats.add(chat_id)
+
+    def _chat_is_shared(self, chat_id: Optional[int]) -> bool:
+        return (
+            chat_id is not None
+            and self.shared is not None
+            and chat_id in self.shared.shared_chats
+            and time.monotonic() - self._shared_failed_at > 60
+        )
+
     async def can_send(self, chat_id: Optional[int] = None) -> bool:
         """Check if we can send a request"""
         # Check global backoff
         if self.backoff_until and datetime.now() < self.backoff_until:
             return False
 
-        # Check global rate limit
-        if not await self.global_bucket.consume():
+        # локальный чат проверяем до глобального бакета, чтобы отказ чата не сжигал
+        # глобальный токен; общий чат проверяет сам tg_rate_acquire
+        now = time.monotonic()
+        shared_chat = self._chat_is_shared(chat_id)
+        if chat_id and not shared_chat and self.chat_buckets.wait_time(chat_id, now=now) > 0:
             return False
 
-        # Check per-chat rate limit
-        if chat_id and not await self.chat_buckets[chat_id].consume():
-            return False
+        if self.shared is not None:
+            try:
+                granted = await self.shared.try_acquire(chat_id if shared_chat else None)
+            except Exception as e:
+                # БД недоступна — работаем на локальных бакетах, не блокируя отправку
+                if now - self._shared_failed_at > 60:
+                    logger.warning("Shared rate limiter unavailable, using local buckets: %s", e)
+                self._shared_failed_at = now
+            else:
+                if granted and chat_id and not shared_chat:
+                    self.chat_buckets.try_consume(chat_id)
+                return granted
 
+        if not self.global_bucket.try_consume(now=now):
+            return False
+        if chat_id:
+            self.chat_buckets.try_consume(chat_id, now=now)
         return True
 
     async def wait_for_send(self, chat_id: Optional[int] = None) -> float:
@@ -92,25 +406,51 @@ class BotRateLimiter:
         if self.backoff_until and datetime.now() < self.backoff_until:
             wait_times.append((self.backoff_until - datetime.now()).total_seconds())
 
-        # Global rate limit wait
-        global_wait = await self.global_bucket.wait_for_tokens()
-        if global_wait > 0:
-            wait_times.append(global_wait)
+        shared_chat = self._chat_is_shared(chat_id)
+        if self.shared is not None and time.monotonic() - self._shared_failed_at > 60:
+            wait_times.append(self.shared.estimated_wait(chat_id if shared_chat else None))
+        else:
+            # Global rate limit wait
+            global_wait = self.global_bucket.wait_time()
+            if global_wait > 0:
+                wait_times.append(global_wait)
 
         # Per-chat rate limit wait
-        if chat_id:
-            chat_wait = await self.chat_buckets[chat_id].wait_for_tokens()
+        if chat_id and not shared_chat:
+            chat_wait = self.chat_buckets.wait_time(chat_id)
             if chat_wait > 0:
                 wait_times.append(chat_wait)
 
         return max(wait_times) if wait_times else 0.0
 
+    async def acquire(self, chat_id: Optional[int] = None) -> float:
+        """Ждёт разрешения на запрос; возвращает, сколько секунд пришлось ждать"""
+        waited = 0.0
+        while not await self.can_send(chat_id=chat_id):
+            wait_for = max(self.MIN_WAIT, await self.wait_for_send(chat_id=chat_id))
+            waited += wait_for
+            await asyncio.sleep(wait_for)
+        return waited
+
+    def _set_rate_factor(self, factor: float) -> None:
+        factor = min(1.0, max(self.MIN_RATE_FACTOR, factor))
+        if factor == self.rate_factor:
+            return
+        self.rate_factor = factor
+        self.global_bucket.refill_rate = self.GLOBAL_RATE * factor
+        if self.shared is not None:
+            self.shared.global_rate = self.GLOBAL_RATE * factor
+        logger.info("📉 Send rate for %s... set to %.0f%%", self.bot_token[:10], factor * 100)
+
     def record_error(self, error_code: int, retry_after: Optional[int] = None):
         """Record API error for backoff calculation"""
         now = datetime.now()
         self.error_history.append((now, error_code, retry_after))
 
         if error_code == 429:  # Too Many Requests
+            self._successes_since_429 = 0
+            self._set_rate_factor(self.rate_factor / 2)
+
             if retry_after:
                 self.backoff_until = now + timedelta(seconds=retry_after + 1)
             else:
@@ -127,102 +467,456 @@ class BotRateLimiter:
                 self.backoff_until,
             )
 
+            # штраф в общий бакет — остальные реплики тоже притормозят
+            if self.shared is not None:
+                seconds = (self.backoff_until - now).total_seconds()
+                try:
+                    task = asyncio.get_running_loop().create_task(self.shared.penalize(seconds))
+                    task.add_done_callback(_log_penalize_failure)
+                except RuntimeError:
+                    pass  # вне event loop — обойдёмся локальным backoff
+
     def record_success(self):
         """Record successful request"""
         # Clear some error history on success
         if len(self.error_history) > 10:
             self.error_history.popleft()
 
+        if self.rate_factor < 1.0:
+            self._successes_since_429 += 1
+            if self._successes_since_429 >= self.RATE_RECOVERY_SUCCESSES:
+                self._successes_since_429 = 0
+                self._set_rate_factor(self.rate_factor + self.RATE_RECOVERY_STEP)
+
+
+def _log_penalize_failure(task: "asyncio.Task[None]") -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Failed to share rate limit backoff: %r", task.exception())
+
+
+# Лимитеры ботов по bot.id: воркер регистрирует свой (с общими бакетами в БД),
+# для остальных ботов (мастер, разовые проверки токенов) создаётся локальный
+_bot_limiters: Dict[int, BotRateLimiter] = {}
+_fallback_limiters: TTLCache = TTLCache(maxsize=1024, ttl=3600)
+
+# Сколько следующих запросов текущей задачи уже оплачены токенами
+# (OutboundScheduler берёт токен до вызова job())
+_prepaid_requests: ContextVar[Optional[List[int]]] = ContextVar(
+    "prepaid_requests", default=None
+)
+
+
+def register_bot_limiter(bot_id: int, limiter: BotRateLimiter) -> None:
+    _bot_limiters[bot_id] = limiter
+    _fallback_limiters.pop(bot_id, None)
+
+
+def limiter_for_bot(bot: "Bot") -> BotRateLimiter:
+    limiter = _bot_limiters.get(bot.id)
+    if limiter is None:
+        limiter = _fallback_limiters.get(bot.id)
+        if limiter is None:
+            limiter = _fallback_limiters[bot.id] = BotRateLimiter(bot.token)
+    return limiter
+
+
+class RateLimitRequestMiddleware(BaseRequestMiddleware):
+    """
+    Request middleware сессии: каждый исходящий вызов Bot API проходит через
+    BotRateLimiter своего бота, TelegramRetryAfter включает backoff и снижает
+    скорость, успешные ответы постепенно её возвращают. Прямые вызовы из
+    хэндлеров не засыпают на лимите чата — это работа OutboundScheduler.
+    """
+
+    # служебные вызовы, которые не должны стоять в очереди за сообщениями
+    UNTHROTTLED_METHODS = frozenset(
+        {
+            "getMe",
+            "getUpdates",
+            "getWebhookInfo",
+            "setWebhook",
+            "deleteWebhook",
+            "getFile",
+            "answerCallbackQuery",
+            "answerInlineQuery",
+            "logOut",
+            "close",
+        }
+    )
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: "Bot",
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        limiter = limiter_for_bot(bot)
+
+        if method.__api_method__ not in self.UNTHROTTLED_METHODS:
+            prepaid = _prepaid_requests.get()
+            if prepaid and prepaid[0] > 0:
+                prepaid[0] -= 1
+            else:
+                # внутри хэндлера ждём только глобальный бакет (миллисекунды при 30 rps);
+                # темп по чату держат лейны OutboundScheduler, здесь чат лишь учитывается
+                await limiter.acquire()
+                chat_id = getattr(method, "chat_id", None)
+                if isinstance(chat_id, int):
+                    limiter.chat_buckets.try_consume(chat_id)
+
+        try:
+            response = await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            limiter.record_error(429, e.retry_after)
+            raise
+        limiter.record_success()
+        return response
+
+
+class OutboundQueueFull(RuntimeError):
+    """Очередь чата в OutboundScheduler переполнена — отправка не поставлена."""
+
+
+class OutboundScheduler:
+    """
+    Неблокирующая отправка для одного бота.
+
+    Хэндлер кладёт "намерение отправить" (корутину-фабрику) в очередь чата и сразу
+    возвращается. Для каждого чата с непустой очередью живёт одна задача-лейн:
+    она выполняет намерения по порядку и ждёт лимитов BotRateLimiter сама,
+    не задерживая обработку апдейтов. Пустые лейны завершаются.
+    """
+
+    def __init__(
+        self,
+        ratelimiter: "BotRateLimiter",
+        name: str = "",
+        max_pending_per_chat: int = 200,
+    ):
+        self.ratelimiter = ratelimiter
+        self.name = name
+        self.max_pending_per_chat = max_pending_per_chat
+
+        self._lanes: Dict[int, deque] = {}
+        self._lane_tasks: Dict[int, asyncio.Task] = {}
+
+        self.stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "rejected": 0,
+            "waited_seconds": 0.0,
+        }
+
+    def submit(self, chat_id: int, job: Callable[[], Awaitable[Any]]) -> "asyncio.Future[Any]":
+        """
+        Ставит job() в очередь чата. Возвращает future с результатом job();
+        ждать его не обязательно — ошибки логируются.
+
+        Переполненная очередь чата — OutboundQueueFull сразу, в вызывающем коде:
+        апдейт тогда не подтверждается в очереди и будет обработан повторно.
+        """
+        lane = self._lanes.get(chat_id)
+        if lane is not None and len(lane) >= self.max_pending_per_chat:
+            self.stats["rejected"] += 1
+            logger.warning(
+                "📛 Outbound queue full: instance=%s chat=%s pending=%s",
+                self.name,
+                chat_id,
+                len(lane),
+            )
+            raise OutboundQueueFull(
+                f"Outbound queue for chat {chat_id} is full ({len(lane)}), instance {self.name}"
+            )
+
+        loop = asyncio.get_running_loop()
+        fut: asyncio.Future = loop.create_future()
+        fut.add_done_callback(self._log_failure)
+
+        lane = self._lanes.setdefault(chat_id, deque())
+        lane.append((job, fut))
+        self.stats["submitted"] += 1
+
+        task = self._lane_tasks.get(chat_id)
+        if task is None or task.done():
+            self._lane_tasks[chat_id] = asyncio.create_task(self._run_lane(chat_id))
+        return fut
+
+    def _log_failure(self, fut: "asyncio.Future[Any]") -> None:
+        if fut.cancelled():
+            return
+        exc = fut.exception()
+        if exc is not None:
+            logger.error("Outbound send failed (%s): %r", self.name, exc)
+
+    async def _acquire(self, chat_id: int) -> None:
+        self.stats["waited_seconds"] += await self.ratelimiter.acquire(chat_id)
+
+    async def _run_lane(self, chat_id: int) -> None:
+        lane = self._lanes.get(chat_id)
+        try:
+            while lane:
+                job, fut = lane.popleft()
+                if fut.done():
+                    continue
+                try:
+                    await self._acquire(chat_id)
+                    # первый запрос job() уже оплачен — middleware сессии не спишет токен повторно
+                    prepaid = _prepaid_requests.set([1])
+                    try:
+                        result = await job()
+                    finally:
+                        _prepaid_requests.reset(prepaid)
+                except asyncio.CancelledError:
+                    fut.cancel()
+                    raise
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    fut.set_exception(e)
+                else:
+                    self.stats["completed"] += 1
+                    fut.set_result(result)
+        finally:
+            if not lane:
+                self._lanes.pop(chat_id, None)
+            if self._lane_tasks.get(chat_id) is asyncio.current_task():
+                self._lane_tasks.pop(chat_id, None)
+
+    def pending(self) -> int:
+        return sum(len(lane) for lane in self._lanes.values())
+
+    async def drain(self, timeout: float = 10.0) -> None:
+        """Дожидается отправки всего поставленного в очередь (при остановке процесса)."""
+        tasks = list(self._lane_tasks.values())
+        if not tasks:
+            return
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(
+                "Outbound scheduler %s: %s lanes cancelled on drain", self.name, len(pending)
+            )
+
 
 OnUpdateCallable = Callable[[str, types.Update], Awaitable[None]]
+OnDoneCallable = Callable[[UpdateQueueItem, Optional[BaseException]], Awaitable[None]]
 
+# Приоритеты апдейтов: больше — раньше. Нажатие кнопки ждёт ответа (крутилка в клиенте),
+# новое сообщение важнее правки старого
+PRIORITY_CALLBACK = 20
+PRIORITY_MESSAGE = 10
+PRIORITY_OTHER = 0
 
-class RateLimiter:
-    """Main rate limiter managing all bot instances"""
 
-    def __init__(self, on_update: Optional[OnUpdateCallable] = None):
+class RateLimiter:
+    """
+    In-process исполнитель апдейтов для queue-воркера: на каждый инстанс —
+    ограниченная очередь по приоритету и одна задача-лейн, обрабатывающая её по порядку.
+    Приоритет переставляет апдейты только разных чатов: внутри чата порядок FIFO —
+    апдейт не получает приоритет выше ещё не обработанного апдейта того же чата.
+
+    Backpressure: заполненные лейны (saturated_instances) claimer исключает из выборки
+    tg_update_queue, общее число апдейтов в памяти ограничено max_inflight
+    (wait_for_capacity). Исходящие запросы лимитирует middleware сессии, а не лейн.
+    """
+
+    LANE_IDLE_SECONDS = 30.0
+
+    def __init__(
+        self,
+        on_update: Optional[OnUpdateCallable] = None,
+        *,
+        on_done: Optional[OnDoneCallable] = None,
+        on_capacity: Optional[Callable[[], None]] = None,
+        lane_size: int = 100,
+        max_inflight: int = 500,
+    ):
         self.on_update = on_update
+        self.on_done = on_done
+        self.on_capacity = on_capacity
+        self.lane_size = max(1, lane_size)
+        self.max_inflight = max(1, max_inflight)
 
         self.bot_limiters: Dict[str, BotRateLimiter] = {}
-        self.update_queues: Dict[str, asyncio.Queue[UpdateQueueItem]] = defaultdict(
-            lambda: asyncio.Queue(maxsize=1000)
-        )
+        self.update_queues: Dict[str, asyncio.PriorityQueue] = {}
         self.processing_tasks: Dict[str, asyncio.Task] = {}
         self.shutdown_event = asyncio.Event()
 
+        self._seq = 0
+        self._inflight = 0
+        self._capacity_free = asyncio.Event()
+        self._capacity_free.set()
+        self._current: Dict[str, UpdateQueueItem] = {}
+        # (instance_id, chat_id) -> [приоритет последнего в очереди, сколько в очереди]
+        self._chat_tails: Dict[Tuple[str, int], List[int]] = {}
+        # job_id апдейтов в лейнах (в очереди и в обработке) — для heartbeat locked_at
+        self._held_jobs: Dict[str, Set[int]] = defaultdict(set)
+        self._lane_stats: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: {"accepted": 0, "rejected": 0, "processed": 0, "failed": 0}
+        )
+
     def get_or_create_limiter(self, instance_id: str, bot_token: str) -> BotRateLimiter:
         """Get or create rate limiter for bot instance"""
         if instance_id not in self.bot_limiters:
             self.bot_limiters[instance_id] = BotRateLimiter(bot_token)
         return self.bot_limiters[instance_id]
 
-    async def add_update(self, instance_id: str, update_data: dict, priority: int = 0):
-        """Add update to processing queue"""
-        queue = self.update_queues[instance_id]
+    def attach_limiter(self, instance_id: str, limiter: BotRateLimiter) -> None:
+        """Лимитер воркера инстанса — чтобы get_stats показывал реальные бакеты"""
+        self.bot_limiters[instance_id] = limiter
+
+    @staticmethod
+    def update_priority(update_data: dict) -> int:
+        if "callback_query" in update_data:
+            return PRIORITY_CALLBACK
+        if "message" in update_data:
+            return PRIORITY_MESSAGE
+        return PRIORITY_OTHER
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    def has_capacity(self) -> bool:
+        return self._inflight < self.max_inflight
+
+    async def wait_for_capacity(self) -> None:
+        while not self.has_capacity():
+            self._capacity_free.clear()
+            await self._capacity_free.wait()
+
+    def saturated_instances(self) -> List[str]:
+        return [iid for iid, q in self.update_queues.items() if q.full()]
+
+    def add_update(
+        self,
+        instance_id: str,
+        update_data: dict,
+        priority: Optional[int] = None,
+        job_id: Optional[int] = None,
+    ) -> bool:
+        """
+        Ставит апдейт в лейн инстанса. False — лейн заполнен или исполнитель
+        остановлен: апдейт не принят, его надо вернуть в tg_update_queue.
+        """
+        if self.shutdown_event.is_set():
+            return False
 
-        try:
-            item = UpdateQueueItem(
-                instance_id=instance_id,
-                update_data=update_data,
-                priority=priority,
-            )
-            await queue.put(item)
+        queue = self.update_queues.get(instance_id)
+        if queue is None:
+            queue = self.update_queues[instance_id] = asyncio.PriorityQueue(maxsize=self.lane_size)
+
+        if priority is None:
+            priority = self.update_priority(update_data)
+        chat_id = self.extract_chat_id(update_data)
+        tail = self._chat_tails.get((instance_id, chat_id)) if chat_id is not None else None
+        if tail:
+            # не обгоняем ожидающие апдейты своего чата
+            priority = min(priority, tail[0])
+        item = UpdateQueueItem(
+            instance_id=instance_id,
+            updated_ata=update_data,
+            priority=priority,
+            job_id=job_id,
+        )
 
-            # Start processing task if not running
-            if instance_id not in self.processing_tasks:
-                self.processing_tasks[instance_id] = asyncio.create_task(
-                    self.process_queue(instance_id)
-                )
+        self._seq += 1
+        try:
+            # при равном приоритете — FIFO
+            queue.put_nowait((-priority, self._seq, item))
         except asyncio.QueueFull:
-            logger.warning("Update queue full for instance %s, dropping update", instance_id)
+            self._lane_stats[instance_id]["rejected"] += 1
+            logger.warning("Update queue full for instance %s, deferring update", instance_id)
+            return False
+
+        self._lane_stats[instance_id]["accepted"] += 1
+        self._inflight += 1
+        if chat_id is not None:
+            if tail:
+                tail[0] = priority
+                tail[1] += 1
+            else:
+                self._chat_tails[(instance_id, chat_id)] = [priority, 1]
+        if job_id is not None:
+            self._held_jobs[instance_id].add(job_id)
+
+        # Start processing task if not running
+        task = self.processing_tasks.get(instance_id)
+        if task is None or task.done():
+            self.processing_tasks[instance_id] = asyncio.create_task(
+                self.process_queue(instance_id)
+            )
+        return True
 
     async def process_queue(self, instance_id: str):
         """Process updates for specific instance"""
         queue = self.update_queues[instance_id]
-        limiter = self.bot_limiters.get(instance_id)
+        stats = self._lane_stats[instance_id]
 
-        if not limiter:
-            logger.error("No rate limiter found for instance %s", instance_id)
-            return
-
-        logger.info("Started processing queue for instance %s", instance_id)
+        logger.debug("Started processing queue for instance %s", instance_id)
 
         try:
             while not self.shutdown_event.is_set():
                 try:
-                    # Get next update
-                    item = await asyncio.wait_for(queue.get(), timeout=1.0)
-
-                    # Check rate limits
-                    chat_id = self.extract_chat_id(item.update_data)
-
-                    if not await limiter.can_send(chat_id):
-                        wait_time = await limiter.wait_for_send(chat_id)
-                        if wait_time > 0:
-                            logger.debug(
-                                "Rate limiting instance %s, waiting %.2fs",
-                                instance_id,
-                                wait_time,
-                            )
-                            await asyncio.sleep(wait_time)
-
-                    # Process the update
-                    await self.process_update(instance_id, item)
-                    limiter.record_success()
-
-                    queue.task_done()
-
+                    _, _, item = await asyncio.wait_for(queue.get(), timeout=self.LANE_IDLE_SECONDS)
                 except asyncio.TimeoutError:
-                    continue  # Check shutdown event
+                    break  # лейн простаивает — задача завершается, новая стартует в add_update
+
+                was_full = queue.qsize() + 1 >= self.lane_size
+                self._current[instance_id] = item
+                self._untrack_chat(instance_id, item)
+                error: Optional[BaseException] = None
+                try:
+                    await self.process_update(instance_id, item)
+                    stats["processed"] += 1
+                except asyncio.CancelledError:
+                    raise
                 except Exception as e:
+                    error = e
+                    stats["failed"] += 1
                     logger.exception("Error processing update for %s: %s", instance_id, e)
-                    limiter.record_error(500)  # Generic error
+                # при отмене item остаётся в _current — его вернёт shutdown()
+                self._current.pop(instance_id, None)
+                self._held_jobs[instance_id].discard(item.job_id)
+                queue.task_done()
+
+                self._release_slot(was_full)
+                if self.on_done:
+                    try:
+                        await self.on_done(item, error)
+                    except Exception:
+                        logger.exception("on_done failed for instance %s", instance_id)
 
         except asyncio.CancelledError:
             logger.info("Processing task cancelled for instance %s", instance_id)
         finally:
             # Clean up
-            self.processing_tasks.pop(instance_id, None)
+            if self.processing_tasks.get(instance_id) is asyncio.current_task():
+                self.processing_tasks.pop(instance_id, None)
+
+    def _untrack_chat(self, instance_id: str, item: UpdateQueueItem) -> None:
+        chat_id = self.extract_chat_id(item.update_data)
+        if chat_id is None:
+            return
+        key = (instance_id, chat_id)
+        tail = self._chat_tails.get(key)
+        if tail is not None:
+            tail[1] -= 1
+            if tail[1] <= 0:
+                del self._chat_tails[key]
+
+    def held_job_ids(self) -> List[int]:
+        """job_id всех апдейтов в лейнах, включая обрабатываемые сейчас"""
+        return [job_id for jobs in self._held_jobs.values() for job_id in jobs]
+
+    def _release_slot(self, lane_was_full: bool) -> None:
+        was_saturated = self._inflight >= self.max_inflight
+        self._inflight -= 1
+        self._capacity_free.set()
+        if (lane_was_full or was_saturated) and self.on_capacity:
+            # claimer мог уснуть в ожидании NOTIFY, пока все доступные апдейты были заблокированы
+            self.on_capacity()
 
     def extract_chat_id(self, update_data: dict) -> Optional[int]:
         """Extract chat ID from update for per-chat rate limiting"""
@@ -230,7 +924,11 @@ class RateLimiter:
             if "message" in update_data:
                 return update_data["message"]["chat"]["id"]
             if "callback_query" in update_data:
-                return update_data["callback_query"]["message"]["chat"]["id"]
+                callback = update_data["callback_query"]
+                # у inline-кнопок без сообщения чата нет — порядок держим по пользователю
+                if callback.get("message"):
+                    return callback["message"]["chat"]["id"]
+                return callback["from"]["id"]
             if "edited_message" in update_data:
                 return update_data["edited_message"]["chat"]["id"]
         except (KeyError, TypeError):
@@ -261,20 +959,35 @@ class RateLimiter:
         except asyncio.CancelledError:
             pass
         finally:
-            # Cancel all processing tasks
-            for task in list(self.processing_tasks.values()):
-                task.cancel()
-
-            # Wait for tasks to complete
-            if self.processing_tasks:
-                await asyncio.gather(*self.processing_tasks.values(), return_exceptions=True)
-
+            await self.shutdown()
             logger.info("Update processing loop stopped")
 
     def stop(self):
         """Stop all processing"""
         self.shutdown_event.set()
 
+    async def shutdown(self) -> List[UpdateQueueItem]:
+        """
+        Останавливает лейны и возвращает апдейты, которые не успели обработать
+        (прерванные и ещё стоящие в очередях) — их нужно вернуть в tg_update_queue.
+        """
+        self.shutdown_event.set()
+        tasks = list(self.processing_tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        pending: List[UpdateQueueItem] = list(self._current.values())
+        self._current.clear()
+        for queue in self.update_queues.values():
+            while not queue.empty():
+                pending.append(queue.get_nowait()[2])
+        self._inflight = 0
+        self._chat_tails.clear()
+        self._held_jobs.clear()
+        return pending
+
     async def remove_instance(self, instance_id: str):
         """Remove instance from rate limiter"""
         # Cancel processing task
@@ -288,7 +1001,14 @@ class RateLimiter:
 
         # Clean up data structures
         self.bot_limiters.pop(instance_id, None)
-        self.update_queues.pop(instance_id, None)
+        queue = self.update_queues.pop(instance_id, None)
+        if queue is not None:
+            self._inflight -= queue.qsize() + (1 if self._current.pop(instance_id, None) else 0)
+            self._capacity_free.set()
+        self._lane_stats.pop(instance_id, None)
+        self._held_jobs.pop(instance_id, None)
+        for key in [key for key in self._chat_tails if key[0] == instance_id]:
+            del self._chat_tails[key]
 
         logger.info("Removed instance %s from rate limiter", instance_id)
 
@@ -297,13 +1017,26 @@ class RateLimiter:
         limiter = self.bot_limiters.get(instance_id)
         queue = self.update_queues.get(instance_id)
 
-        if not limiter or not queue:
+        if not limiter and not queue:
             return {}
 
-        return {
-            "global_tokens": limiter.global_bucket.tokens,
-            "chat_buckets": len(limiter.chat_buckets),
-            "queue_size": queue.qsize(),
-            "error_count": len(limiter.error_history),
-            "backoff_until": limiter.backoff_until.isoformat() if limiter.backoff_until else None,
+        stats: Dict[str, Any] = {
+            "queue_size": queue.qsize() if queue else 0,
+            "queue_capacity": self.lane_size,
+            "processing": instance_id in self._current,
+            "lane_active": instance_id in self.processing_tasks,
+            **self._lane_stats.get(instance_id, {}),
         }
+        if limiter:
+            stats.update(
+                {
+                    "global_tokens": limiter.global_bucket.tokens,
+                    "rate_factor": limiter.rate_factor,
+                    "chat_buckets": len(limiter.chat_buckets),
+                    "error_count": len(limiter.error_history),
+                    "backoff_until": (
+                        limiter.backoff_until.isoformat() if limiter.backoff_until else None
+                    ),
+                }
+            )
+        return stats
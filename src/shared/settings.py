@@ -25,6 +25,62 @@ DATABASE_URL_ASYNC = (
     f"postgresql+asyncpg://{DB_USER}:{_db_password_encoded}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 )
 
+# Отстающую схему мигрирует первый стартовавший процесс (под advisory lock).
+# 0 — только проверка версии: миграции запускаются шагом деплоя `python -m shared.migrations`
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "1").strip().lower() not in ("0", "false", "no")
+
+# Метрики запросов MasterDatabase: порог лога медленных запросов (мс)
+# и предел числа различных запросов в статистике (остальное — в "sql:other")
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "200"))
+DB_QUERY_STATS_MAX = int(os.getenv("DB_QUERY_STATS_MAX", "500"))
+
+# === PostgreSQL: бюджет соединений ===
+# Роль процесса: master / api / queue / worker — от неё зависит доля бюджета
+DB_ROLE = os.getenv("DB_ROLE", "").strip().lower()
+# Сколько соединений всего могут занять все процессы платформы (≈ max_connections)
+DB_CONNECTION_BUDGET = int(os.getenv("DB_CONNECTION_BUDGET", "100"))
+DB_CONNECTION_RESERVE = int(os.getenv("DB_CONNECTION_RESERVE", "3"))
+# Ожидаемое число процессов каждой роли; worker — сколько слотов заранее отложить
+# под Docker-воркеров тенантов (DockerWorkerManager предупреждает, когда их больше)
+DB_BUDGET_REPLICAS = {
+    "master": int(os.getenv("DB_BUDGET_MASTER_REPLICAS", "1")),
+    "api": int(os.getenv("DB_BUDGET_API_REPLICAS", "1")),
+    "queue": int(os.getenv("DB_BUDGET_QUEUE_REPLICAS", os.getenv("QUEUE_WORKER_REPLICAS", "1"))),
+    "worker": int(os.getenv("DB_BUDGET_WORKER_REPLICAS", "10")),
+}
+# Фиксированный пул воркера тенанта (слот бюджета — этот пул плюс LISTEN-соединение)
+DB_WORKER_POOL_SIZE = int(os.getenv("DB_WORKER_POOL_SIZE", "2"))
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+# Явный размер пула вместо расчёта по бюджету (0 — считать)
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "0"))
+# DSN указывает на PgBouncer в transaction-режиме: без кэша prepared statements,
+# LISTEN и advisory-локи — через DB_DIRECT_URL (прямое соединение с Postgres)
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "0").strip().lower() in ("1", "true", "yes")
+DB_DIRECT_URL = os.getenv("DB_DIRECT_URL", "").strip()
+
+# === PostgreSQL: read-реплики ===
+# Через запятую; на реплики идут только явно read-only запросы (дашборды, листинги, экспорт)
+DB_REPLICA_URLS = [u.strip() for u in os.getenv("DB_REPLICA_URLS", "").split(",") if u.strip()]
+# Реплика с отставанием больше этого (сек) не используется — запрос уходит на primary
+DB_REPLICA_MAX_LAG_SECONDS = float(os.getenv("DB_REPLICA_MAX_LAG_SECONDS", "5"))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "5"))
+
+# === PostgreSQL: история сообщений (messages) ===
+# Срок хранения по тарифам (дни) — начальные значения saas_plans.messages_retention_days,
+# дальше правится в самой таблице. Срок фиксируется в строке при записи (expires_at)
+MESSAGES_RETENTION_DAYS = {
+    "demo": int(os.getenv("MESSAGES_RETENTION_DEMO_DAYS", "30")),
+    "lite": int(os.getenv("MESSAGES_RETENTION_LITE_DAYS", "180")),
+    "pro": int(os.getenv("MESSAGES_RETENTION_PRO_DAYS", "365")),
+    "enterprise": int(os.getenv("MESSAGES_RETENTION_ENTERPRISE_DAYS", "730")),
+}
+# Для инстансов без тарифа и тарифов без явного срока
+MESSAGES_RETENTION_DEFAULT_DAYS = int(os.getenv("MESSAGES_RETENTION_DEFAULT_DAYS", "365"))
+# На сколько месяцев сверх максимального срока заранее создавать партиции
+MESSAGES_PARTITIONS_AHEAD_MONTHS = int(os.getenv("MESSAGES_PARTITIONS_AHEAD_MONTHS", "2"))
+# Перенос старой таблицы (messages_legacy) после миграции: строк за одну транзакцию
+MESSAGES_LEGACY_COPY_BATCH = int(os.getenv("MESSAGES_LEGACY_COPY_BATCH", "5000"))
+
 
 # === КЛЮЧИ ===
 ENCRYPTION_KEY_FILE = Path(
@@ -53,13 +109,38 @@ WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("WEBHOOKPORT", "9443")))
 
 # === ОБЩИЕ НАСТРОЙКИ ===
 AUTO_CLOSE_HOURS = int(os.getenv("AUTO_CLOSE_HOURS", "12"))
+# Лимиты отправки в Telegram на бота: запросов в секунду всего и сообщений в минуту на чат
 GLOBAL_RATE_LIMIT = int(os.getenv("GLOBAL_RATE_LIMIT", "30"))
 CHAT_RATE_LIMIT = int(os.getenv("CHAT_RATE_LIMIT", "20"))
 MAX_INSTANCES_PER_USER = int(os.getenv("MAX_INSTANCES_PER_USER", "5"))
 
+# === TELEGRAM HTTP (общий пул соединений для всех Bot) ===
+TELEGRAM_HTTP_POOL_LIMIT = int(os.getenv("TELEGRAM_HTTP_POOL_LIMIT", "100"))
+TELEGRAM_HTTP_POOL_PER_HOST = int(os.getenv("TELEGRAM_HTTP_POOL_PER_HOST", "50"))
+TELEGRAM_HTTP_KEEPALIVE = float(os.getenv("TELEGRAM_HTTP_KEEPALIVE", "30"))
+TELEGRAM_HTTP_DNS_TTL = int(os.getenv("TELEGRAM_HTTP_DNS_TTL", "3600"))
+
+# === TELEGRAM RATE LIMIT (общие для всех процессов бакеты бота и OpenChat-группы) ===
+# postgres — лимиты делят все реплики через tg_rate_buckets; local — только в памяти процесса
+RATE_LIMITER_BACKEND = os.getenv("RATE_LIMITER_BACKEND", "postgres").strip().lower()
+# сколько токенов глобального бакета процесс забирает за один поход в БД
+# (0 — треть GLOBAL_RATE_LIMIT: при полной скорости ~3 запроса к строке бакета в секунду)
+RATE_LIMITER_GLOBAL_BATCH = int(os.getenv("RATE_LIMITER_GLOBAL_BATCH", "0"))
+# сколько секунд живут неизрасходованные токены из пачки (потом сгорают)
+RATE_LIMITER_LEASE_TTL = float(os.getenv("RATE_LIMITER_LEASE_TTL", "1.0"))
+# токенов общего бакета чата (OpenChat-группа) за поход в БД: при CHAT_RATE_LIMIT в минуту
+# больше одного за lease_ttl не набегает, остаток сгорел бы
+RATE_LIMITER_CHAT_BATCH = int(os.getenv("RATE_LIMITER_CHAT_BATCH", "1"))
+
 WORKER_MONITOR_INTERVAL = int(os.getenv("WORKER_MONITOR_INTERVAL", "600"))
 BILLING_CRON_INTERVAL = int(os.getenv("BILLING_CRON_INTERVAL", "3600"))
 
+# === АНТИФЛУД (общие для реплик воркера счётчики в PostgreSQL) ===
+# ширина бакета скользящего минутного окна: меньше — точнее окно, больше — меньше строк
+ANTIFLOOD_BUCKET_SECONDS = max(1, int(os.getenv("ANTIFLOOD_BUCKET_SECONDS", "10")))
+# сколько секунд помнить локально "лимит сессии исчерпан" без похода в БД
+ANTIFLOOD_SESSION_BLOCK_TTL = float(os.getenv("ANTIFLOOD_SESSION_BLOCK_TTL", "5"))
+
 # === ADMIN / ROLES ===
 _SUPERADMIN_RAW = os.getenv("GRACEHUB_SUPERADMIN_TELEGRAM_ID", "").strip()
 
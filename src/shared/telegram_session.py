@@ -0,0 +1,90 @@
+# src/shared/telegram_session.py
+import asyncio
+import logging
+import ssl
+from typing import Optional
+
+import certifi
+from aiogram import __version__ as aiogram_version
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiohttp import ClientSession, TCPConnector
+
+from . import settings
+from .rate_limiter import RateLimitRequestMiddleware
+
+logger = logging.getLogger(__name__)
+
+
+class SharedAiohttpSession(AiohttpSession):
+    """
+    Один aiohttp-пул соединений к api.telegram.org на процесс.
+
+    Токен подставляется в URL на каждый запрос, поэтому одну сессию можно отдать
+    любому числу Bot(...). close() от отдельных ботов игнорируется (старый код
+    закрывает bot.session после разовых вызовов) — реально пул закрывает
+    только shutdown() при остановке процесса.
+
+    Пул собираем сами через публичные TCPConnector/ClientSession: make_request()
+    и stream_content() aiogram берут сессию только через create_session().
+    """
+
+    def __init__(self) -> None:
+        super().__init__(limit=settings.TELEGRAM_HTTP_POOL_LIMIT)
+        self._pool: Optional[ClientSession] = None
+        self._pool_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def create_session(self) -> ClientSession:
+        loop = asyncio.get_running_loop()
+        # ClientSession привязан к event loop: в новом loop (тесты, asyncio.run)
+        # старый пул использовать нельзя — просто создаём новый
+        if self._pool is None or self._pool.closed or self._pool_loop is not loop:
+            self._pool = ClientSession(
+                connector=TCPConnector(
+                    ssl=ssl.create_default_context(cafile=certifi.where()),
+                    limit=settings.TELEGRAM_HTTP_POOL_LIMIT,
+                    limit_per_host=settings.TELEGRAM_HTTP_POOL_PER_HOST,
+                    keepalive_timeout=settings.TELEGRAM_HTTP_KEEPALIVE,
+                    ttl_dns_cache=settings.TELEGRAM_HTTP_DNS_TTL,
+                ),
+                headers={"User-Agent": f"GraceHub aiogram/{aiogram_version}"},
+            )
+            self._pool_loop = loop
+        return self._pool
+
+    async def close(self) -> None:
+        return None
+
+    async def shutdown(self) -> None:
+        if self._pool is not None and not self._pool.closed:
+            await self._pool.close()
+            # как в AiohttpSession.close(): даём SSL-соединениям закрыться
+            await asyncio.sleep(0.25)
+        self._pool = None
+        self._pool_loop = None
+
+
+_shared_session: Optional[SharedAiohttpSession] = None
+
+
+def get_shared_session() -> SharedAiohttpSession:
+    """
+    Общая сессия для всех Bot(...) процесса: Bot(token=..., session=get_shared_session()).
+    """
+    global _shared_session
+    if _shared_session is None:
+        _shared_session = SharedAiohttpSession()
+        # лимиты Bot API и реакция на 429 — для всех ботов, работающих через эту сессию
+        _shared_session.middleware(RateLimitRequestMiddleware())
+        logger.info(
+            "Shared Telegram HTTP session created (limit=%s, per_host=%s)",
+            settings.TELEGRAM_HTTP_POOL_LIMIT,
+            settings.TELEGRAM_HTTP_POOL_PER_HOST,
+        )
+    return _shared_session
+
+
+async def close_shared_session() -> None:
+    global _shared_session
+    if _shared_session is not None:
+        await _shared_session.shutdown()
+        _shared_session = None
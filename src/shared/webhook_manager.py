@@ -7,6 +7,8 @@ from urllib.parse import urljoin
 from aiogram import Bot
 from aiogram.exceptions import TelegramBadRequest, TelegramUnauthorizedError
 
+from .telegram_session import get_shared_session
+
 logger = logging.getLogger(__name__)
 
 
@@ -49,7 +51,7 @@ class WebhookManager:
         Get current webhook info from Telegram (getWebhookInfo).
         Useful to avoid unnecessary deleteWebhook/setWebhook on restarts.
         """
-        bot = Bot(token=bottoken)
+        bot = Bot(token=bottoken, session=get_shared_session())
         try:
             info = await bot.get_webhook_info()
 
@@ -86,7 +88,7 @@ class WebhookManager:
         if allowed_updates is None:
             allowed_updates = ["message", "callback_query", "chat_member"]
 
-        bot = Bot(token=bottoken)
+        bot = Bot(token=bottoken, session=get_shared_session())
         try:
             for attempt in range(1, 4):  # 3 попытки
                 try:
@@ -129,7 +131,7 @@ class WebhookManager:
         drop_pending_updates по умолчанию False — чтобы случайные reset'ы не теряли очередь.
         В аварийных сценариях можно передать True.
         """
-        bot = Bot(token=bottoken)
+        bot = Bot(token=bottoken, session=get_shared_session())
         try:
             await bot.delete_webhook(drop_pending_updates=drop_pending_updates)
             logger.info("Webhook removed successfully")
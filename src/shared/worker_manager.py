@@ -3,6 +3,7 @@ import docker
 import logging
 import os
 from typing import Optional
+from shared import settings
 from shared.database import MasterDatabase
 
 logger = logging.getLogger(__name__)
@@ -79,6 +80,23 @@ class DockerWorkerManager:
                 "DB_NAME": os.getenv("DB_NAME", ""),
             }
             
+            # Бюджет соединений: воркер тенанта берёт фиксированный слот по роли worker
+            environment["DB_ROLE"] = "worker"
+            self._check_worker_slots(client)
+            for key in (
+                "DB_CONNECTION_BUDGET",
+                "DB_CONNECTION_RESERVE",
+                "DB_BUDGET_MASTER_REPLICAS",
+                "DB_BUDGET_API_REPLICAS",
+                "DB_BUDGET_QUEUE_REPLICAS",
+                "DB_BUDGET_WORKER_REPLICAS",
+                "DB_WORKER_POOL_SIZE",
+                "DB_PGBOUNCER",
+                "DB_DIRECT_URL",
+            ):
+                if os.getenv(key):
+                    environment[key] = os.environ[key]
+
             # 🔥 Копируем все GRACEHUB_* переменные из master (но НЕ токены!)
             for key, value in os.environ.items():
                 if key.startswith("GRACEHUB_") and key not in ["GRACEHUB_MASTERBOT_TOKEN"]:
@@ -113,6 +131,28 @@ class DockerWorkerManager:
 
 
     
+    def running_workers(self, client: Optional[docker.DockerClient] = None) -> int:
+        """Число запущенных контейнеров воркеров тенантов (по label gracehub.type)"""
+        client = client or docker.DockerClient(base_url=self.docker_host)
+        return len(client.containers.list(filters={"label": "gracehub.type=user-worker"}))
+
+    def _check_worker_slots(self, client: docker.DockerClient) -> None:
+        """
+        Слоты бюджета соединений под воркеров резервируются заранее
+        (DB_BUDGET_WORKER_REPLICAS): предупреждаем, если новый воркер в них не влезает.
+        """
+        try:
+            running = self.running_workers(client)
+        except Exception as e:
+            logger.warning(f"⚠️ Failed to count running workers: {e}")
+            return
+        slots = settings.DB_BUDGET_REPLICAS["worker"]
+        if running + 1 > slots:
+            logger.warning(
+                f"⚠️ DB budget: {running + 1} tenant workers with {slots} reserved slots "
+                f"(DB_BUDGET_WORKER_REPLICAS) — pools may exceed DB_CONNECTION_BUDGET"
+            )
+
     async def stop_worker(self, instance_id: str):
         """Останавливаем и удаляем worker контейнер"""
         try:
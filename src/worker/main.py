@@ -1,15 +1,19 @@
 # creator GraceHub Tg: @Gribson_Micro
 
 import asyncio
+import inspect
+import json
 import logging
 import os
+import signal
 import sys
-from collections import deque
+import time
+import weakref
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
 
-from aiogram import Bot, Dispatcher, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ChatType, ParseMode
 from aiogram.exceptions import TelegramBadRequest
@@ -17,19 +21,36 @@ from aiogram.filters import Command, CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import (
-    BufferedInputFile,
     CallbackQuery,
+    ErrorEvent,
+    FSInputFile,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
     Message,
     MessageEntity,
+    TelegramObject,
     Update,
+    User,
 )
+from cachetools import TTLCache
 
 from languages import LANGS
 from shared import settings
+from shared.antiflood import DistributedFloodCounter
+from shared.csv_export import DEFAULT_PART_MAX_BYTES, GzipCsvPartWriter
 from shared.database import MasterDatabase
-from shared.rate_limiter import BotRateLimiter
+from shared.fsm_storage import PostgresFSMStorage, TenantFSMStorage
+from shared.rate_limiter import (
+    BotRateLimiter,
+    OutboundQueueFull,
+    OutboundScheduler,
+    register_bot_limiter,
+)
+from shared.telegram_session import get_shared_session
 
 PROJECT_ROOT = Path(__file__).resolve().parents[2]  # /root/gracehub
 SRC_DIR = PROJECT_ROOT / "src"
@@ -39,6 +60,62 @@ if str(SRC_DIR) not in sys.path:
 logger = logging.getLogger("worker")
 
 
+# ====================== КЭШ КЛАВИАТУР ======================
+
+# Готовые клавиатуры: (язык, вид, флаги...) -> InlineKeyboardMarkup.
+# Клавиатуры и кнопки aiogram изменяемые, поэтому наружу отдаём копию образца:
+# правка у одного вызывающего не попадёт в меню других тенантов процесса.
+_KEYBOARD_CACHE: Dict[tuple, InlineKeyboardMarkup] = {}
+_KEYBOARD_CACHE_MAXSIZE = 512
+
+# Шаблоны клавиатур тикетов: ключ -> строки кнопок (text, callback_data c "{ticket_id}")
+_KeyboardTemplate = tuple
+
+
+def _cached_keyboard(
+    key: tuple, build: Callable[[], InlineKeyboardMarkup]
+) -> InlineKeyboardMarkup:
+    kb = _KEYBOARD_CACHE.get(key)
+    if kb is None:
+        if len(_KEYBOARD_CACHE) >= _KEYBOARD_CACHE_MAXSIZE:
+            _KEYBOARD_CACHE.clear()
+        kb = _KEYBOARD_CACHE[key] = build()
+    # копия без повторной валидации — кнопки образца уже проверены при build()
+    return InlineKeyboardMarkup.model_construct(
+        inline_keyboard=[[button.model_copy() for button in row] for row in kb.inline_keyboard]
+    )
+
+
+_KEYBOARD_TEMPLATES: Dict[tuple, _KeyboardTemplate] = {}
+
+
+def _render_keyboard_template(
+    key: tuple,
+    build: Callable[[], _KeyboardTemplate],
+    ticket_id: int,
+) -> InlineKeyboardMarkup:
+    """
+    Клавиатура по шаблону с подстановкой ticket_id. Тексты и раскладка уже
+    проверены при построении шаблона, поэтому объекты собираем без валидации.
+    """
+    template = _KEYBOARD_TEMPLATES.get(key)
+    if template is None:
+        template = _KEYBOARD_TEMPLATES[key] = build()
+
+    return InlineKeyboardMarkup.model_construct(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton.model_construct(
+                    text=text,
+                    callback_data=callback.format(ticket_id=ticket_id),
+                )
+                for text, callback in row
+            ]
+            for row in template
+        ]
+    )
+
+
 def setup_logging():
     """🔥 НОВЫЙ setup_logging - НЕ использует ENV токены!"""
     # 🔥 Парсим instance_id ИЗ HOSTNAME (даже при импорте)
@@ -99,7 +176,7 @@ async def run_worker():
     # 🔥 3. MasterDatabase - ОДНА попытка! (НЕ retry!)
     try:
         from shared.database import MasterDatabase
-        db = MasterDatabase(database_url)
+        db = MasterDatabase(database_url, role="worker")
         await db.init()
         logger.info("✅ Database + Cipher ready")
     except Exception as e:
@@ -133,8 +210,17 @@ async def run_worker():
     if hasattr(worker, 'start_webhook_server'):
         asyncio.create_task(worker.start_webhook_server())
     
-    # Infinite loop
-    await asyncio.Event().wait()
+    # До SIGTERM/SIGINT (docker stop), затем — отправка отложенного и закрытие пула
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info(f"🛑 Worker '{instance_id}' stopping...")
+        await worker.shutdown()
+        await db.close()
 
 
 class AdminStates(StatesGroup):
@@ -211,6 +297,27 @@ class GraceHubWorker:
     MAX_USER_TEXT = 4096
     MAX_DB_TEXT = 2000
 
+    # Кэш размеров файлов: file_unique_id -> file_size (размер файла в Telegram не меняется)
+    FILE_SIZE_CACHE_MAXSIZE = 5000
+    FILE_SIZE_CACHE_TTL = 6 * 3600
+
+    # Сколько сообщений подряд без ответа оператора пропускаем в тикет
+    SESSION_FLOOD_LIMIT = 3
+
+    # Альбомы: ждём остальные части группы, пока они приходят с паузой меньше окна
+    MEDIA_GROUP_WINDOW = 1.0
+    MEDIA_GROUP_MAX_ITEMS = 10
+
+    # Переименование тем тикетов: правки статуса/исполнителя внутри окна схлопываются в одну
+    TOPIC_TITLE_DEBOUNCE = 2.0
+
+    # getMe кэшируется надолго: username/id бота меняются только со сменой токена
+    BOT_IDENTITY_TTL = 24 * 3600
+
+    # Экспорт пользователей: строк за один fetch курсора и предел сжатой части файла
+    EXPORT_BATCH_SIZE = 2000
+    EXPORT_PART_MAX_BYTES = DEFAULT_PART_MAX_BYTES
+
     @staticmethod
     def _safe_trim(text: str, limit: int) -> str:
         if text is None:
@@ -219,6 +326,64 @@ class GraceHubWorker:
             return text
         return text[: limit - 1] + "…"
 
+    # Keyset-курсор в callback_data: "<микросекунды от эпохи>:<user_id>" (влезает в 64 байта)
+    _KEYSET_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+    @classmethod
+    def _encode_keyset(cls, ts: datetime, user_id: int) -> str:
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=timezone.utc)
+        return f"{(ts - cls._KEYSET_EPOCH) // timedelta(microseconds=1)}:{user_id}"
+
+    @classmethod
+    def _decode_keyset(cls, ts_part: str, user_id_part: str) -> Optional[tuple]:
+        try:
+            ts = cls._KEYSET_EPOCH + timedelta(microseconds=int(ts_part))
+            return ts, int(user_id_part)
+        except (ValueError, OverflowError):
+            return None
+
+    async def _fetch_keyset_page(
+        self,
+        table: str,
+        ts_column: str,
+        cursor: Optional[tuple],
+        direction: str,
+        limit: int,
+        extra_where: str = "",
+        extra_params: tuple = (),
+    ) -> tuple:
+        """
+        Одна страница списка (user_id, username, ts) по индексу (instance_id, ts DESC, user_id DESC).
+        direction "n" — строки после курсора, "p" — перед ним. Возвращает (строки в порядке DESC,
+        есть ли ещё строки в направлении движения).
+        """
+        params: List[Any] = [self.instance_id, *extra_params]
+        where = "instance_id = $1" + extra_where
+        if cursor is not None:
+            op = "<" if direction == "n" else ">"
+            where += (
+                " AND (" + ts_column + ", user_id) " + op
+                + " ($" + str(len(params) + 1) + ", $" + str(len(params) + 2) + ")"
+            )
+            params.extend(cursor)
+        order = "DESC" if direction == "n" else "ASC"
+        params.append(limit + 1)
+
+        sql = (  # nosec B608 — имена таблиц/колонок только из кода
+            "SELECT user_id, username, " + ts_column + " AS ts FROM " + table
+            + " WHERE " + where
+            + " ORDER BY " + ts_column + " " + order + ", user_id " + order
+            + " LIMIT $" + str(len(params))
+        )
+        rows = [dict(r) for r in await self.db.fetchall(sql, tuple(params))]
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if direction != "n":
+            rows.reverse()
+        return rows, has_more
+
     def __init__(self, instance_id: str, db: MasterDatabase, token: str = None):
         self.instance_id = instance_id
         self.db: MasterDatabase = db
@@ -227,9 +392,18 @@ class GraceHubWorker:
         self.token = token  # Может быть None
         self.bot = None
         self.bot_username = None
+        # кэш getMe: сам объект, токен, для которого он получен, и monotonic-срок жизни
+        self._me: Optional[User] = None
+        self._me_token: Optional[str] = None
+        self._me_expires_at: float = 0.0
         self.ratelimiter = None  
+        self.outbound: Optional[OutboundScheduler] = None
         
-        self.dp = Dispatcher()
+        # FSM в Postgres: состояние админских сценариев переживает рестарты
+        # и видно всем репликам queue-worker
+        self.fsm_storage = PostgresFSMStorage(self.db, self.instance_id)
+        # Хэндлеры общие на процесс, воркер подставляется через WorkerContextMiddleware
+        self.dp = get_shared_dispatcher()
         self.shutdown_event = asyncio.Event()
         self.lang_code = "ru"
         self.texts = LANGS[self.lang_code]
@@ -241,52 +415,123 @@ class GraceHubWorker:
         self.max_file_mb: int = 10
         self.max_file_bytes: int = self.max_file_mb * 1024 * 1024
 
-        self.user_msg_timestamps: dict[int, deque[datetime]] = {}
-        self.user_session_messages: Dict[int, int] = {}
+        # антифлуд: счётчики в Postgres, общие для всех реплик
+        self.flood_counter = DistributedFloodCounter(self.db, self.instance_id)
         self.ticket_keyboard_anchor: Dict[int, Dict[str, Any]] = {}
 
+        # --- кэш get_file() для проверки размеров вложений ---
+        self._file_size_cache: TTLCache = TTLCache(
+            maxsize=self.FILE_SIZE_CACHE_MAXSIZE, ttl=self.FILE_SIZE_CACHE_TTL
+        )
+        self._file_size_inflight: Dict[str, asyncio.Future] = {}
+
+        # --- буфер альбомов: media_group_id -> {"messages", "last_at", "task"} ---
+        # части уже подтверждены в очереди, поэтому flush-задачи учитываются и
+        # дожидаются в shutdown()
+        self._media_group_buffers: Dict[str, Dict[str, Any]] = {}
+        self._media_group_tasks: Set[asyncio.Task] = set()
+
+        # --- названия тем: последнее применённое хранится в tickets.topic_title (общее для
+        # всех реплик); отложенные переименования: ticket_id -> {"ticket", "last_at", "task"}
+        self._topic_title_pending: Dict[int, Dict[str, Any]] = {}
+
+        # хвосты форвардов в OpenChat (запись в БД после отправки из лейна)
+        self._forward_tails: Set[asyncio.Task] = set()
+
+        # фоновая выгрузка пользователей (одна на воркер)
+        self._export_task: Optional[asyncio.Task] = None
+
+        # разбивка времени холодного старта (мс), заполняется в initialize()
+        self.cold_start_timings: Dict[str, float] = {}
+
+
+    # Дефолты worker_settings, которые дописываются при первом старте инстанса
+    DEFAULT_WORKER_SETTINGS: Dict[str, str] = {
+        "admin_user_id": "0",
+        "privacy_mode_enabled": "False",
+        "lang_code": "ru",
+        "rating_enabled": "True",
+    }
 
     async def initialize(self) -> None:
         """
-        🔥 Полная асинхронная инициализация с GRACEFUL FALLBACK
+        🔥 Полная асинхронная инициализация с GRACEFUL FALLBACK.
+        Инстанс, токен и настройки приходят одним запросом (get_worker_bootstrap).
         """
         logger.info(f"🔄 Initializing worker for instance {self.instance_id}")
-        
-        # 🔥 1. Проверяем инстанс (с fallback!)
-        instance = await self.db.get_instance(self.instance_id)
-        if not instance:
+        t_start = time.perf_counter()
+        timings: Dict[str, float] = {}
+
+        # 🔥 1. Инстанс + токен + настройки одним запросом
+        bootstrap = await self.db.get_worker_bootstrap(
+            self.instance_id, self.DEFAULT_WORKER_SETTINGS
+        )
+        timings["db"] = time.perf_counter() - t_start
+
+        if bootstrap:
+            instance = bootstrap["instance"]
+            self.token = bootstrap["token"]
+            self._apply_settings_snapshot(bootstrap["settings"])
+        else:
             logger.warning(f"⚠️ Instance '{self.instance_id}' NOT FOUND in DB - MINIMAL MODE")
             # 🔥 Создаём fake instance для минимальной работы
             instance = type('FakeInstance', (), {
                 'bot_username': 'unknown-bot',
                 'instance_id': self.instance_id
             })()
-        
-        # 🔥 2. Загружаем токен (может не быть)
-        self.token = await self.db.get_decrypted_token(self.instance_id)
+            # 🔥 Токен может быть передан снаружи (или лежать в БД без инстанса)
+            self.token = self.token or await self.db.get_decrypted_token(self.instance_id)
+            timings["db"] = time.perf_counter() - t_start
+
         if not self.token:
             logger.error(f"❌ FATAL: No token for {self.instance_id} - cannot initialize bot!")
             return  # Graceful fallback
         
         logger.info(f"✅ Token loaded for @{instance.bot_username}")
         
-        # 🔥 3. Создаём Bot и ratelimiter
+        # 🔥 2. Создаём Bot и ratelimiter
+        t_phase = time.perf_counter()
         self.bot = Bot(
             token=self.token,
+            session=get_shared_session(),
             default=DefaultBotProperties(parse_mode=ParseMode.HTML),
         )
-        self.ratelimiter = BotRateLimiter(self.token)
-        self.bot_username = instance.bot_username
-        
-        # 🔥 4. Регистрируем handlers
+        self.ratelimiter = BotRateLimiter(self.token, db=self.db)
+        register_bot_limiter(self.bot.id, self.ratelimiter)
+        self.outbound = OutboundScheduler(self.ratelimiter, name=self.instance_id)
+        # username из bot_instances (в minimal-режиме неизвестен — спросим getMe при надобности)
+        self.bot_username = instance.bot_username if bootstrap else None
+        if self._me_token != self.token:
+            self._me = None
+        timings["bot"] = time.perf_counter() - t_phase
+
+        # 🔥 3. Регистрируем воркер в общем dispatcher
+        t_phase = time.perf_counter()
         self.register_handlers()
-        
-        # 🔥 5. Существующий код
-        await self.init_database()
-        await self.load_language()
-        
+        timings["handlers"] = time.perf_counter() - t_phase
+
+        timings["total"] = time.perf_counter() - t_start
+        self.cold_start_timings = {k: round(v * 1000, 2) for k, v in timings.items()}
+
+        logger.info(
+            "⏱️ Cold start %s: db=%.1fms bot=%.1fms handlers=%.1fms total=%.1fms",
+            self.instance_id,
+            self.cold_start_timings["db"],
+            self.cold_start_timings["bot"],
+            self.cold_start_timings["handlers"],
+            self.cold_start_timings["total"],
+        )
         logger.info(f"✅ Worker FULLY initialized: @{self.bot_username}")
 
+    def _apply_settings_snapshot(self, values: Dict[str, str]) -> None:
+        """
+        Применяет снимок worker_settings, полученный при старте (язык и т.п.).
+        """
+        code = values.get("lang_code") or "ru"
+        if code not in LANGS:
+            code = "ru"
+        self.lang_code = code
+        self.texts = LANGS[code]
 
     async def _is_attachment_too_big(self, message: Message) -> bool:
         await (
@@ -356,20 +601,20 @@ class GraceHubWorker:
         if not limit or limit <= 0:
             return False
 
-        now = datetime.now(timezone.utc)
-        window = timedelta(seconds=60)
-
-        dq = self.user_msg_timestamps.get(userid)
-        if dq is None:
-            dq = deque()
-            self.user_msg_timestamps[userid] = dq
-
-        while dq and now - dq[0] > window:
-            dq.popleft()
-
-        dq.append(now)
+        # счётчик общий для всех реплик воркера (см. shared.antiflood)
+        try:
+            return await self.flood_counter.hit(userid, limit)
+        except Exception as e:
+            # при сбое БД не режем пользователей — антифлуд не критичнее доставки
+            logger.warning("Antiflood counter failed for user %s: %s", userid, e)
+            return False
 
-        return len(dq) > limit
+    async def _try_acquire_session_slot(self, userid: int) -> bool:
+        try:
+            return await self.flood_counter.try_acquire_session(userid, self.SESSION_FLOOD_LIMIT)
+        except Exception as e:
+            logger.warning("Session flood counter failed for user %s: %s", userid, e)
+            return True
 
     async def load_language(self):
         code = await self.get_setting("lang_code") or "ru"
@@ -378,12 +623,77 @@ class GraceHubWorker:
         self.lang_code = code
         self.texts = LANGS[code]
 
-    async def _check_file_size(self, file_id: str) -> bool:
+    async def get_bot_identity(self) -> User:
+        """
+        getMe с кэшем на BOT_IDENTITY_TTL. Сбрасывается при смене токена.
+        """
+        if (
+            self._me is not None
+            and self._me_token == self.token
+            and time.monotonic() < self._me_expires_at
+        ):
+            return self._me
+
+        me = await self.bot.get_me()
+        self._me = me
+        self._me_token = self.token
+        self._me_expires_at = time.monotonic() + self.BOT_IDENTITY_TTL
+        if me.username:
+            self.bot_username = me.username
+        return me
+
+    async def get_bot_username(self) -> str:
+        """
+        Username бота для текстов: сохранённый в bot_instances или из кэша getMe.
+        """
+        if self.bot_username:
+            return self.bot_username
+        me = await self.get_bot_identity()
+        return me.username or "bot"
+
+    async def _get_file_size(self, file_id: str, file_unique_id: Optional[str] = None) -> int:
+        """
+        Размер файла через get_file() с кэшем по file_unique_id.
+        Параллельные запросы одного и того же файла ждут один общий вызов Telegram API.
+        """
+        key = file_unique_id or file_id
+
+        cached = self._file_size_cache.get(key)
+        if cached is not None:
+            return cached
+
+        pending = self._file_size_inflight.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._file_size_inflight[key] = fut
+        try:
+            tg_file = await self.bot.get_file(file_id)
+            size = getattr(tg_file, "file_size", None) or 0
+            if size:
+                self._file_size_cache[key] = size
+            fut.set_result(size)
+            return size
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            # исключение пробрасывается вызывающему; помечаем как полученное для остальных
+            fut.exception()
+            raise
+        finally:
+            self._file_size_inflight.pop(key, None)
+
+    async def check_file_size(self, file_id: str, file_unique_id: Optional[str] = None) -> bool:
+        """
+        True => файл проходит лимит, False => файл больше лимита.
+        """
         # гарантируем, что лимит актуальный (с TTL)
         await self._refresh_limits_from_db()
 
-        tg_file = await self.bot.get_file(file_id)
-        size = getattr(tg_file, "file_size", None) or 0
+        size = await self._get_file_size(file_id, file_unique_id)
         return size <= self.max_file_bytes
 
     async def global_error_handler(self, exception: Exception) -> bool:
@@ -391,6 +701,11 @@ class GraceHubWorker:
         Глобальный обработчик ошибок aiogram.
         В error-middleware сюда прилетает только exception.
         """
+        # переполненный лейн отправки: апдейт не подтверждаем — process_update пробросит дальше
+        exc = getattr(exception, "exception", exception)
+        if isinstance(exc, OutboundQueueFull):
+            raise exc
+
         user_id = None
         update = getattr(exception, "update", None)
 
@@ -418,19 +733,12 @@ class GraceHubWorker:
     async def get_operators_keyboard(
         self,
         ticket_id: int,
-        page: int = 0,
+        cursor: Optional[tuple] = None,
+        direction: str = "n",
         per_page: int = 10,
     ) -> InlineKeyboardMarkup:
-        offset = page * per_page
-        rows = await self.db.fetchall(
-            """
-            SELECT user_id, username, last_seen
-            FROM operators
-            WHERE instance_id = $1
-            ORDER BY last_seen DESC
-            LIMIT $2 OFFSET $3
-            """,
-            (self.instance_id, per_page, offset),
+        rows, has_more = await self._fetch_keyset_page(
+            "operators", "last_seen", cursor, direction, per_page
         )
 
         buttons: List[List[InlineKeyboardButton]] = []
@@ -451,6 +759,23 @@ class GraceHubWorker:
         if not buttons:
             return InlineKeyboardMarkup(inline_keyboard=[])
 
+        # Листание: курсор — первый/последний оператор страницы
+        nav_row: List[InlineKeyboardButton] = []
+        has_prev = cursor is not None and (direction == "n" or has_more)
+        has_next = has_more if direction == "n" else True
+        if has_prev:
+            first = self._encode_keyset(rows[0]["ts"], rows[0]["user_id"])
+            nav_row.append(
+                InlineKeyboardButton(text="⬅️", callback_data=f"ticket:ap:{ticket_id}:p:{first}")
+            )
+        if has_next:
+            last = self._encode_keyset(rows[-1]["ts"], rows[-1]["user_id"])
+            nav_row.append(
+                InlineKeyboardButton(text="➡️", callback_data=f"ticket:ap:{ticket_id}:n:{last}")
+            )
+        if nav_row:
+            buttons.append(nav_row)
+
         # Отмена
         buttons.append(
             [
@@ -463,115 +788,70 @@ class GraceHubWorker:
 
         return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-    async def init_database(self) -> None:
-        """Инициализация дефолтных настроек только для СУЩЕСТВУЮЩИХ инстансов"""
-        
-        logger.info(f"🔍 Checking instance '{self.instance_id}'...")
-        
-        # 🔥 ПРАВИЛЬНЫЙ PostgreSQL asyncpg синтаксис!
-        try:
-            instance_exists = await self.db.fetchone(
-                "SELECT 1 FROM bot_instances WHERE instance_id = $1 LIMIT 1",  
-                (self.instance_id,)
-            )
-        except Exception as e:
-            logger.error(f"❌ DB check failed: {e}")
-            instance_exists = None
-        
-        if not instance_exists:
-            logger.warning(f"⚠️  Instance '{self.instance_id}' NOT FOUND - skipping settings")
-            await self.load_language()
-            logger.info("✅ Worker ready (minimal mode)")
-            return
-        
-        logger.info(f"✅ Instance '{self.instance_id}' OK - init settings...")
-        
-        # Безопасная инициализация настроек
-        try:
-            settings_defaults = {
-                "admin_user_id": "0",
-                "privacy_mode_enabled": "False",
-                "lang_code": "ru",
-                "rating_enabled": "True"
-            }
-            
-            for key, default_value in settings_defaults.items():
-                current = await self.get_setting(key)
-                if current is None:
-                    await self.set_setting(key, default_value)
-                    logger.info(f"Set default {key}={default_value}")
-            
-            await self.load_language()
-            logger.info(f"✅ Worker DB FULLY initialized: {self.instance_id}")
-            
-        except Exception as e:
-            logger.error(f"❌ Settings init failed: {e}")
-            logger.info("Worker continues in minimal mode")
-        
-        logger.info(f"✅ Worker READY: {self.instance_id}")
+    # Standalone-режим: без NOTIFY (обрыв соединения) перепроверяем очередь команд раз в N секунд
+    BOT_COMMANDS_FALLBACK_SECONDS = 30
 
-        
     async def process_bot_commands_loop(self):
         """
-        Фоновая задача: проверяет очередь команд от API и выполняет их.
+        Фоновая задача standalone-воркера: выполняет команды от API по LISTEN/NOTIFY.
+        Запрос в БД — только по уведомлению (или раз в BOT_COMMANDS_FALLBACK_SECONDS).
+        В queue-режиме команды разбирает queue_worker.
         """
         logger.info(f"🔄 [Instance {self.instance_id}] Bot commands processor started")
-        
-        while True:
-            try:
-                # ИСПРАВЛЕНО: параметр в кортеже
-                commands = await self.db.fetchall(
-                    """
-                    SELECT id, command, payload
-                    FROM bot_commands
-                    WHERE instance_id = $1 AND status = 'pending'
-                    ORDER BY created_at ASC
-                    LIMIT 10
-                    """,
-                    (self.instance_id,)  # ← КОРТЕЖ!
-                )
-                
-                for cmd in commands:
-                    cmd_id = cmd['id']
-                    command = cmd['command']
-                    payload = json.loads(cmd['payload']) if cmd['payload'] else {}
-                    
-                    try:
-                        await self.execute_bot_command(command, payload)
-                        
-                        # ИСПРАВЛЕНО: параметр в кортеже
-                        await self.db.execute(
-                            """
-                            UPDATE bot_commands
-                            SET status = 'completed', completed_at = NOW()
-                            WHERE id = $1
-                            """,
-                            (cmd_id,)  # ← КОРТЕЖ!
-                        )
-                        
-                        logger.info(f"✅ [Instance {self.instance_id}] Command '{command}' executed (id={cmd_id})")
-                        
-                    except Exception as e:
-                        logger.error(f"❌ [Instance {self.instance_id}] Command '{command}' failed (id={cmd_id}): {e}")
-                        
-                        # ИСПРАВЛЕНО: оба параметра в кортеже
-                        await self.db.execute(
-                            """
-                            UPDATE bot_commands
-                            SET status = 'failed', error = $1
-                            WHERE id = $2
-                            """,
-                            (str(e)[:500], cmd_id)  # ← КОРТЕЖ!
+
+        wakeup = asyncio.Event()
+        wakeup.set()  # при старте разбираем то, что накопилось
+
+        def on_notify(connection, pid, channel, payload):
+            if payload == self.instance_id:
+                wakeup.set()
+
+        # выделенное LISTEN-соединение процесса; без него — перепроверка по таймауту
+        await self.db.listen("bot_command_channel", on_notify)
+
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(
+                        wakeup.wait(), timeout=self.BOT_COMMANDS_FALLBACK_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                wakeup.clear()
+
+                try:
+                    while True:
+                        commands = await self.db.pick_bot_commands(
+                            f"standalone:{os.getpid()}", instance_id=self.instance_id
                         )
-                
-                await asyncio.sleep(2)
-                
-            except Exception as e:
-                logger.error(f"❌ [Instance {self.instance_id}] Command loop error: {e}")
-                await asyncio.sleep(5)
+                        if not commands:
+                            break
+                        for cmd in commands:
+                            await self.run_bot_command(cmd)
+                except Exception as e:
+                    logger.error(f"❌ [Instance {self.instance_id}] Command loop error: {e}")
+                    await asyncio.sleep(5)
+        finally:
+            await self.db.unlisten("bot_command_channel", on_notify)
 
+    async def run_bot_command(self, cmd: Dict[str, Any]) -> None:
+        """
+        Выполняет заклейменную команду из bot_commands и отмечает результат.
+        """
+        cmd_id = cmd["id"]
+        command = cmd["command"]
+        try:
+            payload = cmd["payload"] or {}
+            if isinstance(payload, str):
+                payload = json.loads(payload)
+
+            await self.execute_bot_command(command, payload)
+            await self.db.complete_bot_command(cmd_id)
+            logger.info(f"✅ [Instance {self.instance_id}] Command '{command}' executed (id={cmd_id})")
+        except Exception as e:
+            logger.error(f"❌ [Instance {self.instance_id}] Command '{command}' failed (id={cmd_id}): {e}")
+            await self.db.fail_bot_command(cmd_id, str(e))
 
-    
     async def execute_bot_command(self, command: str, payload: dict):
         """Выполняет команду от API"""
         
@@ -581,11 +861,68 @@ class GraceHubWorker:
         elif command == 'close_ticket':
             ticket_id = payload.get('ticket_id')
             if ticket_id:
-                await self.close_ticket(ticket_id)
+                await self.close_ticket(int(ticket_id))
+
+        elif command == 'tickets_autoclosed':
+            ticket_ids = [int(t) for t in payload.get('ticket_ids') or ()]
+            if ticket_ids:
+                await self.notify_tickets_closed(ticket_ids)
         
         else:
             logger.warning(f"⚠️ [Instance {self.instance_id}] Unknown command: {command}")
     
+    async def close_ticket(self, ticket_id: int) -> None:
+        """Закрывает тикет по команде из Mini App (статус, тема, запрос оценки)."""
+        await self.set_ticket_status(ticket_id, "closed")
+
+    async def notify_tickets_closed(self, ticket_ids: List[int]) -> None:
+        """
+        Тикеты уже закрыты мастером (автозакрытие): обновляем темы и просим оценку.
+        Ничего не ждём — отправки встают в лейны OutboundScheduler и идут под лимитами
+        бота, не задерживая разбор остальных команд.
+        """
+        rows = await self.db.fetchall(
+            """
+            SELECT *
+            FROM tickets
+            WHERE instance_id = $1 AND id = ANY($2::bigint[]) AND status = 'closed'
+            """,
+            (self.instance_id, ticket_ids),
+        )
+        rating_enabled = (await self.get_setting("rating_enabled")) == "True"
+
+        for row in rows:
+            ticket = dict(row)
+            await self.update_ticket_topic_title(ticket)
+
+            user_id = ticket.get("user_id")
+            if not rating_enabled or not user_id:
+                continue
+
+            def send_rating(user_id=user_id, ticket_id=ticket["id"]):
+                return self._send_safe_message(
+                    chat_id=user_id,
+                    text=self.texts.ticket_closed_rating_request,
+                    reply_markup=self.get_rating_keyboard(ticket_id),
+                )
+
+            if self.outbound is not None:
+                try:
+                    self.outbound.submit(user_id, send_rating)
+                except OutboundQueueFull:
+                    continue  # уже залогировано планировщиком
+            else:
+                try:
+                    await send_rating()
+                except Exception as e:
+                    logger.error(
+                        "Failed to send rating request for ticket %s: %s", ticket["id"], e
+                    )
+
+        logger.info(
+            f"🔒 [Instance {self.instance_id}] Auto-closed tickets notified: {len(rows)}"
+        )
+
     async def handle_create_operator_topic(self, payload: dict):
         """
         Создает топик в личном чате оператора с историей тикета.
@@ -599,6 +936,13 @@ class GraceHubWorker:
         if not ticket_id or not operator_id:
             logger.error(f"❌ Invalid payload for create_operator_topic: {payload}")
             return
+
+        if not history and user_id:
+            # история не пришла в команде — берём из messages (индекс по ленте пользователя)
+            try:
+                history = await self.db.get_user_messages(self.instance_id, int(user_id), limit=50)
+            except Exception as e:
+                logger.warning(f"⚠️ Failed to load history for ticket #{ticket_id}: {e}")
         
         logger.info(f"🎫 [Instance {self.instance_id}] Creating topic for ticket #{ticket_id}, operator {operator_id}")
         
@@ -654,9 +998,10 @@ class GraceHubWorker:
             lines.append(f"_...показаны последние {limit} из {len(messages)} сообщений_\n")
         
         for msg in recent:
-            direction_emoji = "👤" if msg.get('direction') == 'usertoopenchat' else "👨‍💼"
-            direction_text = "Клиент" if msg.get('direction') == 'usertoopenchat' else "Оператор"
-            content = msg.get('content', '_медиа_')
+            from_user = msg.get('direction') in ('usertoopenchat', 'user_to_openchat')
+            direction_emoji = "👤" if from_user else "👨‍💼"
+            direction_text = "Клиент" if from_user else "Оператор"
+            content = msg.get('content') or '_медиа_'
             
             # Обрезаем длинные сообщения
             if len(content) > 200:
@@ -671,14 +1016,11 @@ class GraceHubWorker:
         Клавиатура для оценки работы специалиста.
         """
         emojis = ["👎🏻", "😑", "😊", "👍🏻", "🥳"]
-        buttons = [
-            InlineKeyboardButton(
-                text=e,
-                callback_data=f"rating:{ticket_id}:{e}",
-            )
-            for e in emojis
-        ]
-        return InlineKeyboardMarkup(inline_keyboard=[buttons])
+        return _render_keyboard_template(
+            ("rating",),
+            lambda: ((tuple((e, "rating:{ticket_id}:" + e) for e in emojis)),),
+            ticket_id,
+        )
 
     # ====================== УТИЛИТЫ ======================
     async def handle_language_callback(self, cb: CallbackQuery, state: FSMContext) -> None:
@@ -768,8 +1110,8 @@ class GraceHubWorker:
         if not message.forum_topic_edited:
             return
 
-        me = await self.bot.get_me()
-        if not message.from_user or message.from_user.id != me.id:
+        # id бота зашит в токене — сеть не нужна
+        if not message.from_user or message.from_user.id != self.bot.id:
             # Не наше системное сообщение — не трогаем
             return
 
@@ -801,6 +1143,17 @@ class GraceHubWorker:
         )
         return row["value"] if row else None
 
+    async def get_settings(self, keys: tuple) -> Dict[str, str]:
+        rows = await self.db.fetchall(
+            """
+            SELECT key, value
+            FROM worker_settings
+            WHERE instance_id = $1 AND key = ANY($2::text[])
+            """,
+            (self.instance_id, list(keys)),
+        )
+        return {r["key"]: r["value"] for r in rows}
+
     async def set_setting(self, key: str, value: str) -> None:
         await self.db.execute(
             """
@@ -813,9 +1166,13 @@ class GraceHubWorker:
         )
 
     async def get_openchat_settings(self) -> Dict:
+        chat_id = int((await self.get_setting("general_panel_chat_id")) or 0) or 0
+        if chat_id and self.ratelimiter is not None:
+            # в OpenChat-группу пишут лейны всех реплик — её лимит общий, через БД
+            self.ratelimiter.share_chat(chat_id)
         return {
             "enabled": (await self.get_setting("openchat_enabled")) == "True",
-            "chat_id": int((await self.get_setting("general_panel_chat_id")) or 0) or 0,
+            "chat_id": chat_id,
             "username": (await self.get_setting("openchat_username")) or "",
         }
 
@@ -858,28 +1215,102 @@ class GraceHubWorker:
 
         return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+    async def count_blacklist(self) -> int:
+        row = await self.db.fetchone(
+            "SELECT COUNT(*) AS cnt FROM blacklist WHERE instance_id = $1",
+            (self.instance_id,),
+        )
+        return int(row["cnt"]) if row else 0
+
+    async def get_blacklist_page(
+        self,
+        cursor: Optional[tuple] = None,
+        direction: str = "n",
+        per_page: int = 10,
+        query: Optional[str] = None,
+    ) -> tuple:
+        """
+        Страница чёрного списка по keyset-курсору (added_at, user_id).
+        query — подстрока username (без учёта регистра).
+        """
+        if not query:
+            return await self._fetch_keyset_page(
+                "blacklist", "added_at", cursor, direction, per_page
+            )
+
+        pattern = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return await self._fetch_keyset_page(
+            "blacklist",
+            "added_at",
+            cursor,
+            direction,
+            per_page,
+            extra_where=" AND lower(username) LIKE $2",
+            extra_params=(f"%{pattern.lower()}%",),
+        )
+
+    def _blacklist_nav_row(
+        self,
+        prefix: str,
+        rows: List[Dict[str, Any]],
+        page: int,
+        has_next: bool,
+    ) -> List[InlineKeyboardButton]:
+        nav_row: List[InlineKeyboardButton] = []
+        if page > 0:
+            first = self._encode_keyset(rows[0]["ts"], rows[0]["user_id"])
+            nav_row.append(
+                InlineKeyboardButton(
+                    text=self.texts.blacklist_prev_page_button,
+                    callback_data=f"{prefix}:p:{page - 1}:{first}",
+                )
+            )
+        if has_next:
+            last = self._encode_keyset(rows[-1]["ts"], rows[-1]["user_id"])
+            nav_row.append(
+                InlineKeyboardButton(
+                    text=self.texts.blacklist_next_page_button,
+                    callback_data=f"{prefix}:n:{page + 1}:{last}",
+                )
+            )
+        return nav_row
+
     async def render_blacklist_page(
         self,
         cb: CallbackQuery,
         page: int = 0,
         per_page: int = 10,
+        cursor: Optional[tuple] = None,
+        direction: str = "n",
+        total: Optional[int] = None,
     ) -> None:
-        bl = await self.get_blacklist()
-        total = len(bl)
-
-        if total == 0:
+        """
+        Страница чёрного списка. Курсор и общее число записей едут в callback_data
+        (bl_page:<total>:<n|p>:<page>:<курсор>), поэтому листание — один индексный запрос.
+        """
+        if total is None or cursor is None:
+            page, cursor, direction = 0, None, "n"
+            total = await self.count_blacklist()
+
+        rows: List[Dict[str, Any]] = []
+        has_more = False
+        if total:
+            rows, has_more = await self.get_blacklist_page(cursor, direction, per_page)
+            if not rows and cursor is not None:
+                # курсор устарел (записи удалили) — начинаем сначала
+                page, direction = 0, "n"
+                total = await self.count_blacklist()
+                rows, has_more = await self.get_blacklist_page(None, direction, per_page)
+
+        if not rows:
             text = self.texts.blacklist_list_empty
             text = self._safe_trim(text, self.MAX_USER_TEXT)
             kb = self.get_blacklist_menu()
             await cb.message.edit_text(text, reply_markup=kb)
             return
 
-        start = page * per_page
-        end = start + per_page
-        page_items = bl[start:end]
-
         lines: list[str] = []
-        for u in page_items:
+        for u in rows:
             label = f"@{u['username']}" if u["username"] else ""
             lines.append(f"<code>{u['user_id']}</code> {label}")
 
@@ -888,28 +1319,15 @@ class GraceHubWorker:
             self.texts.blacklist_list_title
             + "\n".join(lines)
             + self.texts.blacklist_page_suffix.format(
-                current=page + 1,
+                current=min(page + 1, total_pages),
                 total=total_pages,
             )
         )
 
         text = self._safe_trim(text, self.MAX_USER_TEXT)
 
-        nav_row: list[InlineKeyboardButton] = []
-        if page > 0:
-            nav_row.append(
-                InlineKeyboardButton(
-                    text=self.texts.blacklist_prev_page_button,
-                    callback_data=f"bl_page:{page - 1}",
-                )
-            )
-        if end < total:
-            nav_row.append(
-                InlineKeyboardButton(
-                    text=self.texts.blacklist_next_page_button,
-                    callback_data=f"bl_page:{page + 1}",
-                )
-            )
+        has_next = has_more if direction == "n" else True
+        nav_row = self._blacklist_nav_row(f"bl_page:{total}", rows, page, has_next)
 
         kb_rows: list[list[InlineKeyboardButton]] = []
         if nav_row:
@@ -935,6 +1353,38 @@ class GraceHubWorker:
         kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
         await cb.message.edit_text(text, reply_markup=kb)
 
+    async def build_blacklist_search_page(
+        self,
+        query: str,
+        page: int = 0,
+        per_page: int = 10,
+        cursor: Optional[tuple] = None,
+        direction: str = "n",
+    ) -> Optional[tuple]:
+        """
+        Страница результатов поиска по чёрному списку: (text, keyboard) или None, если пусто.
+        Сам запрос хранится в FSM (blacklist_query), в callback_data — только курсор.
+        """
+        rows, has_more = await self.get_blacklist_page(cursor, direction, per_page, query=query)
+        if not rows:
+            return None
+
+        lines = []
+        for u in rows:
+            label = f"@{u['username']}" if u["username"] else ""
+            lines.append(f"<code>{u['user_id']}</code> {label}")
+
+        text = f'🔍 Результаты поиска по "{query}":\n' + "\n".join(lines)
+        text = self._safe_trim(text, self.MAX_USER_TEXT)
+
+        has_next = has_more if direction == "n" else True
+        nav_row = self._blacklist_nav_row("bl_sr", rows, page, has_next)
+
+        kb = self.get_blacklist_menu()
+        if nav_row:
+            kb = InlineKeyboardMarkup(inline_keyboard=[nav_row, *kb.inline_keyboard])
+        return text, kb
+
     async def is_user_blacklisted(self, user_id: int) -> bool:
         row = await self.db.fetchone(
             """
@@ -1122,22 +1572,30 @@ class GraceHubWorker:
         )
 
     async def get_admin_menu(self) -> InlineKeyboardMarkup:
-        # Автоответы
-        autoreply_enabled = await self.get_setting("autoreply_enabled")
-        autoreply_on = autoreply_enabled == "True"
-        autoreply_label = f"{self.texts.menu_autoreply}: {'🟢' if autoreply_on else '🔴'}"
-
-        # Privacy Mode
-        privacy_on = await self.is_privacy_enabled()
-        privacy_label = f"Privacy Mode: {'🟢' if privacy_on else '🔴'}"
+        # все флаги меню — одним запросом; сама клавиатура берётся из кэша
+        values = await self.get_settings(
+            ("autoreply_enabled", "privacy_mode_enabled", "rating_enabled", "lang_code")
+        )
+        autoreply_on = values.get("autoreply_enabled") == "True"
+        privacy_on = values.get("privacy_mode_enabled") == "True"
+        rating_on = values.get("rating_enabled") == "True"
+        lang_code = values.get("lang_code") or "ru"
+
+        return _cached_keyboard(
+            ("admin_menu", self.lang_code, autoreply_on, privacy_on, rating_on, lang_code),
+            lambda: self._build_admin_menu(autoreply_on, privacy_on, rating_on, lang_code),
+        )
 
-        # Фидбек при закрытии тикета
-        rating_enabled = await self.get_setting("rating_enabled")
-        rating_on = rating_enabled == "True"
+    def _build_admin_menu(
+        self,
+        autoreply_on: bool,
+        privacy_on: bool,
+        rating_on: bool,
+        lang_code: str,
+    ) -> InlineKeyboardMarkup:
+        autoreply_label = f"{self.texts.menu_autoreply}: {'🟢' if autoreply_on else '🔴'}"
+        privacy_label = f"Privacy Mode: {'🟢' if privacy_on else '🔴'}"
         rating_label = f"{self.texts.menu_rating}: {'🟢' if rating_on else '🔴'}"
-
-        # Язык
-        lang_code = await self.get_setting("lang_code") or "ru"
         lang_label = f"{self.texts.menu_language}: {lang_code.upper()}"
 
         return InlineKeyboardMarkup(
@@ -1188,6 +1646,9 @@ class GraceHubWorker:
         )
 
     def get_blacklist_menu(self) -> InlineKeyboardMarkup:
+        return _cached_keyboard(("blacklist_menu", self.lang_code), self._build_blacklist_menu)
+
+    def _build_blacklist_menu(self) -> InlineKeyboardMarkup:
         return InlineKeyboardMarkup(
             inline_keyboard=[
                 [
@@ -1252,6 +1713,71 @@ class GraceHubWorker:
         )
         return int(row["target_user_id"]) if row else None
 
+    # ====================== ЭКСПОРТ ======================
+
+    async def export_users(self, chat_id: int) -> None:
+        """
+        Выгружает пользователей инстанса в CSV: серверный курсор -> gzip во временные
+        файлы (частями до EXPORT_PART_MAX_BYTES) -> документы в чат.
+        """
+        writer = GzipCsvPartWriter(
+            ["user_id", "username", "first_seen"],
+            prefix=f"users_{self.instance_id}",
+            part_max_bytes=self.EXPORT_PART_MAX_BYTES,
+        )
+        try:
+            async for batch in self.db.iterate(
+                """
+                SELECT user_id, MAX(username) AS username, MIN(created_at) AS first_seen
+                FROM tickets
+                WHERE instance_id = $1
+                GROUP BY user_id
+                ORDER BY first_seen ASC
+                """,
+                (self.instance_id,),
+                prefetch=self.EXPORT_BATCH_SIZE,
+                read_only=True,  # отчёт может отставать на секунды — разгружаем primary
+            ):
+                rows = [
+                    (
+                        r["user_id"],
+                        r["username"] or "",
+                        r["first_seen"].isoformat()
+                        if isinstance(r["first_seen"], datetime)
+                        else r["first_seen"],
+                    )
+                    for r in batch
+                ]
+                await asyncio.to_thread(writer.write_rows, rows)
+
+            paths = await asyncio.to_thread(writer.finish)
+            if not writer.rows_written:
+                await self.bot.send_message(chat_id, self.texts.export_no_users)
+                return
+
+            for idx, path in enumerate(paths, start=1):
+                caption = self.texts.export_users_caption
+                filename = "users_export.csv.gz"
+                if len(paths) > 1:
+                    caption = f"{caption} {idx}/{len(paths)}"
+                    filename = f"users_export_part{idx}.csv.gz"
+                await self.bot.send_document(
+                    chat_id,
+                    document=FSInputFile(path, filename=filename),
+                    caption=caption,
+                )
+
+            logger.info(
+                "📋 Users export for %s: %s rows, %s file(s)",
+                self.instance_id,
+                writer.rows_written,
+                len(paths),
+            )
+        except Exception:
+            logger.exception("Users export failed for instance %s", self.instance_id)
+        finally:
+            await asyncio.to_thread(writer.cleanup)
+
     # ====================== ТИКЕТЫ / OPENCHAT ======================
 
     def _format_ticket_title(self, ticket: Dict[str, Any]) -> str:
@@ -1272,25 +1798,98 @@ class GraceHubWorker:
 
     async def update_ticket_topic_title(self, ticket: Dict[str, Any]) -> None:
         """
-        Обновляет название форумной темы по данным тикета.
+        Планирует обновление названия форумной темы по данным тикета.
+
+        Правки одного тикета внутри TOPIC_TITLE_DEBOUNCE схлопываются: после паузы
+        применяется только последнее состояние, и только если название изменилось.
+        """
+        if not ticket.get("thread_id") or not ticket.get("chat_id"):
+            return
+
+        loop = asyncio.get_running_loop()
+        ticket_id = ticket.get("id")
+
+        pending = self._topic_title_pending.get(ticket_id)
+        if pending is None:
+            pending = {"ticket": ticket, "last_at": loop.time(), "task": None}
+            self._topic_title_pending[ticket_id] = pending
+            pending["task"] = asyncio.create_task(self._apply_topic_title_later(ticket_id))
+            return
+
+        pending["ticket"] = ticket
+        pending["last_at"] = loop.time()
+
+    async def _apply_topic_title_later(self, ticket_id: int) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            pending = self._topic_title_pending.get(ticket_id)
+            if pending is None:
+                return
+            delay = pending["last_at"] + self.TOPIC_TITLE_DEBOUNCE - loop.time()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+
+        pending = self._topic_title_pending.pop(ticket_id, None)
+        if not pending:
+            return
+
+        ticket = pending["ticket"]
+        chat_id = ticket["chat_id"]
+        if self.outbound is not None:
+            try:
+                self.outbound.submit(chat_id, lambda: self._apply_topic_title(ticket))
+            except OutboundQueueFull:
+                pass  # уже залогировано планировщиком; название поправит следующее обновление
+        else:
+            await self._apply_topic_title(ticket)
+
+    async def _apply_topic_title(self, ticket: Dict[str, Any]) -> None:
         """
-        thread_id = ticket.get("thread_id") 
+        Переименовывает тему, пропуская no-op: название совпадает с последним применённым.
+        Последнее применённое название — в tickets.topic_title, а не в памяти процесса:
+        тикет между правками мог переименовать воркер другой реплики.
+        """
+        ticket_id = ticket.get("id")
+        thread_id = ticket.get("thread_id")
         chat_id = ticket.get("chat_id")
-        if not thread_id or not chat_id:
+        title = self._format_ticket_title(ticket)
+
+        row = await self.db.fetchone(
+            """
+            SELECT topic_title
+            FROM tickets
+            WHERE instance_id = $1 AND id = $2 AND thread_id = $3
+            """,
+            (self.instance_id, ticket_id, thread_id),
+        )
+        if row and row["topic_title"] == title:
             return
 
         try:
             await self.bot.edit_forum_topic(
                 chat_id=chat_id,
                 message_thread_id=thread_id,
-                name=self._format_ticket_title(ticket),
+                name=title,
             )
+        except TelegramBadRequest as e:
+            # TOPIC_NOT_MODIFIED — название уже такое, запоминаем его
+            if "not modified" not in str(e).lower():
+                logger.error("Failed to update topic title for ticket %s: %s", ticket_id, e)
+                return
         except Exception as e:
-            logger.error(
-                "Failed to update topic title for ticket %s: %s",
-                ticket.get("id"),
-                e,
-            )
+            logger.error("Failed to update topic title for ticket %s: %s", ticket_id, e)
+            return
+
+        await self.db.execute(
+            """
+            UPDATE tickets
+            SET topic_title = $1
+            WHERE instance_id = $2 AND id = $3 AND thread_id = $4
+            """,
+            (title, self.instance_id, ticket_id, thread_id),
+        )
 
     async def fetch_ticket(self, ticket_id: int) -> Optional[Dict[str, Any]]:
         row = await self.db.fetchone(
@@ -1450,15 +2049,8 @@ class GraceHubWorker:
         can_close = status not in ("closed", "spam")
 
         if compact:
-            kb = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [
-                        InlineKeyboardButton(
-                            text="🖲",
-                            callback_data=f"ticket:menu:{ticket_id}",
-                        )
-                    ]
-                ]
+            kb = _render_keyboard_template(
+                ("ticket_compact",), lambda: ((("🖲", "ticket:menu:{ticket_id}"),),), ticket_id
             )
         else:
             kb = self._build_full_ticket_keyboard(
@@ -1532,50 +2124,65 @@ class GraceHubWorker:
         Для closed: 'Переоткрыть' + 'Свернуть'.
         Для обычного: Себе / Назначить / Спам / Закрыть + 'Свернуть'.
         """
-        buttons: List[List[InlineKeyboardButton]] = []
+        return _render_keyboard_template(
+            ("ticket_full", self.lang_code, can_close, is_spam, is_closed),
+            lambda: self._full_ticket_keyboard_template(
+                can_close, is_spam=is_spam, is_closed=is_closed
+            ),
+            ticket_id,
+        )
+
+    def _full_ticket_keyboard_template(
+        self,
+        can_close: bool,
+        *,
+        is_spam: bool = False,
+        is_closed: bool = False,
+    ) -> _KeyboardTemplate:
+        buttons: List[List[tuple]] = []
 
         if is_spam:
             buttons.append(
                 [
-                    InlineKeyboardButton(
-                        text=self.texts.ticket_btn_not_spam,
-                        callback_data=f"ticket:not_spam:{ticket_id}",
+                    (
+                        self.texts.ticket_btn_not_spam,
+                        "ticket:not_spam:{ticket_id}",
                     )
                 ]
             )
         elif is_closed:
             buttons.append(
                 [
-                    InlineKeyboardButton(
-                        text=self.texts.ticket_btn_reopen,
-                        callback_data=f"ticket:reopen:{ticket_id}",
+                    (
+                        self.texts.ticket_btn_reopen,
+                        "ticket:reopen:{ticket_id}",
                     )
                 ]
             )
         else:
             buttons.append(
                 [
-                    InlineKeyboardButton(
-                        text=self.texts.ticket_btn_self,
-                        callback_data=f"ticket:self:{ticket_id}",
+                    (
+                        self.texts.ticket_btn_self,
+                        "ticket:self:{ticket_id}",
                     ),
-                    InlineKeyboardButton(
-                        text=self.texts.ticket_btn_assign,
-                        callback_data=f"ticket:assign:{ticket_id}",
+                    (
+                        self.texts.ticket_btn_assign,
+                        "ticket:assign:{ticket_id}",
                     ),
                 ]
             )
-            row_spam: List[InlineKeyboardButton] = [
-                InlineKeyboardButton(
-                    text=self.texts.ticket_btn_spam,
-                    callback_data=f"ticket:spam:{ticket_id}",
+            row_spam: List[tuple] = [
+                (
+                    self.texts.ticket_btn_spam,
+                    "ticket:spam:{ticket_id}",
                 )
             ]
             if can_close:
                 row_spam.append(
-                    InlineKeyboardButton(
-                        text=self.texts.ticket_btn_close,
-                        callback_data=f"ticket:close:{ticket_id}",
+                    (
+                        self.texts.ticket_btn_close,
+                        "ticket:close:{ticket_id}",
                     )
                 )
             buttons.append(row_spam)
@@ -1583,14 +2190,14 @@ class GraceHubWorker:
         # Кнопка свернуть назад в 🖲
         buttons.append(
             [
-                InlineKeyboardButton(
-                    text=self.texts.ticket_btn_compact,
-                    callback_data=f"ticket:compact:{ticket_id}",
+                (
+                    self.texts.ticket_btn_compact,
+                    "ticket:compact:{ticket_id}",
                 )
             ]
         )
 
-        return InlineKeyboardMarkup(inline_keyboard=buttons)
+        return tuple(tuple(row) for row in buttons)
 
     async def fetch_ticket_by_chat(
         self,
@@ -1734,150 +2341,409 @@ class GraceHubWorker:
             text_content = self._safe_trim(message.caption, self.MAX_DB_TEXT)
 
         try:
-            await self.db.execute(
-                """
-                INSERT INTO messages (
-                    instance_id, chat_id, message_id, user_id, direction, content
-                )
-                VALUES ($1, $2, $3, $4, $5, $6)
-                """,
+            await self.db.store_messages(
+                [
+                    (
+                        self.instance_id,
+                        chat_id,
+                        message.message_id,
+                        user_id,
+                        "user_to_openchat",
+                        text_content,
+                    )
+                ]
+            )
+        except Exception as e:
+            logger.error(f"Failed to insert message into messages table: {e}")
+
+    async def store_forwarded_messages(
+        self, chat_id: int, messages: List[Message], user_id: int
+    ) -> None:
+        """
+        Пакетная версия store_forwarded_message (альбомы): одна вставка на группу.
+        """
+        rows = []
+        for msg in messages:
+            text_content = None
+            if msg.text:
+                text_content = self._safe_trim(msg.text, self.MAX_DB_TEXT)
+            elif msg.caption:
+                text_content = self._safe_trim(msg.caption, self.MAX_DB_TEXT)
+            rows.append(
                 (
                     self.instance_id,
                     chat_id,
-                    message.message_id,
+                    msg.message_id,
                     user_id,
                     "user_to_openchat",
                     text_content,
-                ),
+                )
             )
+
+        if not rows:
+            return
+
+        try:
+            await self.db.store_messages(rows)
         except Exception as e:
-            logger.error(f"Failed to insert message into messages table: {e}")
+            logger.error(f"Failed to insert album messages into messages table: {e}")
 
-    async def forward_to_openchat(self, message: Message) -> None:
+    async def _notify_billing_blocked(
+        self, message: Message, oc: Dict[str, Any], ticket: Dict[str, Any]
+    ) -> None:
         """
-        Отправка входящего сообщения пользователя в привязанный OpenChat (в его топик)
-        с сохранением маппинга для последующих реплеев администратора.
+        Сообщает пользователю и владельцам, что тикет не создан из-за биллинга.
         """
+        user_id = message.from_user.id
+        reason = ticket.get("billing_reason")
 
-        # Админа в OpenChat не форвардим
-        if message.from_user and await self.is_admin(message.from_user.id):
-            return
-
-        # Чёрный список: если пользователь заблокирован — игнорируем
-        if message.from_user and await self.is_user_blacklisted(message.from_user.id):
-            try:
-                await self._send_safe_message(
-                    chat_id=message.chat.id,
-                    text="❌ Вы заблокированы и не можете отправлять сообщения в поддержку.",
-                )
-            except Exception as e:
-                logger.error(f"Failed to notify blacklisted user {message.from_user.id}: {e}")
-            return
-
-        oc = await self.get_openchat_settings()
-        if not (oc["enabled"] and oc["chat_id"]):
-            return
+        if reason == "limit_reached":
+            user_text = getattr(
+                self.texts,
+                "billing_user_limit_reached_message",
+                "⚠️ Лимит обращений по текущему тарифу исчерпан. Попробуйте связаться с владельцами бота другими способами.",
+            )
+            owner_text = getattr(
+                self.texts,
+                "billing_owner_limit_reached_message",
+                "⚠️ Лимит тикетов по текущему тарифу исчерпан. Новые обращения не попадают в систему поддержки.",
+            )
+        elif reason == "expired":
+            user_text = getattr(
+                self.texts,
+                "billing_user_demo_expired_message",
+                "⏳ Тестовый тариф этого бота закончился, новые обращения временно не принимаются.",
+            )
+            owner_text = getattr(
+                self.texts,
+                "billing_owner_demo_expired_message",
+                "⏳ Демо‑период бота закончился. Новые тикеты не создаются.",
+            )
+        else:
+            user_text = getattr(
+                self.texts,
+                "billing_user_no_plan_message",
+                "⚠️ Для этого бота ещё не настроен тариф поддержки, новые обращения временно не принимаются.",
+            )
+            owner_text = getattr(
+                self.texts,
+                "billing_owner_no_plan_message",
+                "⚠️ Для этого бота не настроен активный тариф, обращения пользователей не доходят до системы поддержки.",
+            )
 
-        if not self.db:
-            return
+        # Сообщение пользователю
+        try:
+            await self._send_safe_message(
+                chat_id=message.chat.id,
+                text=user_text,
+            )
+        except Exception as e:
+            logger.error(
+                "Failed to notify user %s about billing limit (%s): %s",
+                user_id,
+                reason,
+                e,
+            )
 
-        user_id = message.from_user.id
-        username = message.from_user.username or ""
-        chat_id = oc["chat_id"]
+        # Сообщение владельцам/операторам в General‑топик
+        try:
+            if oc["enabled"] and oc["chat_id"]:
+                await self.bot.send_message(
+                    oc["chat_id"],
+                    owner_text,
+                )
+        except Exception as e:
+            logger.error(
+                "Failed to notify owners in General about billing limit for instance %s: %s",
+                self.instance_id,
+                e,
+            )
 
-        # --- БИЛЛИНГ / ЛИМИТЫ ---
-        ticket = await self.ensure_ticket_for_user(chat_id, user_id, username)
+    async def _send_to_ticket_thread(
+        self,
+        chat_id: int,
+        ticket: Dict[str, Any],
+        send: Callable[[Optional[int]], Awaitable[Any]],
+    ) -> Any:
+        """
+        Отправляет в топик тикета через send(thread_id) с обработкой flood control
+        и пересозданием удалённого топика. Возвращает результат send() или None.
+        """
+        # Лимиты Telegram соблюдает OutboundScheduler: сюда попадаем уже из лейна чата
+        thread_id = ticket.get("thread_id")
 
-        # Если ensure_ticket_for_user вернул спец-статус блокировки биллингом
-        if ticket.get("status") == "billing_blocked":
-            reason = ticket.get("billing_reason")
+        # Пытаемся отправить в текущий thread_id
+        try:
+            return await send(thread_id)
+        except Exception as e:
+            err_text = str(e).lower()
 
-            if reason == "limit_reached":
-                user_text = getattr(
-                    self.texts,
-                    "billing_user_limit_reached_message",
-                    "⚠️ Лимит обращений по текущему тарифу исчерпан. Попробуйте связаться с владельцами бота другими способами.",
-                )
-                owner_text = getattr(
-                    self.texts,
-                    "billing_owner_limit_reached_message",
-                    "⚠️ Лимит тикетов по текущему тарифу исчерпан. Новые обращения не попадают в систему поддержки.",
-                )
-            elif reason == "expired":
-                user_text = getattr(
-                    self.texts,
-                    "billing_user_demo_expired_message",
-                    "⏳ Тестовый тариф этого бота закончился, новые обращения временно не принимаются.",
-                )
-                owner_text = getattr(
-                    self.texts,
-                    "billing_owner_demo_expired_message",
-                    "⏳ Демо‑период бота закончился. Новые тикеты не создаются.",
-                )
-            else:
-                user_text = getattr(
-                    self.texts,
-                    "billing_user_no_plan_message",
-                    "⚠️ Для этого бота ещё не настроен тариф поддержки, новые обращения временно не принимаются.",
-                )
-                owner_text = getattr(
-                    self.texts,
-                    "billing_owner_no_plan_message",
-                    "⚠️ Для этого бота не настроен активный тариф, обращения пользователей не доходят до системы поддержки.",
-                )
+            # Flood control: Too Many Requests
+            if "too many requests" in err_text or "flood control exceeded" in err_text:
+                retry_sec = 5
+                for token in err_text.split():
+                    if token.isdigit():
+                        retry_sec = int(token)
+                        break
 
-            # Сообщение пользователю
-            try:
-                await self._send_safe_message(
-                    chat_id=message.chat.id,
-                    text=user_text,
-                )
-            except Exception as e:
-                logger.error(
-                    "Failed to notify user %s about billing limit (%s): %s",
-                    user_id,
-                    reason,
-                    e,
+                logger.warning(
+                    "Flood control in forward_to_openchat, sleep %s sec (chat %s, ticket %s)",
+                    retry_sec,
+                    chat_id,
+                    ticket["id"],
                 )
+                await asyncio.sleep(retry_sec)
 
-            # Сообщение владельцам/операторам в General‑топик
-            try:
-                if oc["enabled"] and oc["chat_id"]:
-                    await self.bot.send_message(
-                        oc["chat_id"],
-                        owner_text,
+                try:
+                    return await send(thread_id)
+                except Exception as e2:
+                    logger.error(
+                        "Failed to forward to OpenChat after retry for ticket %s: %s",
+                        ticket["id"],
+                        e2,
                     )
-            except Exception as e:
-                logger.error(
-                    "Failed to notify owners in General about billing limit for instance %s: %s",
-                    self.instance_id,
-                    e,
-                )
+                    return None
 
-            return
+            elif (
+                "message thread not found" in err_text
+                or "message thread not found"
+                in getattr(getattr(e, "message", ""), "lower", lambda: "")()
+            ):
+                # Топик удалён — создаём новый и обновляем тикет
+                try:
+                    title = self._format_ticket_title(ticket)
+                    ft = await self.bot.create_forum_topic(chat_id, name=title)
+                    new_thread_id = ft.message_thread_id
 
-        thread_id = ticket.get("thread_id")
-        header = username or f"user {user_id}"
-        now = datetime.now(timezone.utc)
-        sent: Optional[Message] = None
+                    await self.db.execute(
+                        """
+                        UPDATE tickets
+                        SET thread_id = $1, topic_title = $2, updated_at = $3
+                        WHERE instance_id = $4 AND id = $5
+                        """,
+                        (
+                            new_thread_id,
+                            title,
+                            datetime.now(timezone.utc),
+                            self.instance_id,
+                            ticket["id"],
+                        ),
+                    )
 
-        async def _send_into_thread(thread: int) -> Message:
-            if message.text:
-                body = f"{header}:\n{message.text}"
-                return await self.bot.send_message(chat_id, body, message_thread_id=thread)
+                    ticket["thread_id"] = new_thread_id
 
-            if message.photo:
-                caption = message.caption or ""
-                cap = f"{header}:\n{caption}" if caption else header
-                return await self.bot.send_photo(
-                    chat_id,
-                    message.photo[-1].file_id,
-                    caption=cap,
-                    message_thread_id=thread,
-                )
+                    return await send(new_thread_id)
+                except Exception as e2:
+                    logger.error(f"Failed to recreate forum topic for ticket {ticket['id']}: {e2}")
+                    return None
 
-            if message.video:
-                caption = message.caption or ""
+            else:
+                logger.error(f"Failed to forward to OpenChat: Telegram server says - {e}")
+                return None
+
+    def _submit_to_ticket_thread(
+        self,
+        chat_id: int,
+        ticket: Dict[str, Any],
+        send: Callable[[Optional[int]], Awaitable[Any]],
+        user_id: int,
+        now: datetime,
+    ) -> None:
+        """
+        Ставит в лейн чата OpenChat только саму отправку в топик. Запись в БД после неё
+        (маппинги, история, тайминги тикета) идёт отдельной задачей и лейн не занимает.
+        При переполненном лейне пробрасывает OutboundQueueFull.
+        """
+        fut = self.outbound.submit(
+            chat_id, lambda: self._send_to_ticket_thread(chat_id, ticket, send)
+        )
+        task = asyncio.create_task(
+            self._finish_forward_to_openchat(fut, chat_id, ticket, user_id, now)
+        )
+        self._forward_tails.add(task)
+        task.add_done_callback(self._forward_tails.discard)
+
+    async def _finish_forward_to_openchat(
+        self,
+        fut: "asyncio.Future[Any]",
+        chat_id: int,
+        ticket: Dict[str, Any],
+        user_id: int,
+        now: datetime,
+    ) -> None:
+        try:
+            sent = await fut
+        except Exception:
+            return  # ошибку отправки уже залогировал OutboundScheduler
+        if not sent:
+            return
+
+        sent = list(sent) if isinstance(sent, (list, tuple)) else [sent]
+        if len(sent) > 1:
+            logger.info(
+                "Forwarded media group of %s items to ticket %s", len(sent), ticket["id"]
+            )
+        try:
+            await self._after_forward_to_openchat(chat_id, ticket, sent, user_id, now)
+        except Exception:
+            logger.exception("Failed to store forward to OpenChat for ticket %s", ticket["id"])
+
+    async def _after_forward_to_openchat(
+        self,
+        chat_id: int,
+        ticket: Dict[str, Any],
+        sent: List[Message],
+        user_id: int,
+        now: datetime,
+    ) -> None:
+        """
+        Общий хвост форварда: маппинг реплаев, сохранение сообщений,
+        перенос клавиатуры тикета и обновление таймингов.
+        """
+        # Сохраняем связь для корректного реплея админа клиенту + сообщения в БД
+        if sent:
+            if len(sent) == 1:
+                await self.save_reply_mapping_v2(chat_id, sent[0].message_id, user_id)
+                await self.store_forwarded_message(
+                    chat_id=chat_id,
+                    message=sent[0],
+                    user_id=user_id,
+                )
+            else:
+                await self.db.executemany(
+                    """
+                    INSERT INTO admin_reply_map_v2 (instance_id, chat_id, admin_message_id, target_user_id, created_at)
+                    VALUES ($1, $2, $3, $4, $5)
+                    ON CONFLICT (instance_id, chat_id, admin_message_id)
+                    DO UPDATE SET target_user_id = EXCLUDED.target_user_id,
+                                  created_at     = EXCLUDED.created_at
+                    """,
+                    [(self.instance_id, chat_id, m.message_id, user_id, now) for m in sent],
+                )
+                await self.store_forwarded_messages(chat_id, sent, user_id)
+
+            # ------------------------------------------------------------
+            # КЛАВИАТУРА: переносим НЕ чаще чем раз в 60 минут на тикет
+            #
+            # Требование: в __init__ должен быть кеш:
+            # self.ticket_keyboard_anchor: Dict[int, Dict[str, Any]] = {}
+            # где ticket_id -> {"message_id": int, "moved_at": datetime}
+            # ------------------------------------------------------------
+            move_window = timedelta(minutes=60)
+            ticket_id = ticket["id"]
+            # для альбома клавиатура вешается на последнее сообщение группы
+            anchor_message = sent[-1]
+
+            anchor = getattr(self, "ticket_keyboard_anchor", None)
+            if anchor is None:
+                # На случай если ещё не добавил в __init__
+                self.ticket_keyboard_anchor = {}
+                anchor = self.ticket_keyboard_anchor
+
+            anchor_rec = anchor.get(ticket_id)
+            should_move = False
+            if not anchor_rec:
+                should_move = True
+            else:
+                moved_at = anchor_rec.get("moved_at")
+                if not moved_at or (now - moved_at) >= move_window:
+                    should_move = True
+
+            if should_move:
+                # затем вешаем компактную кнопку-меню на "якорное" (текущее) сообщение
+                await self.put_ticket_keyboard(ticket_id, anchor_message.message_id, compact=True)
+
+                # запоминаем якорь
+                anchor[ticket_id] = {"message_id": anchor_message.message_id, "moved_at": now}
+            else:
+                # не переносим, чтобы не биться в editMessageReplyMarkup при флуде
+                pass
+
+        # Обновляем тайминги тикета
+        try:
+            await self.db.execute(
+                """
+                UPDATE tickets
+                SET last_user_msg_at = $1,
+                    updated_at       = $2
+                WHERE instance_id = $3
+                AND id          = $4
+                """,
+                (now, now, self.instance_id, ticket["id"]),
+            )
+
+            current_status = ticket.get("status") or "new"
+            if current_status in ("answered", "closed"):
+                await self.set_ticket_status(ticket["id"], "inprogress")
+        except Exception as e:
+            logger.error(f"Failed to update ticket timestamps: {e}")
+
+    async def forward_to_openchat(self, message: Message) -> None:
+        """
+        Отправка входящего сообщения пользователя в привязанный OpenChat (в его топик)
+        с сохранением маппинга для последующих реплеев администратора.
+        Проверки и тикет — здесь, в апдейте; в лейн чата уходит только отправка.
+        """
+
+        # Админа в OpenChat не форвардим
+        if message.from_user and await self.is_admin(message.from_user.id):
+            return
+
+        # Чёрный список: если пользователь заблокирован — игнорируем
+        if message.from_user and await self.is_user_blacklisted(message.from_user.id):
+            try:
+                await self._send_safe_message(
+                    chat_id=message.chat.id,
+                    text="❌ Вы заблокированы и не можете отправлять сообщения в поддержку.",
+                )
+            except Exception as e:
+                logger.error(f"Failed to notify blacklisted user {message.from_user.id}: {e}")
+            return
+
+        # Альбом: копим части группы и отправляем одним sendMediaGroup
+        if message.media_group_id:
+            self._buffer_media_group(message)
+            return
+
+        oc = await self.get_openchat_settings()
+        if not (oc["enabled"] and oc["chat_id"]):
+            return
+
+        if not self.db:
+            return
+
+        user_id = message.from_user.id
+        username = message.from_user.username or ""
+        chat_id = oc["chat_id"]
+
+        # --- БИЛЛИНГ / ЛИМИТЫ ---
+        ticket = await self.ensure_ticket_for_user(chat_id, user_id, username)
+
+        # Если ensure_ticket_for_user вернул спец-статус блокировки биллингом
+        if ticket.get("status") == "billing_blocked":
+            await self._notify_billing_blocked(message, oc, ticket)
+            return
+
+        header = username or f"user {user_id}"
+        now = datetime.now(timezone.utc)
+
+        async def _send_into_thread(thread: int) -> Message:
+            if message.text:
+                body = f"{header}:\n{message.text}"
+                return await self.bot.send_message(chat_id, body, message_thread_id=thread)
+
+            if message.photo:
+                caption = message.caption or ""
+                cap = f"{header}:\n{caption}" if caption else header
+                return await self.bot.send_photo(
+                    chat_id,
+                    message.photo[-1].file_id,
+                    caption=cap,
+                    message_thread_id=thread,
+                )
+
+            if message.video:
+                caption = message.caption or ""
                 cap = f"{header}:\n{caption}" if caption else header
                 return await self.bot.send_video(
                     chat_id,
@@ -1924,141 +2790,124 @@ class GraceHubWorker:
             body = f"{header}: [{message.content_type}]"
             return await self.bot.send_message(chat_id, body, message_thread_id=thread)
 
-        # Rate-limit перед отправкой в OpenChat
-        if not await self.ratelimiter.can_send(chat_id=chat_id):
-            wait_for = await self.ratelimiter.wait_for_send()
-            logger.info(f"Rate limit wait for OpenChat chat {chat_id}: {wait_for}s")
-            await asyncio.sleep(wait_for)
-
-        # Пытаемся отправить в текущий thread_id
-        try:
-            sent = await _send_into_thread(thread_id)
-        except Exception as e:
-            err_text = str(e).lower()
-
-            # Flood control: Too Many Requests
-            if "too many requests" in err_text or "flood control exceeded" in err_text:
-                retry_sec = 5
-                for token in err_text.split():
-                    if token.isdigit():
-                        retry_sec = int(token)
-                        break
+        self._submit_to_ticket_thread(chat_id, ticket, _send_into_thread, user_id, now)
 
-                logger.warning(
-                    "Flood control in forward_to_openchat, sleep %s sec (chat %s, ticket %s)",
-                    retry_sec,
-                    chat_id,
-                    ticket["id"],
-                )
-                await asyncio.sleep(retry_sec)
+    # ====================== АЛЬБОМЫ (media_group_id) ======================
 
-                try:
-                    sent = await _send_into_thread(thread_id)
-                except Exception as e2:
-                    logger.error(
-                        "Failed to forward to OpenChat after retry for ticket %s: %s",
-                        ticket["id"],
-                        e2,
-                    )
-                    return
+    def _is_media_group_continuation(self, message: Message) -> bool:
+        """
+        True, если сообщение — не первая часть уже буферизованного альбома.
+        Такие части не считаются отдельными сообщениями для сессионного антифлуда.
+        """
+        return bool(message.media_group_id) and (
+            message.media_group_id in self._media_group_buffers
+        )
 
-            elif (
-                "message thread not found" in err_text
-                or "message thread not found"
-                in getattr(getattr(e, "message", ""), "lower", lambda: "")()
-            ):
-                # Топик удалён — создаём новый и обновляем тикет
-                try:
-                    ft = await self.bot.create_forum_topic(
-                        chat_id,
-                        name=self._format_ticket_title(ticket),
-                    )
-                    new_thread_id = ft.message_thread_id
+    def _buffer_media_group(self, message: Message) -> None:
+        """
+        Кладёт часть альбома в буфер. Первая часть запускает отложенный flush,
+        который срабатывает после паузы MEDIA_GROUP_WINDOW без новых частей.
+        """
+        loop = asyncio.get_running_loop()
+        key = message.media_group_id
 
-                    await self.db.execute(
-                        """
-                        UPDATE tickets
-                        SET thread_id = $1, updated_at = $2
-                        WHERE instance_id = $3 AND id = $4
-                        """,
-                        (new_thread_id, now, self.instance_id, ticket["id"]),
-                    )
+        buf = self._media_group_buffers.get(key)
+        if buf is None:
+            buf = {"messages": [], "last_at": loop.time(), "task": None}
+            self._media_group_buffers[key] = buf
+            task = buf["task"] = asyncio.create_task(self._flush_media_group_later(key))
+            self._media_group_tasks.add(task)
+            task.add_done_callback(self._media_group_tasks.discard)
 
-                    ticket["thread_id"] = new_thread_id
-                    thread_id = new_thread_id
+        buf["messages"].append(message)
+        buf["last_at"] = loop.time()
 
-                    sent = await _send_into_thread(new_thread_id)
-                except Exception as e2:
-                    logger.error(f"Failed to recreate forum topic for ticket {ticket['id']}: {e2}")
-                    return
+    async def _flush_media_group_later(self, key: str) -> None:
+        loop = asyncio.get_running_loop()
 
-            else:
-                logger.error(f"Failed to forward to OpenChat: Telegram server says - {e}")
+        while True:
+            buf = self._media_group_buffers.get(key)
+            if buf is None:
                 return
+            # в альбоме Telegram не больше 10 элементов — дальше ждать нечего
+            if len(buf["messages"]) >= self.MEDIA_GROUP_MAX_ITEMS:
+                break
+            delay = buf["last_at"] + self.MEDIA_GROUP_WINDOW - loop.time()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+
+        buf = self._media_group_buffers.pop(key, None)
+        if buf:
+            await self._flush_media_group(key, buf["messages"])
+
+    async def _flush_media_group(self, key: str, messages: List[Message]) -> None:
+        try:
+            oc = await self.get_openchat_settings()
+            if not (oc["enabled"] and oc["chat_id"]):
+                return
+            await self._forward_media_group(messages)
+        except Exception:
+            logger.exception("Failed to forward media group %s to OpenChat", key)
 
-        # Сохраняем связь для корректного реплея админа клиенту + сообщения в БД
-        if sent:
-            await self.save_reply_mapping_v2(chat_id, sent.message_id, user_id)
+    async def _forward_media_group(self, messages: List[Message]) -> None:
+        """
+        Отправляет собранный альбом в топик тикета одним sendMediaGroup
+        и пишет маппинги/сообщения в БД пачкой.
+        """
+        messages = sorted(messages, key=lambda m: m.message_id)
+        first = messages[0]
 
-            await self.store_forwarded_message(
-                chat_id=chat_id,
-                message=sent,
-                user_id=user_id,
-            )
+        oc = await self.get_openchat_settings()
+        if not (oc["enabled"] and oc["chat_id"]):
+            return
 
-            # ------------------------------------------------------------
-            # КЛАВИАТУРА: переносим НЕ чаще чем раз в 60 минут на тикет
-            #
-            # Требование: в __init__ должен быть кеш:
-            # self.ticket_keyboard_anchor: Dict[int, Dict[str, Any]] = {}
-            # где ticket_id -> {"message_id": int, "moved_at": datetime}
-            # ------------------------------------------------------------
-            move_window = timedelta(minutes=60)
-            ticket_id = ticket["id"]
+        if not self.db:
+            return
 
-            anchor = getattr(self, "ticket_keyboard_anchor", None)
-            if anchor is None:
-                # На случай если ещё не добавил в __init__
-                self.ticket_keyboard_anchor = {}
-                anchor = self.ticket_keyboard_anchor
+        user_id = first.from_user.id
+        username = first.from_user.username or ""
+        chat_id = oc["chat_id"]
 
-            anchor_rec = anchor.get(ticket_id)
-            should_move = False
-            if not anchor_rec:
-                should_move = True
-            else:
-                moved_at = anchor_rec.get("moved_at")
-                if not moved_at or (now - moved_at) >= move_window:
-                    should_move = True
+        ticket = await self.ensure_ticket_for_user(chat_id, user_id, username)
+        if ticket.get("status") == "billing_blocked":
+            await self._notify_billing_blocked(first, oc, ticket)
+            return
 
-            if should_move:
-                # затем вешаем компактную кнопку-меню на "якорное" (текущее) сообщение
-                await self.put_ticket_keyboard(ticket_id, sent.message_id, compact=True)
+        header = username or f"user {user_id}"
+        now = datetime.now(timezone.utc)
 
-                # запоминаем якорь
-                anchor[ticket_id] = {"message_id": sent.message_id, "moved_at": now}
+        media: List[Any] = []
+        for msg in messages:
+            caption = msg.caption or ""
+            if not media:
+                # подпись с именем клиента — только на первом элементе альбома
+                caption = f"{header}:\n{caption}" if caption else header
+            caption = caption or None
+
+            if msg.photo:
+                media.append(InputMediaPhoto(media=msg.photo[-1].file_id, caption=caption))
+            elif msg.video:
+                media.append(InputMediaVideo(media=msg.video.file_id, caption=caption))
+            elif msg.document:
+                media.append(InputMediaDocument(media=msg.document.file_id, caption=caption))
+            elif msg.audio:
+                media.append(InputMediaAudio(media=msg.audio.file_id, caption=caption))
             else:
-                # не переносим, чтобы не биться в editMessageReplyMarkup при флуде
-                pass
+                logger.warning(
+                    "Unsupported media group item %s (%s) for ticket %s",
+                    msg.message_id,
+                    msg.content_type,
+                    ticket["id"],
+                )
 
-        # Обновляем тайминги тикета
-        try:
-            await self.db.execute(
-                """
-                UPDATE tickets
-                SET last_user_msg_at = $1,
-                    updated_at       = $2
-                WHERE instance_id = $3
-                AND id          = $4
-                """,
-                (now, now, self.instance_id, ticket["id"]),
-            )
+        if not media:
+            return
 
-            current_status = ticket.get("status") or "new"
-            if current_status in ("answered", "closed"):
-                await self.set_ticket_status(ticket["id"], "inprogress")
-        except Exception as e:
-            logger.error(f"Failed to update ticket timestamps: {e}")
+        async def _send_album(thread: int) -> List[Message]:
+            return await self.bot.send_media_group(chat_id, media, message_thread_id=thread)
+
+        self._submit_to_ticket_thread(chat_id, ticket, _send_album, user_id, now)
 
     # ====================== КОМАНДЫ ======================
 
@@ -2083,8 +2932,7 @@ class GraceHubWorker:
 
         # Ветка для админа
         if await self.is_admin(user_id):
-            me = await self.bot.get_me()
-            bot_username = me.username or "bot"
+            bot_username = await self.get_bot_username()
 
             if not oc["enabled"]:
                 # Для незанастроенного OpenChat показываем статус + подсказку по привязке
@@ -2212,8 +3060,8 @@ class GraceHubWorker:
         parts = (message.text or "").split()
         if len(parts) > 1:
             arg = parts[1].lstrip("@")
-            me = await self.bot.get_me()
-            if arg.lower() != (me.username or "").lower():
+            bot_username = await self.get_bot_username()
+            if arg.lower() != bot_username.lower():
                 await self._send_safe_message(
                     chat_id=message.chat.id,
                     text=self.texts.openchat_bind_usage_error,
@@ -2434,8 +3282,14 @@ class GraceHubWorker:
             return
 
         # 2) "Назначить" — показать список операторов из БД
-        if action == "assign":
-            kb = await self.get_operators_keyboard(ticket_id, page=0)
+        #    (ticket:ap:<id>:<n|p>:<курсор> — листание списка)
+        if action == "assign" or (action == "ap" and len(parts) == 6):
+            cursor = None
+            direction = "n"
+            if action == "ap":
+                direction = "p" if parts[3] == "p" else "n"
+                cursor = self._decode_keyset(parts[4], parts[5])
+            kb = await self.get_operators_keyboard(ticket_id, cursor=cursor, direction=direction)
             if not kb.inline_keyboard:
                 await cb.answer(self.texts.ticket_no_assignees, show_alert=True)
                 return
@@ -2584,6 +3438,26 @@ class GraceHubWorker:
 
     # ====================== CALLBACKS АДМИН-ПАНЕЛИ ======================
 
+    # Callback'и админ-панели: точное значение или префикс "<name>:" -> метод
+    ADMIN_CALLBACK_ROUTES: Dict[str, str] = {
+        "edit_greeting": "_cb_edit_greeting",
+        "setup_autoreply": "_cb_setup_autoreply",
+        "setup_openchat": "_cb_setup_openchat",
+        "setup_privacy": "_cb_setup_privacy",
+        "toggle_privacy": "_cb_toggle_privacy",
+        "setup_rating": "_cb_setup_rating",
+        "toggle_rating": "_cb_toggle_rating",
+        "blacklist": "_cb_blacklist",
+        "blacklist_add": "_cb_blacklist_add",
+        "blacklist_remove": "_cb_blacklist_remove",
+        "blacklist_show": "_cb_blacklist_show",
+        "bl_page:": "_cb_bl_page",
+        "bl_sr:": "_cb_bl_sr",
+        "blacklist_search": "_cb_blacklist_search",
+        "export_users": "_cb_export_users",
+        "main_menu": "_cb_main_menu",
+    }
+
     async def handle_callback(self, cb: CallbackQuery, state: FSMContext) -> None:
         if not await self.is_admin(cb.from_user.id):
             await cb.answer(self.texts.access_denied, show_alert=True)
@@ -2591,341 +3465,352 @@ class GraceHubWorker:
 
         data = cb.data or ""
 
-        if data == "edit_greeting":
-            await state.set_state(AdminStates.wait_greeting)
-            await cb.message.edit_text(
-                self.texts.greeting_edit_prompt,
-                reply_markup=InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [
-                            InlineKeyboardButton(
-                                text=self.texts.back,
-                                callback_data="main_menu",
-                            )
-                        ]
-                    ]
-                ),
-            )
-
-        elif data == "setup_autoreply":
-            await state.set_state(AdminStates.wait_autoreply)
-            enabled = self.texts.autoreply_state_on.format(
-                state=self.texts.autoreply_enabled_label
-                if await self.get_setting("autoreply_enabled") == "True"
-                else self.texts.autoreply_disabled_label
-            )
-            await cb.message.edit_text(
-                enabled,
-                reply_markup=InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [
-                            InlineKeyboardButton(
-                                text=self.texts.back,
-                                callback_data="main_menu",
-                            )
-                        ]
-                    ]
-                ),
-            )
-
-        elif data == "setup_openchat":
-            openchat = await self.get_openchat_settings()
-            status = (
-                self.texts.openchat_status_on
-                if openchat["enabled"]
-                else self.texts.openchat_status_off
-            )
+        route = self.ADMIN_CALLBACK_ROUTES.get(data)
+        if route is None and ":" in data:
+            route = self.ADMIN_CALLBACK_ROUTES.get(data.split(":", 1)[0] + ":")
+        if route is None:
+            await cb.answer()
+            return
 
-            if openchat["chat_id"]:
-                current = self.texts.openchat_current_chat_id.format(chat_id=openchat["chat_id"])
-            else:
-                current = self.texts.openchat_not_bound
+        await getattr(self, route)(cb, state, data)
 
-            me = await self.bot.get_me()
-            bot_username = me.username or "bot"
-            await cb.message.edit_text(
-                self.texts.openchat_now_status.format(
-                    status=status,
-                    current=current,
-                    bot_username=bot_username,
-                ),
-                reply_markup=InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [
-                            InlineKeyboardButton(
-                                text=self.texts.back,
-                                callback_data="main_menu",
-                            )
-                        ]
+    async def _cb_edit_greeting(self, cb: CallbackQuery, state: FSMContext, data: str) -> None:
+        await state.set_state(AdminStates.wait_greeting)
+        await cb.message.edit_text(
+            self.texts.greeting_edit_prompt,
+            reply_markup=InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [
+                        InlineKeyboardButton(
+                            text=self.texts.back,
+                            callback_data="main_menu",
+                        )
                     ]
-                ),
-            )
+                ]
+            ),
+        )
 
-        elif data == "setup_privacy":
-            enabled = (
-                self.texts.privacy_state_on
-                if await self.is_privacy_enabled()
-                else self.texts.privacy_state_off
-            )
-            await cb.message.edit_text(
-                self.texts.privacy_screen.format(state=enabled),
-                reply_markup=InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [
-                            InlineKeyboardButton(
-                                text=self.texts.privacy_toggle_btn,
-                                callback_data="toggle_privacy",
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                text=self.texts.back,
-                                callback_data="main_menu",
-                            )
-                        ],
+    async def _cb_setup_autoreply(self, cb: CallbackQuery, state: FSMContext, data: str) -> None:
+        await state.set_state(AdminStates.wait_autoreply)
+        enabled = self.texts.autoreply_state_on.format(
+            state=self.texts.autoreply_enabled_label
+            if await self.get_setting("autoreply_enabled") == "True"
+            else self.texts.autoreply_disabled_label
+        )
+        await cb.message.edit_text(
+            enabled,
+            reply_markup=InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [
+                        InlineKeyboardButton(
+                            text=self.texts.back,
+                            callback_data="main_menu",
+                        )
                     ]
-                ),
-            )
+                ]
+            ),
+        )
 
-        elif data == "toggle_privacy":
-            current = await self.is_privacy_enabled()
-            await self.set_setting("privacy_mode_enabled", "False" if current else "True")
-            new_state = self.texts.privacy_state_on if not current else self.texts.privacy_state_off
-            await cb.answer(
-                self.texts.privacy_toggled.format(state=new_state),
-                show_alert=False,
-            )
+    async def _cb_setup_openchat(self, cb: CallbackQuery, state: FSMContext, data: str) -> None:
+        openchat = await self.get_openchat_settings()
+        status = (
+            self.texts.openchat_status_on
+            if openchat["enabled"]
+            else self.texts.openchat_status_off
+        )
 
-            enabled = (
-                self.texts.privacy_state_on
-                if await self.is_privacy_enabled()
-                else self.texts.privacy_state_off
-            )
-            await cb.message.edit_text(
-                self.texts.privacy_screen.format(state=enabled),
-                reply_markup=InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [
-                            InlineKeyboardButton(
-                                text=self.texts.privacy_toggle_btn,
-                                callback_data="toggle_privacy",
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                text=self.texts.back,
-                                callback_data="main_menu",
-                            )
-                        ],
+        if openchat["chat_id"]:
+            current = self.texts.openchat_current_chat_id.format(chat_id=openchat["chat_id"])
+        else:
+            current = self.texts.openchat_not_bound
+
+        bot_username = await self.get_bot_username()
+        await cb.message.edit_text(
+            self.texts.openchat_now_status.format(
+                status=status,
+                current=current,
+                bot_username=bot_username,
+            ),
+            reply_markup=InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [
+                        InlineKeyboardButton(
+                            text=self.texts.back,
+                            callback_data="main_menu",
+                        )
                     ]
-                ),
-            )
+                ]
+            ),
+        )
 
-        elif data == "setup_rating":
-            rating_enabled = (await self.get_setting("rating_enabled")) == "True"
-            enabled_text = (
-                self.texts.rating_state_on if rating_enabled else self.texts.rating_state_off
-            )
-            await cb.message.edit_text(
-                self.texts.rating_screen.format(state=enabled_text),
-                reply_markup=InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [
-                            InlineKeyboardButton(
-                                text=self.texts.rating_toggle_btn,
-                                callback_data="toggle_rating",
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                text=self.texts.back,
-                                callback_data="main_menu",
-                            )
-                        ],
-                    ]
-                ),
-            )
+    async def _cb_setup_privacy(self, cb: CallbackQuery, state: FSMContext, data: str) -> None:
+        enabled = (
+            self.texts.privacy_state_on
+            if await self.is_privacy_enabled()
+            else self.texts.privacy_state_off
+        )
+        await cb.message.edit_text(
+            self.texts.privacy_screen.format(state=enabled),
+            reply_markup=InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [
+                        InlineKeyboardButton(
+                            text=self.texts.privacy_toggle_btn,
+                            callback_data="toggle_privacy",
+                        )
+                    ],
+                    [
+                        InlineKeyboardButton(
+                            text=self.texts.back,
+                            callback_data="main_menu",
+                        )
+                    ],
+                ]
+            ),
+        )
 
-        elif data == "toggle_rating":
-            current = (await self.get_setting("rating_enabled")) == "True"
-            await self.set_setting("rating_enabled", "False" if current else "True")
-            new_state_text = (
-                self.texts.rating_state_on if not current else self.texts.rating_state_off
-            )
+    async def _cb_toggle_privacy(self, cb: CallbackQuery, state: FSMContext, data: str) -> None:
+        current = await self.is_privacy_enabled()
+        await self.set_setting("privacy_mode_enabled", "False" if current else "True")
+        new_state = self.texts.privacy_state_on if not current else self.texts.privacy_state_off
+        await cb.answer(
+            self.texts.privacy_toggled.format(state=new_state),
+            show_alert=False,
+        )
 
-            await cb.answer(
-                self.texts.rating_toggled.format(state=new_state_text),
-                show_alert=False,
-            )
+        enabled = (
+            self.texts.privacy_state_on
+            if await self.is_privacy_enabled()
+            else self.texts.privacy_state_off
+        )
+        await cb.message.edit_text(
+            self.texts.privacy_screen.format(state=enabled),
+            reply_markup=InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [
+                        InlineKeyboardButton(
+                            text=self.texts.privacy_toggle_btn,
+                            callback_data="toggle_privacy",
+                        )
+                    ],
+                    [
+                        InlineKeyboardButton(
+                            text=self.texts.back,
+                            callback_data="main_menu",
+                        )
+                    ],
+                ]
+            ),
+        )
 
-            rating_enabled = (await self.get_setting("rating_enabled")) == "True"
-            enabled_text = (
-                self.texts.rating_state_on if rating_enabled else self.texts.rating_state_off
-            )
-            await cb.message.edit_text(
-                self.texts.rating_screen.format(state=enabled_text),
-                reply_markup=InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [
-                            InlineKeyboardButton(
-                                text=self.texts.rating_toggle_btn,
-                                callback_data="toggle_rating",
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                text=self.texts.back,
-                                callback_data="main_menu",
-                            )
-                        ],
-                    ]
-                ),
-            )
+    async def _cb_setup_rating(self, cb: CallbackQuery, state: FSMContext, data: str) -> None:
+        rating_enabled = (await self.get_setting("rating_enabled")) == "True"
+        enabled_text = (
+            self.texts.rating_state_on if rating_enabled else self.texts.rating_state_off
+        )
+        await cb.message.edit_text(
+            self.texts.rating_screen.format(state=enabled_text),
+            reply_markup=InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [
+                        InlineKeyboardButton(
+                            text=self.texts.rating_toggle_btn,
+                            callback_data="toggle_rating",
+                        )
+                    ],
+                    [
+                        InlineKeyboardButton(
+                            text=self.texts.back,
+                            callback_data="main_menu",
+                        )
+                    ],
+                ]
+            ),
+        )
 
-        elif data == "blacklist":
-            await state.set_state(AdminStates.wait_blacklist_menu)
-            await cb.message.edit_text(
-                self.texts.blacklist_title,
-                reply_markup=self.get_blacklist_menu(),
-            )
+    async def _cb_toggle_rating(self, cb: CallbackQuery, state: FSMContext, data: str) -> None:
+        current = (await self.get_setting("rating_enabled")) == "True"
+        await self.set_setting("rating_enabled", "False" if current else "True")
+        new_state_text = (
+            self.texts.rating_state_on if not current else self.texts.rating_state_off
+        )
+
+        await cb.answer(
+            self.texts.rating_toggled.format(state=new_state_text),
+            show_alert=False,
+        )
+
+        rating_enabled = (await self.get_setting("rating_enabled")) == "True"
+        enabled_text = (
+            self.texts.rating_state_on if rating_enabled else self.texts.rating_state_off
+        )
+        await cb.message.edit_text(
+            self.texts.rating_screen.format(state=enabled_text),
+            reply_markup=InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [
+                        InlineKeyboardButton(
+                            text=self.texts.rating_toggle_btn,
+                            callback_data="toggle_rating",
+                        )
+                    ],
+                    [
+                        InlineKeyboardButton(
+                            text=self.texts.back,
+                            callback_data="main_menu",
+                        )
+                    ],
+                ]
+            ),
+        )
 
-        elif data == "blacklist_add":
-            await state.set_state(AdminStates.wait_blacklist_add)
-            await cb.message.edit_text(
-                self.texts.blacklist_add_prompt,
-                reply_markup=InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [
-                            InlineKeyboardButton(
-                                text=self.texts.back,
-                                callback_data="blacklist",
-                            )
-                        ]
-                    ]
-                ),
-            )
+    async def _cb_blacklist(self, cb: CallbackQuery, state: FSMContext, data: str) -> None:
+        await state.set_state(AdminStates.wait_blacklist_menu)
+        await cb.message.edit_text(
+            self.texts.blacklist_title,
+            reply_markup=self.get_blacklist_menu(),
+        )
 
-        elif data == "blacklist_remove":
-            await state.set_state(AdminStates.wait_blacklist_remove)
-            await cb.message.edit_text(
-                self.texts.blacklist_remove_prompt,
-                reply_markup=InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [
-                            InlineKeyboardButton(
-                                text=self.texts.back,
-                                callback_data="blacklist",
-                            )
-                        ]
+    async def _cb_blacklist_add(self, cb: CallbackQuery, state: FSMContext, data: str) -> None:
+        await state.set_state(AdminStates.wait_blacklist_add)
+        await cb.message.edit_text(
+            self.texts.blacklist_add_prompt,
+            reply_markup=InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [
+                        InlineKeyboardButton(
+                            text=self.texts.back,
+                            callback_data="blacklist",
+                        )
                     ]
-                ),
-            )
-
-        elif data == "blacklist_show":
-            await self.render_blacklist_page(cb, page=0)
-
-        elif data.startswith("bl_page:"):
-            try:
-                page = int(data.split(":", 1)[1])
-            except ValueError:
-                await cb.answer()
-                return
-            await self.render_blacklist_page(cb, page=page)
+                ]
+            ),
+        )
 
-        elif data == "blacklist_search":
-            await state.set_state(AdminStates.wait_blacklist_search)
-            await cb.message.edit_text(
-                self.texts.blacklist_search_prompt,
-                reply_markup=InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [
-                            InlineKeyboardButton(
-                                text=self.texts.back,
-                                callback_data="blacklist_show",
-                            )
-                        ]
+    async def _cb_blacklist_remove(self, cb: CallbackQuery, state: FSMContext, data: str) -> None:
+        await state.set_state(AdminStates.wait_blacklist_remove)
+        await cb.message.edit_text(
+            self.texts.blacklist_remove_prompt,
+            reply_markup=InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [
+                        InlineKeyboardButton(
+                            text=self.texts.back,
+                            callback_data="blacklist",
+                        )
                     ]
-                ),
-            )
-
-        elif data == "export_users":
-            await cb.answer(self.texts.export_preparing, show_alert=False)
+                ]
+            ),
+        )
 
-            rows = await self.db.fetchall(
-                """
-                SELECT DISTINCT user_id, username, created_at
-                FROM tickets
-                WHERE instance_id = $1
-                ORDER BY created_at ASC
-                """,
-                (self.instance_id,),
-            )
+    async def _cb_blacklist_show(self, cb: CallbackQuery, state: FSMContext, data: str) -> None:
+        await self.render_blacklist_page(cb, page=0)
 
-            if not rows:
-                await cb.message.answer(self.texts.export_no_users)
-                return
+    async def _cb_bl_page(self, cb: CallbackQuery, state: FSMContext, data: str) -> None:
+        # bl_page:<total>:<n|p>:<page>:<ts>:<user_id>; старые кнопки bl_page:<page> -> 1-я стр.
+        parts = data.split(":")
+        if len(parts) != 6:
+            await self.render_blacklist_page(cb)
+            return
+        cursor = self._decode_keyset(parts[4], parts[5])
+        try:
+            total, page = int(parts[1]), int(parts[3])
+        except ValueError:
+            cursor = None
+            total, page = None, 0
+        await self.render_blacklist_page(
+            cb,
+            page=page,
+            cursor=cursor,
+            direction="p" if parts[2] == "p" else "n",
+            total=total,
+        )
 
-            import csv
-            import io
-            from datetime import datetime as _dt
+    async def _cb_bl_sr(self, cb: CallbackQuery, state: FSMContext, data: str) -> None:
+        # bl_sr:<n|p>:<page>:<ts>:<user_id>, сам запрос — в FSM
+        parts = data.split(":")
+        query = (await state.get_data()).get("blacklist_query")
+        cursor = self._decode_keyset(parts[3], parts[4]) if len(parts) == 5 else None
+        if not query or cursor is None:
+            await cb.answer()
+            return
+        try:
+            page = int(parts[2])
+        except ValueError:
+            page = 0
+        result = await self.build_blacklist_search_page(
+            query,
+            page=page,
+            cursor=cursor,
+            direction="p" if parts[1] == "p" else "n",
+        )
+        if result is None:
+            await cb.answer()
+            return
+        text, kb = result
+        await cb.message.edit_text(text, reply_markup=kb)
 
-            buf = io.StringIO()
-            writer = csv.writer(buf)
-            writer.writerow(["user_id", "username", "first_seen"])
-            for r in rows:
-                created = r["created_at"]
-                if isinstance(created, _dt):
-                    created = created.isoformat()
-                writer.writerow([r["user_id"], r["username"] or "", created])
+    async def _cb_blacklist_search(self, cb: CallbackQuery, state: FSMContext, data: str) -> None:
+        await state.set_state(AdminStates.wait_blacklist_search)
+        await cb.message.edit_text(
+            self.texts.blacklist_search_prompt,
+            reply_markup=InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [
+                        InlineKeyboardButton(
+                            text=self.texts.back,
+                            callback_data="blacklist_show",
+                        )
+                    ]
+                ]
+            ),
+        )
 
-            data_bytes = buf.getvalue().encode("utf-8")
-            file = BufferedInputFile(file=data_bytes, filename="users_export.csv")
+    async def _cb_export_users(self, cb: CallbackQuery, state: FSMContext, data: str) -> None:
+        await cb.answer(self.texts.export_preparing, show_alert=False)
 
-            await cb.message.answer_document(
-                document=file,
-                caption=self.texts.export_users_caption,
+        # выгрузка может быть долгой — не держим на ней обработку апдейта
+        if self._export_task is None or self._export_task.done():
+            self._export_task = asyncio.create_task(
+                self.export_users(cb.message.chat.id)
             )
 
-        elif data == "main_menu":
-            await state.clear()
+    async def _cb_main_menu(self, cb: CallbackQuery, state: FSMContext, data: str) -> None:
+        await state.clear()
 
-            openchat = await self.get_openchat_settings()
-            if openchat["enabled"] and openchat["chat_id"]:
-                status_line_admin = self.texts.openchat_status_line_on
-            else:
-                status_line_admin = self.texts.openchat_status_line_off
+        openchat = await self.get_openchat_settings()
+        if openchat["enabled"] and openchat["chat_id"]:
+            status_line_admin = self.texts.openchat_status_line_on
+        else:
+            status_line_admin = self.texts.openchat_status_line_off
 
-            me = await self.bot.get_me()
-            bot_username = me.username or "bot"
+        bot_username = await self.get_bot_username()
 
-            if not openchat["enabled"]:
-                text = (
-                    f"{status_line_admin}\n"
-                    f"{self.texts.menu_you_are_admin}\n\n"
-                    + self.texts.openchat_setup_hint.format(bot_username=bot_username)
-                )
-                reply_markup = InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [
-                            InlineKeyboardButton(
-                                text=self.texts.openchat_setup_button,
-                                callback_data="setup_openchat",
-                            )
-                        ]
+        if not openchat["enabled"]:
+            text = (
+                f"{status_line_admin}\n"
+                f"{self.texts.menu_you_are_admin}\n\n"
+                + self.texts.openchat_setup_hint.format(bot_username=bot_username)
+            )
+            reply_markup = InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [
+                        InlineKeyboardButton(
+                            text=self.texts.openchat_setup_button,
+                            callback_data="setup_openchat",
+                        )
                     ]
-                )
-            else:
-                text = (
-                    f"{status_line_admin}\n"
-                    f"{self.texts.menu_you_are_admin}\n"
-                    f"{self.texts.admin_panel_choose_section}"
-                )
-                reply_markup = await self.get_admin_menu()
-
-            await cb.message.edit_text(text, reply_markup=reply_markup)
-
+                ]
+            )
         else:
-            await cb.answer()
+            text = (
+                f"{status_line_admin}\n"
+                f"{self.texts.menu_you_are_admin}\n"
+                f"{self.texts.admin_panel_choose_section}"
+            )
+            reply_markup = await self.get_admin_menu()
+
+        await cb.message.edit_text(text, reply_markup=reply_markup)
 
     # ====================== ОБРАБОТКА СОСТОЯНИЙ АДМИНА ======================
 
@@ -2946,30 +3831,21 @@ class GraceHubWorker:
 
         query = message.text.strip().lstrip("@").lower()
 
-        bl = await self.get_blacklist()
-        results = [u for u in bl if (u["username"] or "").lower().find(query) != -1]
-
-        if not results:
+        result = await self.build_blacklist_search_page(query)
+        if result is None:
             await self._send_safe_message(
                 chat_id=message.chat.id,
                 text="Ничего не найдено в чёрном списке.",
             )
             return
 
-        lines = []
-        for u in results[:50]:
-            label = f"@{u['username']}" if u["username"] else ""
-            lines.append(f"<code>{u['user_id']}</code> {label}")
-
-        text = f'🔍 Результаты поиска по "{query}":\n' + "\n".join(lines)
-        if len(results) > 50:
-            text += f"\n\nПоказаны первые 50 из {len(results)} записей."
-
+        text, kb = result
         await state.set_state(AdminStates.wait_blacklist_menu)
+        await state.update_data(blacklist_query=query)
         await self._send_safe_message(
             chat_id=message.chat.id,
             text=text,
-            reply_markup=self.get_blacklist_menu(),
+            reply_markup=kb,
         )
 
     async def handle_admin_greeting(self, message: Message, state: FSMContext) -> None:
@@ -3172,34 +4048,17 @@ class GraceHubWorker:
             )
             return
 
+        # Продолжение альбома считается одним сообщением с его первой частью
+        album_part = self._is_media_group_continuation(message)
+
         # Антифлуд: сообщения в минуту от пользователя
-        if await self._is_user_flooding(user_id):
+        if not album_part and await self._is_user_flooding(user_id):
             await self._send_safe_message(
                 chat_id=message.chat.id,
                 text=self.texts.too_many_messages,
             )
             return
 
-        # 🔹 СЕССИОННЫЙ ФЛУД (>=3 подряд) — честно говорим, что НЕ отправили
-        user_msgs = self.user_session_messages.get(user_id, 0)
-        SESSION_FLOOD_LIMIT = 3
-        if user_msgs >= SESSION_FLOOD_LIMIT:
-            logger.warning("User %s session flood (%s msgs)", user_id, user_msgs)
-            await self._send_safe_message(
-                chat_id=message.chat.id,
-                text=(
-                    "⚠️ Слишком много сообщений подряд.\n"
-                    "Это сообщение не отправлено оператору, чтобы не засорять очередь.\n\n"
-                    "Пожалуйста, дождитесь ответа оператора."
-                ),
-            )
-            return
-
-        # Rate-limit на отправку ответов
-        if not await self.ratelimiter.can_send(chat_id=message.chat.id):
-            wait_for = await self.ratelimiter.wait_for_send()
-            await asyncio.sleep(wait_for)
-
         # Если это админ — показываем админ-панель
         if await self.is_admin(user_id):
             await self._send_safe_message(
@@ -3213,13 +4072,13 @@ class GraceHubWorker:
         max_bytes = self.max_file_bytes  # задаётся в __init__ из settings.WORKER_MAX_FILE_MB
         too_big = False
 
-        async def _check_by_file_id(file_id: str) -> bool:
+        async def _check_by_file_id(file_id: str, file_unique_id: Optional[str] = None) -> bool:
             """
             True => файл проходит лимит
             False => файл больше лимита
             """
             try:
-                return await self.check_file_size(file_id)
+                return await self.check_file_size(file_id, file_unique_id)
             except Exception as e:
                 # Если Telegram API временно не даёт размер — лучше НЕ блокировать,
                 # иначе возможны ложные отказы. При желании можно сделать наоборот.
@@ -3233,7 +4092,7 @@ class GraceHubWorker:
                 if photo.file_size > max_bytes:
                     too_big = True
             else:
-                ok = await _check_by_file_id(photo.file_id)
+                ok = await _check_by_file_id(photo.file_id, photo.file_unique_id)
                 too_big = not ok
 
         # Документы
@@ -3242,7 +4101,9 @@ class GraceHubWorker:
                 if message.document.file_size > max_bytes:
                     too_big = True
             else:
-                ok = await _check_by_file_id(message.document.file_id)
+                ok = await _check_by_file_id(
+                    message.document.file_id, message.document.file_unique_id
+                )
                 too_big = not ok
 
         # Видео
@@ -3251,7 +4112,7 @@ class GraceHubWorker:
                 if message.video.file_size > max_bytes:
                     too_big = True
             else:
-                ok = await _check_by_file_id(message.video.file_id)
+                ok = await _check_by_file_id(message.video.file_id, message.video.file_unique_id)
                 too_big = not ok
 
         # Аудио
@@ -3260,7 +4121,7 @@ class GraceHubWorker:
                 if message.audio.file_size > max_bytes:
                     too_big = True
             else:
-                ok = await _check_by_file_id(message.audio.file_id)
+                ok = await _check_by_file_id(message.audio.file_id, message.audio.file_unique_id)
                 too_big = not ok
 
         # Голосовые
@@ -3269,7 +4130,7 @@ class GraceHubWorker:
                 if message.voice.file_size > max_bytes:
                     too_big = True
             else:
-                ok = await _check_by_file_id(message.voice.file_id)
+                ok = await _check_by_file_id(message.voice.file_id, message.voice.file_unique_id)
                 too_big = not ok
 
         # Видео-заметки
@@ -3278,7 +4139,9 @@ class GraceHubWorker:
                 if message.video_note.file_size > max_bytes:
                     too_big = True
             else:
-                ok = await _check_by_file_id(message.video_note.file_id)
+                ok = await _check_by_file_id(
+                    message.video_note.file_id, message.video_note.file_unique_id
+                )
                 too_big = not ok
 
         # Стикеры (если хочешь ограничивать и их)
@@ -3287,7 +4150,9 @@ class GraceHubWorker:
                 if message.sticker.file_size > max_bytes:
                     too_big = True
             else:
-                ok = await _check_by_file_id(message.sticker.file_id)
+                ok = await _check_by_file_id(
+                    message.sticker.file_id, message.sticker.file_unique_id
+                )
                 too_big = not ok
 
         if too_big:
@@ -3308,15 +4173,29 @@ class GraceHubWorker:
 
         # Если включён OpenChat и есть привязанный чат — шлём в топики
         if oc["enabled"] and oc["chat_id"]:
+            # 🔹 СЕССИОННЫЙ ФЛУД (>=3 подряд без ответа оператора) — честно говорим,
+            # что НЕ отправили
+            if not album_part and not await self._try_acquire_session_slot(user_id):
+                logger.warning(
+                    "User %s session flood (>= %s msgs)", user_id, self.SESSION_FLOOD_LIMIT
+                )
+                await self._send_safe_message(
+                    chat_id=message.chat.id,
+                    text=(
+                        "⚠️ Слишком много сообщений подряд.\n"
+                        "Это сообщение не отправлено оператору, чтобы не засорять очередь.\n\n"
+                        "Пожалуйста, дождитесь ответа оператора."
+                    ),
+                )
+                return
+
+            # проверки и тикет — здесь, в апдейте; в лейн чата OpenChat уходит только отправка.
+            # Переполненный лейн (OutboundQueueFull) пробрасываем: апдейт не подтвердится
             try:
                 await self.forward_to_openchat(message)
-
-                # Обновляем счётчик сессии
-                self.user_session_messages[user_id] = user_msgs + 1
-                if self.user_session_messages[user_id] > 10:
-                    self.user_session_messages[user_id] = 0
-
-            except Exception as e:
+            except OutboundQueueFull:
+                raise
+            except Exception:
                 logger.exception("Failed to forward to OpenChat")
 
             return
@@ -3333,10 +4212,7 @@ class GraceHubWorker:
         Обработка сообщений в чате OpenChat (супергруппа с темами).
         Интересуют только реплаи внутри привязанного чата.
         """
-        oc = await self.get_openchat_settings()
-        if not (oc["enabled"] and oc["chat_id"] and message.chat.id == oc["chat_id"]):
-            return
-
+        # Сначала дешёвые структурные проверки, настройки из БД — потом.
         # Берём только ответы на сообщения (reply) — это сигнал ответа клиенту
         if not message.reply_to_message:
             return
@@ -3345,6 +4221,10 @@ class GraceHubWorker:
         if message.from_user and message.from_user.is_bot:
             return
 
+        oc = await self.get_openchat_settings()
+        if not (oc["enabled"] and oc["chat_id"] and message.chat.id == oc["chat_id"]):
+            return
+
         # 🔹 Трекинг оператора по активности в OpenChat
         if message.from_user:
             await self.db.track_operator_activity(
@@ -3357,13 +4237,13 @@ class GraceHubWorker:
         max_bytes = self.max_file_bytes  # задаётся в __init__ из settings.WORKER_MAX_FILE_MB
         too_big = False
 
-        async def _check_by_file_id(file_id: str) -> bool:
+        async def _check_by_file_id(file_id: str, file_unique_id: Optional[str] = None) -> bool:
             """
             True => файл проходит лимит
             False => файл больше лимита
             """
             try:
-                return await self.check_file_size(file_id)
+                return await self.check_file_size(file_id, file_unique_id)
             except Exception as e:
                 # При сбоях Telegram API лучше не блокировать (иначе будут ложные отказы).
                 logger.warning("check_file_size failed for file_id=%s: %s", file_id, e)
@@ -3376,7 +4256,7 @@ class GraceHubWorker:
                 if photo.file_size > max_bytes:
                     too_big = True
             else:
-                ok = await _check_by_file_id(photo.file_id)
+                ok = await _check_by_file_id(photo.file_id, photo.file_unique_id)
                 too_big = not ok
 
         # Документы
@@ -3385,7 +4265,9 @@ class GraceHubWorker:
                 if message.document.file_size > max_bytes:
                     too_big = True
             else:
-                ok = await _check_by_file_id(message.document.file_id)
+                ok = await _check_by_file_id(
+                    message.document.file_id, message.document.file_unique_id
+                )
                 too_big = not ok
 
         # Видео
@@ -3394,7 +4276,7 @@ class GraceHubWorker:
                 if message.video.file_size > max_bytes:
                     too_big = True
             else:
-                ok = await _check_by_file_id(message.video.file_id)
+                ok = await _check_by_file_id(message.video.file_id, message.video.file_unique_id)
                 too_big = not ok
 
         # Аудио
@@ -3403,7 +4285,7 @@ class GraceHubWorker:
                 if message.audio.file_size > max_bytes:
                     too_big = True
             else:
-                ok = await _check_by_file_id(message.audio.file_id)
+                ok = await _check_by_file_id(message.audio.file_id, message.audio.file_unique_id)
                 too_big = not ok
 
         # Голосовые
@@ -3412,7 +4294,7 @@ class GraceHubWorker:
                 if message.voice.file_size > max_bytes:
                     too_big = True
             else:
-                ok = await _check_by_file_id(message.voice.file_id)
+                ok = await _check_by_file_id(message.voice.file_id, message.voice.file_unique_id)
                 too_big = not ok
 
         # Видео-заметки
@@ -3421,7 +4303,9 @@ class GraceHubWorker:
                 if message.video_note.file_size > max_bytes:
                     too_big = True
             else:
-                ok = await _check_by_file_id(message.video_note.file_id)
+                ok = await _check_by_file_id(
+                    message.video_note.file_id, message.video_note.file_unique_id
+                )
                 too_big = not ok
 
         # Стикеры (если тоже ограничиваем)
@@ -3430,7 +4314,9 @@ class GraceHubWorker:
                 if message.sticker.file_size > max_bytes:
                     too_big = True
             else:
-                ok = await _check_by_file_id(message.sticker.file_id)
+                ok = await _check_by_file_id(
+                    message.sticker.file_id, message.sticker.file_unique_id
+                )
                 too_big = not ok
 
         if too_big:
@@ -3503,11 +4389,15 @@ class GraceHubWorker:
         if await self.is_user_blacklisted(target_user_id):
             return
 
-        # Уважим rate limit перед исходящим
-        if not await self.ratelimiter.can_send(chat_id=target_user_id):
-            wait_for = await self.ratelimiter.wait_for_send()
-            await asyncio.sleep(wait_for)
+        # Отправка клиенту — в лейне его чата, с учётом rate limit, без блокировки апдейта
+        self.outbound.submit(
+            target_user_id,
+            lambda: self._deliver_openchat_reply(message, target_user_id, oc),
+        )
 
+    async def _deliver_openchat_reply(
+        self, message: Message, target_user_id: int, oc: Dict[str, Any]
+    ) -> None:
         # Пересылаем по типу контента с учётом Privacy Mode
         try:
             if message.text:
@@ -3559,6 +4449,12 @@ class GraceHubWorker:
             logger.error(f"Failed to send OpenChat reply to user {target_user_id}: {e}")
             return
 
+        # Оператор ответил — сбрасываем сессионный антифлуд пользователя
+        try:
+            await self.flood_counter.reset_session(target_user_id)
+        except Exception as e:
+            logger.warning(f"Failed to reset session flood counter for {target_user_id}: {e}")
+
         # Обновляем тайминги/статус тикета
         try:
             now = datetime.now(timezone.utc)
@@ -3586,108 +4482,53 @@ class GraceHubWorker:
 
     # ====================== РЕГИСТРАЦИЯ ХЭНДЛЕРОВ ======================
     def register_handlers(self) -> None:
-        logger.info(f"Registering handlers for worker instance {self.instance_id}")
-
-        # Сервиска про изменение темы
-        self.dp.message.register(
-            self.handle_forum_service_message,
-            F.forum_topic_edited,
-        )
-
-        # Callback'и тикетной клавиатуры
-        self.dp.callback_query.register(
-            self.handle_ticket_callback,
-            F.data.startswith("ticket:"),
-        )
-
-        # Оценка
-        self.dp.callback_query.register(
-            self.handle_rating_callback,
-            F.data.startswith("rating:"),
-        )
-
-        # Команды в приватке
-        self.dp.message.register(
-            self.cmd_start,
-            CommandStart(),
-            F.chat.type == ChatType.PRIVATE,
-        )
-        logger.debug("Registered /start handler for private chats")
-
-        self.dp.message.register(
-            self.cmd_admin,
-            Command("admin"),
-            F.chat.type == ChatType.PRIVATE,
-        )
-
-        self.dp.message.register(
-            self.cmd_openchat_off,
-            Command("openchat_off"),
-            F.chat.type == ChatType.PRIVATE,
-        )
-
-        # Привязка OpenChat из группы/супергруппы
-        self.dp.message.register(
-            self.cmd_bind_openchat,
-            Command("bind"),
-            (F.chat.type == ChatType.SUPERGROUP) | (F.chat.type == ChatType.GROUP),
-        )
-
-        # Задаём язык (ИСПОЛЬЗУЕМ self.dp)
-        self.dp.callback_query.register(
-            self.handle_language_callback,
-            F.data.in_(["setup_language"]) | F.data.startswith("set_lang:"),
-        )
-
-        # OpenChat: обработка сообщений в супергруппе (для реплеев)
-        self.dp.message.register(
-            self.handle_openchat_message,
-            F.chat.type == ChatType.SUPERGROUP,
-        )
-
-        # Callback'и админ-панели
-        self.dp.callback_query.register(self.handle_callback)
-
-        # Состояния админ-панели
-        self.dp.message.register(
-            self.handle_admin_blacklist_search,
-            StateFilter(AdminStates.wait_blacklist_search),
-            F.chat.type == ChatType.PRIVATE,
-        )
-        self.dp.message.register(
-            self.handle_admin_greeting,
-            StateFilter(AdminStates.wait_greeting),
-            F.chat.type == ChatType.PRIVATE,
-        )
-        self.dp.message.register(
-            self.handle_admin_autoreply,
-            StateFilter(AdminStates.wait_autoreply),
-            F.chat.type == ChatType.PRIVATE,
-        )
-        self.dp.message.register(
-            self.handle_admin_blacklist_add,
-            StateFilter(AdminStates.wait_blacklist_add),
-            F.chat.type == ChatType.PRIVATE,
-        )
-        self.dp.message.register(
-            self.handle_admin_blacklist_remove,
-            StateFilter(AdminStates.wait_blacklist_remove),
-            F.chat.type == ChatType.PRIVATE,
-        )
-
-        # Общий обработчик приватных сообщений
-        self.dp.message.register(
-            self.handle_private_message,
-            F.chat.type == ChatType.PRIVATE,
-        )
-        logger.debug("Registered general private message handler")
+        """
+        Подключает воркер к общему (на процесс) Dispatcher'у.
+        Сами хэндлеры регистрируются один раз в _register_shared_handlers,
+        здесь — только привязка тенанта по bot.id и его FSM-хранилища.
+        """
+        logger.info(f"Registering worker instance {self.instance_id} in shared dispatcher")
 
-        # Общий для ошибок
-        self.dp.errors.register(self.global_error_handler)
-        logger.info(f"All handlers registered successfully for worker {self.instance_id}")
+        _WORKERS_BY_BOT_ID[self.bot.id] = self
+        _SHARED_FSM_STORAGE.register(self.bot.id, self.fsm_storage)
 
     # ====================== ЗАПУСК / ИНТЕГРАЦИЯ ======================
 
+    async def shutdown(self, timeout: float = 10.0) -> None:
+        """
+        Остановка воркера до закрытия пула БД и HTTP-сессии: недособранные альбомы
+        отправляются сразу, не дожидаясь MEDIA_GROUP_WINDOW (их части уже
+        подтверждены в очереди), затем дожидаемся лейнов отправки и записи
+        форвардов в БД (_forward_tails) — после нас пул БД закрывается.
+        """
+        # буфер ещё на месте — flush-задача спит в ожидании окна, её можно отменить
+        for key in list(self._media_group_buffers):
+            buf = self._media_group_buffers.pop(key)
+            if buf["task"] is not None:
+                buf["task"].cancel()
+            await self._flush_media_group(key, buf["messages"])
+
+        # альбомы, которые уже отправлялись в момент остановки
+        if self._media_group_tasks:
+            _, pending = await asyncio.wait(list(self._media_group_tasks), timeout=timeout)
+            for task in pending:
+                task.cancel()
+
+        if self.outbound is not None:
+            await self.outbound.drain(timeout=timeout)
+
+        if self._forward_tails:
+            _, pending = await asyncio.wait(list(self._forward_tails), timeout=timeout)
+            if pending:
+                logger.warning(
+                    "⚠️ Worker %s: %s forward tails not finished in %ss, cancelling",
+                    self.instance_id,
+                    len(pending),
+                    timeout,
+                )
+                for task in pending:
+                    task.cancel()
+
     async def process_update(self, update: Update) -> None:
         """
         Доп. метод, если вдруг захочется кормить воркер апдейтами вручную.
@@ -3698,7 +4539,11 @@ class GraceHubWorker:
         if self.bot is None:
             logger.error(f"❌ Bot not ready for instance {self.instance_id}, skipping update {update.update_id}. Token: {bool(self.token)}")
             return
-            
+
+        if not _is_relevant_update(update):
+            logger.debug(f"Update {update.update_id} dropped by prefilter")
+            return
+
         if update.message:
             logger.info(
                 f"Message from user {update.message.from_user.id} ({update.message.from_user.username or 'no username'}): {update.message.text or '[non-text message]'}"
@@ -3711,15 +4556,251 @@ class GraceHubWorker:
             logger.info(f"Other update type: {update}")
 
         try:
-            await self.dp.feed_update(self.bot, update)
+            await self.dp.feed_update(self.bot, update, worker=self)
             logger.info(
                 f"Update {update.update_id} successfully fed to dispatcher for instance {self.instance_id}"
             )
+        except OutboundQueueFull:
+            # лейн отправки переполнен — ошибка уходит в очередь: job не ack-ается и
+            # повторится с backoff, когда лейн разгрузится
+            raise
         except Exception as e:
             logger.error(
                 f"Error feeding update {update.update_id} to dispatcher for instance {self.instance_id}: {e}",
                 exc_info=True,
             )
+        finally:
+            # изменения FSM за апдейт пишем одним запросом до ack в очереди; ошибку
+            # записи пробрасываем (залогирована в flush()), чтобы job повторился
+            await self.fsm_storage.flush()
+
+
+# ====================== ОБЩИЙ DISPATCHER ДЛЯ ВСЕХ ВОРКЕРОВ ПРОЦЕССА ======================
+
+# bot.id -> воркер тенанта (слабые ссылки: выселенный из кэша воркер не держим)
+_WORKERS_BY_BOT_ID: "weakref.WeakValueDictionary[int, GraceHubWorker]" = (
+    weakref.WeakValueDictionary()
+)
+_SHARED_FSM_STORAGE = TenantFSMStorage()
+_SHARED_DISPATCHER: Optional[Dispatcher] = None
+
+
+class WorkerContextMiddleware(BaseMiddleware):
+    """
+    Outer-middleware общего Dispatcher'а: кладёт в data["worker"] воркер тенанта.
+    Если воркер не передан в feed_update явно — ищем его по bot.id.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if data.get("worker") is None:
+            bot = data.get("bot")
+            worker = _WORKERS_BY_BOT_ID.get(bot.id) if bot else None
+            if worker is None:
+                logger.warning(
+                    "Shared dispatcher: no worker registered for bot_id=%s, update dropped",
+                    getattr(bot, "id", None),
+                )
+                return None
+            data["worker"] = worker
+        return await handler(event, data)
+
+
+def _delegate(method_name: str):
+    """
+    Хэндлер общего роутера, который вызывает метод воркера тенанта.
+    Сигнатура метода разбирается один раз при регистрации.
+    """
+    params = inspect.signature(getattr(GraceHubWorker, method_name)).parameters
+
+    if "state" in params:
+
+        async def handler(event: TelegramObject, worker: GraceHubWorker, state: FSMContext):
+            return await getattr(worker, method_name)(event, state)
+
+    else:
+
+        async def handler(event: TelegramObject, worker: GraceHubWorker):
+            return await getattr(worker, method_name)(event)
+
+    handler.__name__ = method_name
+    handler.__qualname__ = f"shared.{method_name}"
+    return handler
+
+
+# Префикс callback_data (до первого ":") -> метод воркера; остальное — админ-панель
+CALLBACK_ROUTES: Dict[str, str] = {
+    "ticket": "handle_ticket_callback",
+    "rating": "handle_rating_callback",
+    "setup_language": "handle_language_callback",
+    "set_lang": "handle_language_callback",
+}
+
+
+def _callback_router():
+    """
+    Один хэндлер callback_query вместо последовательной проверки фильтров:
+    маршрут ищется в словаре по префиксу callback_data.
+    """
+    routes = {prefix: _delegate(name) for prefix, name in CALLBACK_ROUTES.items()}
+    fallback = _delegate("handle_callback")
+    takes_state = {
+        handler: "state" in inspect.signature(handler).parameters
+        for handler in (*routes.values(), fallback)
+    }
+
+    async def route_callback(event: CallbackQuery, worker: GraceHubWorker, state: FSMContext):
+        handler = routes.get((event.data or "").split(":", 1)[0], fallback)
+        if takes_state[handler]:
+            return await handler(event, worker, state)
+        return await handler(event, worker)
+
+    return route_callback
+
+
+# Типы чатов, где бот слушает только команды/реплаи (OpenChat, привязка)
+_GROUP_CHAT_TYPES = frozenset({ChatType.GROUP, ChatType.SUPERGROUP})
+
+
+def _is_relevant_update(update: Update) -> bool:
+    """
+    Структурный префильтр до Dispatcher'а и до любых запросов в БД:
+    False — апдейт гарантированно не заинтересует ни один хэндлер.
+    """
+    if update.callback_query is not None:
+        return True
+
+    message = update.message
+    if message is None:
+        # edited_message, my_chat_member и т.п. — хэндлеров нет
+        return False
+
+    chat_type = message.chat.type
+    if chat_type == ChatType.PRIVATE:
+        return True
+    if chat_type not in _GROUP_CHAT_TYPES:
+        return False
+
+    if message.forum_topic_edited is not None:
+        return True
+    if (message.text or "").startswith("/"):
+        return True  # /bind и прочие команды
+    if chat_type != ChatType.SUPERGROUP:
+        return False
+
+    # OpenChat: интересны только ответы живых операторов
+    return message.reply_to_message is not None and not (
+        message.from_user is not None and message.from_user.is_bot
+    )
+
+
+async def _shared_error_handler(event: ErrorEvent, worker: Optional[GraceHubWorker] = None):
+    if worker is None:
+        logger.exception(
+            "Unhandled error in shared dispatcher without worker: %r", event.exception
+        )
+        return True
+    return await worker.global_error_handler(event)
+
+
+def _register_shared_handlers(dp: Dispatcher) -> None:
+    # Сервиска про изменение темы
+    dp.message.register(
+        _delegate("handle_forum_service_message"),
+        F.forum_topic_edited,
+    )
+
+    # Все callback'и — один хэндлер с таблицей маршрутов по префиксу callback_data
+    dp.callback_query.register(_callback_router())
+
+    # Команды в приватке
+    dp.message.register(
+        _delegate("cmd_start"),
+        CommandStart(),
+        F.chat.type == ChatType.PRIVATE,
+    )
+    logger.debug("Registered /start handler for private chats")
+
+    dp.message.register(
+        _delegate("cmd_admin"),
+        Command("admin"),
+        F.chat.type == ChatType.PRIVATE,
+    )
+
+    dp.message.register(
+        _delegate("cmd_openchat_off"),
+        Command("openchat_off"),
+        F.chat.type == ChatType.PRIVATE,
+    )
+
+    # Привязка OpenChat из группы/супергруппы
+    dp.message.register(
+        _delegate("cmd_bind_openchat"),
+        Command("bind"),
+        (F.chat.type == ChatType.SUPERGROUP) | (F.chat.type == ChatType.GROUP),
+    )
+
+    # OpenChat: обработка сообщений в супергруппе (для реплеев)
+    dp.message.register(
+        _delegate("handle_openchat_message"),
+        F.chat.type == ChatType.SUPERGROUP,
+    )
+
+    # Состояния админ-панели
+    dp.message.register(
+        _delegate("handle_admin_blacklist_search"),
+        StateFilter(AdminStates.wait_blacklist_search),
+        F.chat.type == ChatType.PRIVATE,
+    )
+    dp.message.register(
+        _delegate("handle_admin_greeting"),
+        StateFilter(AdminStates.wait_greeting),
+        F.chat.type == ChatType.PRIVATE,
+    )
+    dp.message.register(
+        _delegate("handle_admin_autoreply"),
+        StateFilter(AdminStates.wait_autoreply),
+        F.chat.type == ChatType.PRIVATE,
+    )
+    dp.message.register(
+        _delegate("handle_admin_blacklist_add"),
+        StateFilter(AdminStates.wait_blacklist_add),
+        F.chat.type == ChatType.PRIVATE,
+    )
+    dp.message.register(
+        _delegate("handle_admin_blacklist_remove"),
+        StateFilter(AdminStates.wait_blacklist_remove),
+        F.chat.type == ChatType.PRIVATE,
+    )
+
+    # Общий обработчик приватных сообщений
+    dp.message.register(
+        _delegate("handle_private_message"),
+        F.chat.type == ChatType.PRIVATE,
+    )
+    logger.debug("Registered general private message handler")
+
+    # Общий для ошибок
+    dp.errors.register(_shared_error_handler)
+
+
+def get_shared_dispatcher() -> Dispatcher:
+    """
+    Один Dispatcher с одним графом хэндлеров на процесс (все тенанты).
+    Состояние тенанта приходит через WorkerContextMiddleware, FSM — через TenantFSMStorage.
+    """
+    global _SHARED_DISPATCHER
+    if _SHARED_DISPATCHER is None:
+        dp = Dispatcher(storage=_SHARED_FSM_STORAGE)
+        dp.update.outer_middleware(WorkerContextMiddleware())
+        _register_shared_handlers(dp)
+        _SHARED_DISPATCHER = dp
+        logger.info("Shared worker dispatcher built")
+    return _SHARED_DISPATCHER
 
 
 if __name__ == "__main__":
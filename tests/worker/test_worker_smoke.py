@@ -1,10 +1,11 @@
 # tests/worker/test_worker_smoke.py
 
+import asyncio
 import os
 import types
 
 import pytest
-from unittest.mock import AsyncMock
+from unittest.mock import AsyncMock, Mock, patch
 
 from worker.main import GraceHubWorker  # с pytest.ini (pythonpath = src)
 
@@ -29,6 +30,10 @@ class DummyDB:
         # Возвращаем токен для теста
         return "123456789:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
 
+    async def get_worker_bootstrap(self, instance_id: str, default_settings):
+        # Инстанса "нет" — воркер уходит в minimal mode с переданным токеном
+        return None
+
     async def get_instance(self, instance_id: str):
         # Возвращаем фейковый инстанс
         mock_instance = types.SimpleNamespace()
@@ -101,3 +106,1102 @@ async def test_worker_core_utils():
     # is_admin с пустой БД должен вернуть False
     is_admin = await worker.is_admin(user_id=42)
     assert is_admin is False
+
+
+@pytest.mark.asyncio
+async def test_worker_file_size_lookup_is_cached():
+    """
+    Повторные и параллельные проверки одного файла делают один get_file().
+    """
+    _set_minimal_env()
+    worker = GraceHubWorker(
+        instance_id=os.environ["WORKER_INSTANCE_ID"],
+        token=os.environ["WORKER_TOKEN"],
+        db=DummyDB(),
+    )
+    await worker.initialize()
+    worker._platform_defaults.get = AsyncMock(return_value=(0, 10))
+
+    async def _slow_get_file(file_id):
+        await asyncio.sleep(0.01)
+        return types.SimpleNamespace(file_size=1024)
+
+    worker.bot.get_file = AsyncMock(side_effect=_slow_get_file)
+
+    results = await asyncio.gather(
+        *(worker.check_file_size("file-id", "uniq-1") for _ in range(5))
+    )
+    assert all(results)
+    assert await worker.check_file_size("other-file-id", "uniq-1") is True
+    assert worker.bot.get_file.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_worker_fsm_storage_coalesces_writes():
+    """
+    set_state + update_data в рамках апдейта пишутся в БД одним upsert в flush().
+    """
+    from aiogram.fsm.storage.base import StorageKey
+
+    from worker.main import AdminStates
+
+    db = DummyDB()
+    db.executemany = AsyncMock()
+    worker = GraceHubWorker(instance_id="test-instance", token=None, db=db)
+    storage = worker.fsm_storage
+    key = StorageKey(bot_id=1, chat_id=42, user_id=42)
+
+    await storage.set_state(key, AdminStates.wait_greeting)
+    await storage.update_data(key, {"page": 2})
+    assert await storage.get_state(key) == AdminStates.wait_greeting.state
+    db.executemany.assert_not_awaited()
+
+    await storage.flush()
+    db.executemany.assert_awaited_once()
+    rows = db.executemany.await_args.args[1]
+    assert rows == [("test-instance", 42, AdminStates.wait_greeting.state, '{"page": 2}')]
+
+
+@pytest.mark.asyncio
+async def test_workers_share_dispatcher():
+    """
+    Граф хэндлеров один на процесс, тенанты различаются по bot.id.
+    """
+    _set_minimal_env()
+    first = GraceHubWorker(instance_id="tenant-a", token=None, db=DummyDB())
+    second = GraceHubWorker(instance_id="tenant-b", token=None, db=DummyDB())
+
+    assert first.dp is second.dp
+    assert len(first.dp.message.handlers) > 0
+
+
+@pytest.mark.asyncio
+async def test_outbound_scheduler_keeps_chat_order():
+    """
+    submit() не блокирует вызывающего, а отправки одного чата идут по порядку.
+    """
+    from shared.rate_limiter import BotRateLimiter, OutboundScheduler
+
+    scheduler = OutboundScheduler(BotRateLimiter("123:ABC"), name="test")
+    sent = []
+
+    async def send(n):
+        await asyncio.sleep(0)
+        sent.append(n)
+
+    futures = [scheduler.submit(42, lambda n=n: send(n)) for n in range(5)]
+    assert sent == []
+
+    await asyncio.gather(*futures)
+    assert sent == [0, 1, 2, 3, 4]
+    assert scheduler.pending() == 0
+
+
+@pytest.mark.asyncio
+async def test_outbound_overflow_fails_the_update():
+    """
+    Переполненный лейн чата — OutboundQueueFull прямо из submit(), и process_update
+    пробрасывает его: job в очереди не подтверждается и будет повторён.
+    """
+    from shared.rate_limiter import BotRateLimiter, OutboundQueueFull, OutboundScheduler
+
+    scheduler = OutboundScheduler(BotRateLimiter("123:ABC"), name="test", max_pending_per_chat=2)
+    scheduler.submit(42, lambda: asyncio.sleep(0))
+    scheduler.submit(42, lambda: asyncio.sleep(0))
+    with pytest.raises(OutboundQueueFull):
+        scheduler.submit(42, lambda: asyncio.sleep(0))
+    assert scheduler.stats["rejected"] == 1
+    await scheduler.drain()
+
+    worker = GraceHubWorker("test_instance", DummyDB(), token="123:ABC")
+    worker.bot = object()
+    worker.dp = types.SimpleNamespace(
+        feed_update=AsyncMock(side_effect=OutboundQueueFull("chat 42 is full"))
+    )
+    update = types.SimpleNamespace(update_id=1, message=None, callback_query=Mock())
+    with patch("worker.main._is_relevant_update", return_value=True):
+        with pytest.raises(OutboundQueueFull):
+            await worker.process_update(update)
+
+
+@pytest.mark.asyncio
+async def test_failed_fsm_flush_fails_the_update():
+    """
+    Не записанное в БД состояние FSM не теряется молча: process_update
+    пробрасывает ошибку flush(), и job в очереди повторится.
+    """
+    worker = GraceHubWorker("test_instance", DummyDB(), token="123:ABC")
+    worker.bot = object()
+    worker.dp = types.SimpleNamespace(feed_update=AsyncMock())
+    worker.fsm_storage = types.SimpleNamespace(
+        flush=AsyncMock(side_effect=ConnectionError("db is down"))
+    )
+    update = types.SimpleNamespace(update_id=1, message=None, callback_query=Mock())
+    with patch("worker.main._is_relevant_update", return_value=True):
+        with pytest.raises(ConnectionError):
+            await worker.process_update(update)
+    worker.dp.feed_update.assert_awaited_once()
+
+
+def _album_worker(window: float):
+    """Воркер с реальным OutboundScheduler и замоканным Bot API для тестов альбомов"""
+    from shared.rate_limiter import BotRateLimiter, OutboundScheduler
+
+    worker = GraceHubWorker("test_instance", DummyDB(), token="123:ABC")
+    worker.MEDIA_GROUP_WINDOW = window
+    worker.outbound = OutboundScheduler(BotRateLimiter("123:ABC"), name="test")
+    worker.bot = types.SimpleNamespace(
+        send_media_group=AsyncMock(
+            side_effect=lambda chat_id, media, message_thread_id: [
+                types.SimpleNamespace(message_id=100 + i) for i in range(len(media))
+            ]
+        )
+    )
+    worker.is_admin = AsyncMock(return_value=False)
+    worker.is_user_blacklisted = AsyncMock(return_value=False)
+    worker.get_openchat_settings = AsyncMock(
+        return_value={"enabled": True, "chat_id": -100, "username": ""}
+    )
+    worker.ensure_ticket_for_user = AsyncMock(
+        return_value={"id": 7, "thread_id": 5, "status": "inprogress"}
+    )
+    worker._after_forward_to_openchat = AsyncMock()
+    return worker
+
+
+def _album_part(message_id: int):
+    return types.SimpleNamespace(
+        message_id=message_id,
+        media_group_id="album-1",
+        from_user=types.SimpleNamespace(id=1, username="client"),
+        photo=[types.SimpleNamespace(file_id=f"photo-{message_id}")],
+        video=None,
+        document=None,
+        audio=None,
+        caption="подпись" if message_id == 1 else None,
+        content_type="photo",
+    )
+
+
+@pytest.mark.asyncio
+async def test_album_parts_are_forwarded_as_one_media_group():
+    """
+    Части альбома копятся в буфере и уходят в топик тикета одним sendMediaGroup
+    в исходном порядке; маппинги пишутся одной пачкой после отправки.
+    """
+    worker = _album_worker(window=0.01)
+
+    for message_id in (2, 1, 3):
+        await worker.forward_to_openchat(_album_part(message_id))
+    assert worker.bot.send_media_group.await_count == 0
+
+    for _ in range(50):
+        if worker._after_forward_to_openchat.await_count:
+            break
+        await asyncio.sleep(0.01)
+
+    worker.bot.send_media_group.assert_awaited_once()
+    call = worker.bot.send_media_group.await_args
+    assert call.args[0] == -100 and call.kwargs["message_thread_id"] == 5
+    assert [m.media for m in call.args[1]] == ["photo-1", "photo-2", "photo-3"]
+    assert call.args[1][0].caption == "client:\nподпись"
+    assert len(worker._after_forward_to_openchat.await_args.args[2]) == 3
+    assert worker._media_group_buffers == {}
+
+
+@pytest.mark.asyncio
+async def test_worker_shutdown_flushes_buffered_albums():
+    """
+    Остановка не теряет уже подтверждённые части альбома: буфер отправляется
+    сразу, не дожидаясь окна сборки.
+    """
+    worker = _album_worker(window=60)
+
+    await worker.forward_to_openchat(_album_part(1))
+    await worker.forward_to_openchat(_album_part(2))
+    await asyncio.wait_for(worker.shutdown(timeout=1), timeout=2)
+
+    worker.bot.send_media_group.assert_awaited_once()
+    assert len(worker.bot.send_media_group.await_args.args[1]) == 2
+    assert worker._media_group_buffers == {}
+    assert not worker._media_group_tasks
+    # запись маппингов успевает до закрытия пула БД
+    worker._after_forward_to_openchat.assert_awaited_once()
+    assert not worker._forward_tails
+
+
+class TopicTitleDB(DummyDB):
+    """tickets.topic_title одного тикета — общее для воркеров состояние"""
+
+    def __init__(self):
+        self.topic_title = None
+
+    async def fetchone(self, sql, params=None, **kwargs):
+        if "topic_title" in sql:
+            return {"topic_title": self.topic_title}
+        return None
+
+    async def execute(self, sql, params=None, **kwargs):
+        if "SET topic_title" in sql:
+            self.topic_title = params[0]
+
+
+@pytest.mark.asyncio
+async def test_topic_title_updates_are_debounced():
+    """
+    Несколько смен статуса подряд дают одно переименование темы, повтор — ни одного.
+    """
+    worker = GraceHubWorker(instance_id="test-instance", token=None, db=TopicTitleDB())
+    worker.TOPIC_TITLE_DEBOUNCE = 0.01
+    worker.bot = types.SimpleNamespace(edit_forum_topic=AsyncMock())
+
+    ticket = {"id": 7, "chat_id": -100, "thread_id": 5, "user_id": 1, "username": "@u"}
+    for status in ("inprogress", "answered", "closed"):
+        await worker.update_ticket_topic_title({**ticket, "status": status})
+    await asyncio.sleep(0.05)
+
+    worker.bot.edit_forum_topic.assert_awaited_once()
+    assert "#7" in worker.bot.edit_forum_topic.await_args.kwargs["name"]
+
+    await worker.update_ticket_topic_title({**ticket, "status": "closed"})
+    await asyncio.sleep(0.05)
+    worker.bot.edit_forum_topic.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_topic_title_is_compared_with_shared_state():
+    """
+    Тему переименовала другая реплика — возврат к прежнему названию не пропускается.
+    """
+    db = TopicTitleDB()
+    replica_a = GraceHubWorker(instance_id="test-instance", token=None, db=db)
+    replica_b = GraceHubWorker(instance_id="test-instance", token=None, db=db)
+    for worker in (replica_a, replica_b):
+        worker.bot = types.SimpleNamespace(edit_forum_topic=AsyncMock())
+
+    ticket = {"id": 8, "chat_id": -100, "thread_id": 6, "user_id": 1, "username": "@u"}
+    await replica_a._apply_topic_title({**ticket, "status": "inprogress"})
+    await replica_b._apply_topic_title({**ticket, "status": "closed"})
+    await replica_a._apply_topic_title({**ticket, "status": "inprogress"})
+
+    assert replica_a.bot.edit_forum_topic.await_count == 2
+    assert db.topic_title == replica_a._format_ticket_title({**ticket, "status": "inprogress"})
+
+
+def test_gzip_csv_writer_splits_parts():
+    """
+    Экспорт пишется в gzip-части с заголовком в каждой, лишние файлы удаляются.
+    """
+    import gzip
+    import random
+
+    from shared.csv_export import GzipCsvPartWriter
+
+    writer = GzipCsvPartWriter(["user_id", "username"], prefix="test", part_max_bytes=4096)
+    rnd = random.Random(1)
+    for start in range(0, 3000, 500):
+        writer.write_rows((i, f"user{rnd.getrandbits(64):x}") for i in range(start, start + 500))
+    paths = writer.finish()
+
+    try:
+        assert len(paths) > 1
+        lines = []
+        for path in paths:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                part = f.read().splitlines()
+            assert part[0] == "user_id,username"
+            lines.extend(part[1:])
+        assert len(lines) == writer.rows_written == 3000
+    finally:
+        writer.cleanup()
+    assert not any(os.path.exists(p) for p in paths)
+
+
+@pytest.mark.asyncio
+async def test_operators_keyboard_uses_keyset_cursor():
+    """
+    Следующая страница операторов запрашивается по курсору из callback_data, без OFFSET.
+    """
+    from datetime import datetime, timezone
+
+    db = DummyDB()
+    seen = datetime(2026, 1, 2, 3, 4, 5, 678901, tzinfo=timezone.utc)
+    rows = [{"user_id": 100 + i, "username": f"op{i}", "ts": seen} for i in range(3)]
+    db.fetchall = AsyncMock(return_value=rows)
+    worker = GraceHubWorker(instance_id="test-instance", token=None, db=db)
+
+    kb = await worker.get_operators_keyboard(7, per_page=2)
+    nav = kb.inline_keyboard[-2]
+    assert [b.text for b in nav] == ["➡️"]
+    assert "OFFSET" not in db.fetchall.await_args.args[0]
+
+    _, _, ticket_id, direction, ts_part, uid_part = nav[0].callback_data.split(":")
+    assert (ticket_id, direction) == ("7", "n")
+    assert worker._decode_keyset(ts_part, uid_part) == (seen, 101)
+    assert len(nav[0].callback_data) <= 64
+
+
+@pytest.mark.asyncio
+async def test_admin_menu_is_cached_per_language_and_flags():
+    """
+    Меню админа: один запрос настроек, одинаковые флаги -> копия того же готового
+    образца; правка копии не портит меню для следующих вызовов.
+    """
+    db = DummyDB()
+    db.fetchall = AsyncMock(
+        return_value=[{"key": "rating_enabled", "value": "True"}, {"key": "lang_code", "value": "ru"}]
+    )
+    worker = GraceHubWorker(instance_id="test-instance", token=None, db=db)
+
+    first = await worker.get_admin_menu()
+    second = await worker.get_admin_menu()
+    assert first == second and first is not second
+    assert db.fetchall.await_count == 2
+
+    first.inline_keyboard[0][0].text = "changed"
+    first.inline_keyboard.append([])
+    third = await worker.get_admin_menu()
+    assert third == second
+
+    ticket_kb = worker._build_full_ticket_keyboard(42, True)
+    assert ticket_kb.inline_keyboard[0][0].callback_data == "ticket:self:42"
+
+
+@pytest.mark.asyncio
+async def test_bot_username_does_not_call_get_me_when_known():
+    """
+    Username из bot_instances отдаётся без getMe; getMe кэшируется.
+    """
+    worker = GraceHubWorker(instance_id="test-instance", token="123:ABC", db=DummyDB())
+    worker.bot = types.SimpleNamespace(
+        get_me=AsyncMock(return_value=types.SimpleNamespace(id=123, username="fresh_bot"))
+    )
+
+    worker.bot_username = "stored_bot"
+    assert await worker.get_bot_username() == "stored_bot"
+    worker.bot.get_me.assert_not_awaited()
+
+    worker.bot_username = None
+    assert await worker.get_bot_username() == "fresh_bot"
+    assert await worker.get_bot_username() == "fresh_bot"
+    await worker.get_bot_identity()
+    worker.bot.get_me.assert_awaited_once()
+
+
+def test_prefilter_drops_irrelevant_updates():
+    """
+    Сообщения супергруппы без реплая отбрасываются до Dispatcher'а и БД.
+    """
+    from datetime import datetime, timezone
+
+    from aiogram.types import Chat, Message, Update, User
+
+    from worker.main import _is_relevant_update
+
+    def msg(chat_type, **kwargs):
+        return Message(
+            message_id=1,
+            date=datetime.now(timezone.utc),
+            chat=Chat(id=-100 if chat_type != "private" else 1, type=chat_type),
+            from_user=User(id=1, is_bot=False, first_name="u"),
+            **kwargs,
+        )
+
+    assert _is_relevant_update(Update(update_id=1, message=msg("private", text="hi")))
+    assert not _is_relevant_update(Update(update_id=2, message=msg("supergroup", text="hi")))
+    assert _is_relevant_update(Update(update_id=3, message=msg("supergroup", text="/bind @b")))
+    reply = msg("supergroup", text="ok", reply_to_message=msg("supergroup", text="q"))
+    assert _is_relevant_update(Update(update_id=4, message=reply))
+    assert not _is_relevant_update(Update(update_id=5, edited_message=msg("private", text="x")))
+
+
+@pytest.mark.asyncio
+async def test_shared_rate_limiter_leases_global_tokens_in_batches():
+    """
+    Глобальные токены берутся из общего бакета пачкой, чатовые в БД не ходят.
+    """
+    from shared.rate_limiter import BotRateLimiter
+
+    db = DummyDB()
+    db.acquire_rate_tokens = AsyncMock(side_effect=lambda keys, caps, rates, wants: list(wants))
+    limiter = BotRateLimiter("123:ABC", db=db)
+    limiter.shared.global_batch = 3
+
+    for _ in range(3):
+        assert await limiter.can_send()
+    assert db.acquire_rate_tokens.await_count == 1
+    assert db.acquire_rate_tokens.await_args.args[0] == ["tg:123"]
+
+    for chat_id in range(40, 43):
+        assert await limiter.can_send(chat_id=chat_id)
+    assert db.acquire_rate_tokens.await_count == 2
+    assert db.acquire_rate_tokens.await_args.args[0] == ["tg:123"]
+    assert 42 in limiter.chat_buckets
+
+    db.acquire_rate_tokens = AsyncMock(return_value=[0])
+    limiter.shared._global_lease = 0
+    assert not await limiter.can_send()
+    assert await limiter.wait_for_send() > 0
+
+
+@pytest.mark.asyncio
+async def test_shared_rate_limiter_shares_openchat_bucket():
+    """
+    Лимит OpenChat-группы общий для реплик: токены чата берутся из БД вместе
+    с глобальными, а отказ общего бакета чата не пропускает отправку.
+    """
+    from shared.rate_limiter import BotRateLimiter
+
+    db = DummyDB()
+    db.acquire_rate_tokens = AsyncMock(side_effect=lambda keys, caps, rates, wants: list(wants))
+    limiter = BotRateLimiter("123:ABC", db=db)
+    limiter.shared.global_batch = 5
+    limiter.share_chat(-100500)
+
+    assert await limiter.can_send(chat_id=-100500)
+    assert db.acquire_rate_tokens.await_args.args[0] == ["tg:123", "tg:123:chat:-100500"]
+    assert -100500 not in limiter.chat_buckets
+
+    # чатовый токен израсходован, глобальные ещё есть — в БД идёт только ключ чата
+    db.acquire_rate_tokens = AsyncMock(return_value=[0])
+    assert not await limiter.can_send(chat_id=-100500)
+    assert db.acquire_rate_tokens.await_args.args[0] == ["tg:123:chat:-100500"]
+    assert await limiter.wait_for_send(chat_id=-100500) >= 1.0 / limiter.CHAT_RATE
+
+    # личные чаты по-прежнему лимитируются локально
+    assert await limiter.can_send(chat_id=42)
+    assert 42 in limiter.chat_buckets
+
+
+def test_chat_buckets_evict_idle_chats():
+    """
+    Слоты чатов, простоявших до полного бакета, освобождаются и переиспользуются.
+    """
+    from shared.rate_limiter import ChatBucketTable
+
+    table = ChatBucketTable(capacity=2, refill_rate=1.0, wheel_size=8)
+    now = table._wheel_time
+
+    assert table.try_consume(1, now=now)
+    assert table.try_consume(1, now=now)
+    assert not table.try_consume(1, now=now)
+    assert table.wait_time(1, now=now) == pytest.approx(1.0)
+
+    for step in range(1, 200):
+        assert table.try_consume(1000 + step, now=now + step * 3)
+
+    assert len(table) <= 2
+    assert table.stats()["slots"] <= 3
+    assert 1 not in table
+
+
+@pytest.mark.asyncio
+async def test_request_middleware_feeds_retry_after_into_limiter():
+    """
+    429 от Bot API включает backoff и снижает скорость; уже оплаченный
+    OutboundScheduler'ом запрос повторно токен не тратит.
+    """
+    from aiogram import Bot
+    from aiogram.exceptions import TelegramRetryAfter
+    from aiogram.methods import SendMessage
+
+    from shared.rate_limiter import (
+        BotRateLimiter,
+        RateLimitRequestMiddleware,
+        _prepaid_requests,
+        register_bot_limiter,
+    )
+
+    bot = Bot(token="777:TEST")
+    limiter = BotRateLimiter(bot.token)
+    register_bot_limiter(bot.id, limiter)
+    middleware = RateLimitRequestMiddleware()
+    method = SendMessage(chat_id=5, text="hi")
+
+    async def ok(bot, method):
+        return True
+
+    async def flood(bot, method):
+        raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=3)
+
+    assert await middleware(ok, bot, method)
+    assert limiter.global_bucket.tokens == pytest.approx(limiter.GLOBAL_CAPACITY - 1, abs=0.1)
+
+    token = _prepaid_requests.set([1])
+    try:
+        assert await middleware(ok, bot, method)
+    finally:
+        _prepaid_requests.reset(token)
+    assert limiter.global_bucket.tokens == pytest.approx(limiter.GLOBAL_CAPACITY - 1, abs=0.1)
+
+    with pytest.raises(TelegramRetryAfter):
+        await middleware(flood, bot, method)
+    assert limiter.backoff_until is not None
+    assert limiter.rate_factor == 0.5
+    assert not await limiter.can_send(chat_id=5)
+
+    for _ in range(limiter.RATE_RECOVERY_SUCCESSES):
+        limiter.record_success()
+    assert limiter.rate_factor == pytest.approx(0.6)
+
+
+@pytest.mark.asyncio
+async def test_instance_lanes_order_by_priority_and_push_back():
+    """
+    Лейн инстанса обрабатывает нажатия кнопок раньше сообщений других чатов, а
+    заполненный лейн отказывает и попадает в список исключений claimer'а.
+    """
+    from shared.rate_limiter import RateLimiter
+
+    seen, done = [], []
+    gate = asyncio.Event()
+
+    async def on_update(instance_id, update):
+        await gate.wait()
+        seen.append(update.update_id)
+
+    async def on_done(item, error):
+        done.append((item.job_id, error))
+
+    executor = RateLimiter(on_update, on_done=on_done, lane_size=3)
+    message = {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}}
+    callback = {
+        "id": "c",
+        "from": {"id": 2, "is_bot": False, "first_name": "u"},
+        "chat_instance": "x",
+    }
+
+    assert executor.add_update("i1", {"update_id": 1, "message": message}, job_id=1)
+    await asyncio.sleep(0.01)  # лейн забрал первый апдейт и ждёт gate
+    assert executor.add_update("i1", {"update_id": 2, "message": message}, job_id=2)
+    assert executor.add_update("i1", {"update_id": 3, "callback_query": callback}, job_id=3)
+    assert executor.add_update("i1", {"update_id": 4, "edited_message": message}, job_id=4)
+    assert not executor.add_update("i1", {"update_id": 5, "message": message}, job_id=5)
+    assert executor.saturated_instances() == ["i1"]
+    assert executor.get_stats("i1")["rejected"] == 1
+
+    gate.set()
+    for _ in range(20):
+        if len(done) == 4:
+            break
+        await asyncio.sleep(0.01)
+
+    assert seen == [1, 3, 2, 4]
+    assert [job_id for job_id, error in done] == [1, 3, 2, 4]
+    assert executor.saturated_instances() == []
+    assert executor.inflight == 0
+    assert await executor.shutdown() == []
+
+
+@pytest.mark.asyncio
+async def test_instance_lane_keeps_chat_fifo():
+    """
+    Нажатие кнопки не обгоняет ещё не обработанное сообщение того же чата;
+    взятые jobs видны heartbeat'у, пока не обработаны.
+    """
+    from shared.rate_limiter import RateLimiter
+
+    seen = []
+    gate = asyncio.Event()
+
+    async def on_update(instance_id, update):
+        await gate.wait()
+        seen.append(update.update_id)
+
+    executor = RateLimiter(on_update, lane_size=10)
+    message = {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}}
+    callback = {
+        "id": "c",
+        "from": {"id": 1, "is_bot": False, "first_name": "u"},
+        "chat_instance": "x",
+        "message": message,
+    }
+
+    assert executor.add_update("i1", {"update_id": 1, "message": message}, job_id=1)
+    await asyncio.sleep(0.01)
+    assert executor.add_update("i1", {"update_id": 2, "message": message}, job_id=2)
+    assert executor.add_update("i1", {"update_id": 3, "callback_query": callback}, job_id=3)
+    assert sorted(executor.held_job_ids()) == [1, 2, 3]
+
+    gate.set()
+    for _ in range(20):
+        if len(seen) == 3:
+            break
+        await asyncio.sleep(0.01)
+
+    assert seen == [1, 2, 3]
+    assert executor.held_job_ids() == []
+    assert await executor.shutdown() == []
+
+
+@pytest.mark.asyncio
+async def test_schema_check_skips_ddl_when_version_is_current():
+    """
+    При актуальной версии схемы старт процесса — один SELECT, без локов и DDL.
+    """
+    from contextlib import asynccontextmanager
+
+    from shared.migrations import SCHEMA_VERSION, ensure_schema
+
+    conn = types.SimpleNamespace(
+        fetchval=AsyncMock(return_value=SCHEMA_VERSION),
+        execute=AsyncMock(),
+    )
+
+    @asynccontextmanager
+    async def acquire():
+        yield conn
+
+    db = types.SimpleNamespace(pool=types.SimpleNamespace(acquire=acquire))
+
+    assert await ensure_schema(db, auto_migrate=False) == SCHEMA_VERSION
+    conn.execute.assert_not_awaited()
+
+    conn.fetchval = AsyncMock(return_value=None)
+    with pytest.raises(RuntimeError):
+        await ensure_schema(db, auto_migrate=False)
+    conn.execute.assert_not_awaited()
+
+
+def test_query_stats_group_by_name_and_fingerprint(caplog):
+    """
+    Именованные запросы считаются под своим именем, ad-hoc SQL — по отпечатку
+    текста (пробелы не важны); медленные попадают в лог с параметрами.
+    """
+    from shared.db_metrics import QueryStats, register_query
+
+    stats = QueryStats(slow_ms=100)
+    q = register_query("test.pick", "SELECT 1")
+
+    stats.observe(q, 0.003, rows=1)
+    stats.observe(q, 0.004, rows=1)
+    stats.observe("SELECT  *\n FROM t WHERE id = $1", 0.001, rows=0)
+    with caplog.at_level("WARNING"):
+        stats.observe("SELECT * FROM t WHERE id = $1", 0.5, rows=2, params=(42,))
+    stats.observe_acquire(0.002)
+
+    snap = stats.snapshot()
+    by_name = {row["name"]: row for row in snap["queries"]}
+    assert by_name["test.pick"]["count"] == 2
+    assert by_name["test.pick"]["p95_ms"] == 5
+    adhoc = next(row for name, row in by_name.items() if name.startswith("sql:"))
+    assert adhoc["count"] == 2 and adhoc["rows"] == 2
+    assert snap["queries"][0]["name"] == adhoc["name"]  # больше всего суммарного времени
+    assert snap["pool_acquire"]["count"] == 1
+    assert "(42,)" in caplog.text
+
+
+def test_pool_sizes_fit_connection_budget():
+    """
+    Пулы всех процессов плюс их LISTEN-соединения укладываются в бюджет;
+    воркер тенанта берёт фиксированный слот, сколько бы их ни было запущено.
+    """
+    from shared.db_pool import pool_size_for_role
+
+    replicas = {"master": 1, "api": 1, "queue": 3, "worker": 20}
+    budget, reserve = 100, 3
+
+    sizes = {role: pool_size_for_role(role, budget, replicas, reserve=reserve) for role in replicas}
+    used = sum((sizes[role].max_size + 1) * n for role, n in replicas.items())
+
+    assert used <= budget - reserve
+    assert sizes["queue"].max_size > sizes["worker"].max_size >= 1
+    assert all(size.min_size <= 1 for size in sizes.values())
+    assert pool_size_for_role("worker", budget, {"worker": 0}) == sizes["worker"]
+
+
+@pytest.mark.asyncio
+async def test_read_only_queries_use_fresh_replica_or_fall_back():
+    """
+    read_only-запрос уходит на реплику, пока она не отстаёт больше max_lag;
+    отстающая или упавшая реплика — чтение с primary.
+    """
+    from contextlib import asynccontextmanager
+
+    from shared.database import MasterDatabase
+
+    def fake_pool(label, lag=0.0, broken=False):
+        conn = types.SimpleNamespace(
+            fetchval=AsyncMock(return_value=lag),
+            fetch=AsyncMock(return_value=[label]),
+        )
+
+        @asynccontextmanager
+        async def acquire(timeout=None):
+            if broken:
+                raise OSError("connection refused")
+            yield conn
+
+        return types.SimpleNamespace(acquire=acquire)
+
+    db = MasterDatabase("postgresql://primary/db", replica_dsns=["postgresql://replica/db"])
+    db.pool = fake_pool("primary")
+    replica = db.replicas.replicas[0]
+
+    replica.pool = fake_pool("replica", lag=0.5)
+    assert await db.fetchall("SELECT 1", read_only=True) == ["replica"]
+    assert await db.fetchall("SELECT 1") == ["primary"]
+
+    replica.pool, replica.checked_at = fake_pool("replica", lag=60.0), 0.0
+    assert await db.fetchall("SELECT 1", read_only=True) == ["primary"]
+
+    replica.pool, replica.checked_at = fake_pool("replica", broken=True), 0.0
+    assert await db.fetchall("SELECT 1", read_only=True) == ["primary"]
+    assert replica.down_until > 0
+
+
+@pytest.mark.asyncio
+async def test_message_partitions_cover_retention_and_expire_whole_months():
+    """
+    Партиции messages создаются помесячно на всё окно expires_at,
+    а удаляются только те, чей месяц целиком в прошлом.
+    """
+    from datetime import datetime, timezone
+
+    from shared import message_partitions as mp
+
+    now = datetime(2026, 11, 15, tzinfo=timezone.utc)
+    assert mp.partition_months(now, datetime(2027, 2, 1, tzinfo=timezone.utc)) == [
+        mp.partition_month(n)
+        for n in ("messages_p202611", "messages_p202612", "messages_p202701", "messages_p202702")
+    ]
+
+    names = ["messages_p202609", "messages_p202610", "messages_p202611", "messages_legacy"]
+    assert mp.expired_partitions(names, now) == ["messages_p202609", "messages_p202610"]
+
+    executed = []
+    conn = types.SimpleNamespace(
+        fetch=AsyncMock(return_value=[{"relname": "messages_p202611"}]),
+        execute=AsyncMock(side_effect=lambda sql, *a: executed.append(sql)),
+    )
+    created = await mp.ensure_partitions(conn, now, datetime(2027, 1, 10, tzinfo=timezone.utc))
+    assert created == ["messages_p202612", "messages_p202701"]
+    assert "FROM ('2026-12-01') TO ('2027-01-01')" in executed[0]
+
+
+@pytest.mark.asyncio
+async def test_autoclosed_tickets_are_notified_through_outbound_lanes():
+    """
+    Команда tickets_autoclosed не шлёт ничего сама: темы обновляются с дебаунсом,
+    запросы оценки встают в лейны OutboundScheduler (под лимитами бота).
+    """
+    from unittest.mock import Mock
+
+    class TicketsDB(DummyDB):
+        async def fetchall(self, sql, params=None, **kwargs):
+            return [
+                {"id": 1, "user_id": 11, "chat_id": -100, "thread_id": 5, "status": "closed"},
+                {"id": 2, "user_id": 12, "chat_id": -100, "thread_id": 6, "status": "closed"},
+            ]
+
+    worker = GraceHubWorker(instance_id="test-instance", token=None, db=TicketsDB())
+    worker.get_setting = AsyncMock(return_value="True")
+    worker.update_ticket_topic_title = AsyncMock()
+    worker.outbound = types.SimpleNamespace(submit=Mock())
+
+    await worker.execute_bot_command("tickets_autoclosed", {"ticket_ids": [1, 2]})
+
+    assert worker.update_ticket_topic_title.await_count == 2
+    assert [c.args[0] for c in worker.outbound.submit.call_args_list] == [11, 12]
+
+
+@pytest.mark.asyncio
+async def test_bot_limiter_sustains_global_rate_limit():
+    """
+    Лимитер бота пропускает GLOBAL_RATE_LIMIT запросов в секунду, а не 1:
+    всплеск чуть больше бакета в разные чаты не растягивается на секунды.
+    """
+    from shared import settings
+    from shared.rate_limiter import BotRateLimiter
+
+    limiter = BotRateLimiter("555:LOCAL")
+    assert limiter.GLOBAL_RATE == settings.GLOBAL_RATE_LIMIT
+    assert limiter.CHAT_RATE == pytest.approx(settings.CHAT_RATE_LIMIT / 60)
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    for chat_id in range(int(limiter.GLOBAL_CAPACITY * 1.2)):
+        await limiter.acquire(chat_id)
+    assert loop.time() - started < 1.0
+
+
+@pytest.mark.asyncio
+async def test_request_middleware_does_not_sleep_on_chat_limit():
+    """
+    Прямой вызов из хэндлера в чат с исчерпанным лимитом не засыпает:
+    middleware ждёт только глобальный бакет, а чат лишь учитывает.
+    """
+    from aiogram import Bot
+    from aiogram.methods import SendMessage
+
+    from shared.rate_limiter import BotRateLimiter, RateLimitRequestMiddleware, register_bot_limiter
+
+    bot = Bot(token="778:TEST")
+    limiter = BotRateLimiter(bot.token)
+    register_bot_limiter(bot.id, limiter)
+    middleware = RateLimitRequestMiddleware()
+
+    async def ok(bot, method):
+        return True
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    for _ in range(int(limiter.CHAT_CAPACITY) + 3):
+        assert await middleware(ok, bot, SendMessage(chat_id=9, text="hi"))
+    assert loop.time() - started < 0.5
+    assert limiter.chat_buckets.wait_time(9) > 0
+
+
+@pytest.mark.asyncio
+async def test_fsm_storage_rereads_state_on_next_update():
+    """
+    Внутри апдейта состояние читается из БД один раз, а следующий апдейт
+    видит то, что записала другая реплика.
+    """
+    from aiogram.fsm.storage.base import StorageKey
+
+    from shared.fsm_storage import PostgresFSMStorage
+
+    db = DummyDB()
+    db.fetchone = AsyncMock(return_value={"state": "A", "data": None})
+    storage = PostgresFSMStorage(db, "test-instance")
+    key = StorageKey(bot_id=1, chat_id=42, user_id=42)
+
+    assert await storage.get_state(key) == "A"
+    assert await storage.get_data(key) == {}
+    assert db.fetchone.await_count == 1
+    await storage.flush()
+
+    db.fetchone.return_value = {"state": "B", "data": None}
+    assert await storage.get_state(key) == "B"
+
+
+class FloodDB(DummyDB):
+    """
+    Общие для реплик worker_flood_counters / worker_session_counters в памяти:
+    запросы DistributedFloodCounter разбираются по имени таблицы.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.sessions = {}
+        self.calls = 0
+
+    async def fetchone(self, query, params=None):
+        self.calls += 1
+        if "worker_flood_counters" in query:
+            _, user_id, bucket, first_full = params
+            self.buckets[(user_id, bucket)] = self.buckets.get((user_id, bucket), 0) + 1
+            return {
+                "current_hits": self.buckets[(user_id, bucket)],
+                "recent_hits": sum(
+                    hits
+                    for (uid, b), hits in self.buckets.items()
+                    if uid == user_id and first_full <= b < bucket
+                ),
+                "oldest_hits": self.buckets.get((user_id, first_full - 1), 0),
+            }
+        _, user_id, limit = params
+        messages = self.sessions.get(user_id, 0)
+        if messages >= limit:
+            return None
+        self.sessions[user_id] = messages + 1
+        return {"messages": messages + 1}
+
+    async def execute(self, query, params=None):
+        self.sessions.pop(params[1], None)
+
+
+@pytest.mark.asyncio
+async def test_flood_counter_sliding_window_is_shared_between_replicas():
+    """
+    Минутное окно из 10-секундных бакетов: самый старый бакет учитывается
+    пропорционально непрошедшей доле, счётчики общие для всех реплик,
+    а упёршийся в лимит пользователь дальше отсекается без похода в БД.
+    """
+    from shared.antiflood import DistributedFloodCounter
+
+    db = FloodDB()
+    replica_a = DistributedFloodCounter(db, "inst")
+    assert replica_a.bucket_seconds == 10
+
+    with patch("shared.antiflood.time.time", return_value=1000.0):
+        assert [await replica_a.hit(1, limit=5) for _ in range(5)] == [False] * 5
+        assert await replica_a.hit(1, limit=5) is True
+        calls = db.calls
+        assert await replica_a.hit(1, limit=5) is True
+        assert db.calls == calls
+
+    # через 62с бакет 1000..1010 выпал из окна на 20%: 1 + 6 * 0.8 > 5
+    replica_b = DistributedFloodCounter(db, "inst")
+    with patch("shared.antiflood.time.time", return_value=1062.0):
+        assert await replica_b.hit(1, limit=5) is True
+
+    # через 68с — только на 20% внутри окна: 2 + 6 * 0.2 <= 5
+    replica_c = DistributedFloodCounter(db, "inst")
+    with patch("shared.antiflood.time.time", return_value=1068.0):
+        assert await replica_c.hit(1, limit=5) is False
+
+    assert await replica_c.hit(2, limit=0) is False
+
+
+@pytest.mark.asyncio
+async def test_flood_counter_session_block_until_operator_reply():
+    """
+    Лимит "сообщений подряд" общий для реплик; исчерпанный лимит помнится
+    локально и снимается ответом оператора.
+    """
+    from shared.antiflood import DistributedFloodCounter
+
+    db = FloodDB()
+    replica_a = DistributedFloodCounter(db, "inst")
+    replica_b = DistributedFloodCounter(db, "inst")
+
+    assert await replica_a.try_acquire_session(1, limit=2) is True
+    assert await replica_b.try_acquire_session(1, limit=2) is True
+    assert await replica_a.try_acquire_session(1, limit=2) is False
+
+    calls = db.calls
+    assert await replica_a.try_acquire_session(1, limit=2) is False
+    assert db.calls == calls
+
+    await replica_a.reset_session(1)
+    assert await replica_a.try_acquire_session(1, limit=2) is True
+
+
+@pytest.mark.asyncio
+async def test_pick_bot_commands_claims_pending_and_stuck_commands():
+    """
+    Claim забирает pending и зависшие в processing дольше stuck_seconds (по умолчанию
+    300с) команды, помечая их processing за этой репликой; ack/fail — по id.
+    """
+    from shared.database import MasterDatabase
+
+    db = MasterDatabase("postgresql://primary/db")
+    db.fetchall = AsyncMock(
+        return_value=[{"id": 1, "instance_id": "a", "command": "close_ticket", "payload": None}]
+    )
+    db.execute = AsyncMock()
+
+    assert await db.pick_bot_commands("replica-1") == [
+        {"id": 1, "instance_id": "a", "command": "close_ticket", "payload": None}
+    ]
+    query, params = db.fetchall.await_args.args
+    assert params == ("replica-1", None, 300, 10)
+    assert "status = 'pending'" in query
+    assert "status = 'processing'" in query and "claimed_at < NOW() - ($3::int" in query
+    assert "FOR UPDATE SKIP LOCKED" in query
+    assert "claimed_by = $1" in query
+
+    await db.complete_bot_command(1)
+    assert "status = 'completed'" in db.execute.await_args.args[0]
+    assert db.execute.await_args.args[1] == (1,)
+
+    await db.fail_bot_command(2, "boom")
+    assert "status = 'failed'" in db.execute.await_args.args[0]
+    assert db.execute.await_args.args[1] == ("boom", 2)
+
+
+class CommandsDB(DummyDB):
+    """bot_commands в памяти: claim по status, ack/fail меняют status"""
+
+    def __init__(self, commands):
+        self.commands = {c["id"]: dict(c, status="pending") for c in commands}
+
+    async def pick_bot_commands(self, worker_id, **kwargs):
+        picked = [c for c in self.commands.values() if c["status"] == "pending"][:10]
+        for c in picked:
+            c["status"] = "processing"
+        return [dict(c) for c in picked]
+
+    async def complete_bot_command(self, command_id):
+        self.commands[command_id]["status"] = "completed"
+
+    async def fail_bot_command(self, command_id, error):
+        self.commands[command_id]["status"] = "failed"
+
+
+@pytest.mark.asyncio
+async def test_bot_commands_run_per_instance_concurrently_with_a_bound():
+    """
+    Инстансы выполняют свои команды параллельно (не больше concurrency сразу),
+    внутри инстанса — строго по очереди; без токена команда помечается failed.
+    """
+    import queue_worker
+
+    db = CommandsDB(
+        [
+            {"id": 1, "instance_id": "a", "command": "x", "payload": None},
+            {"id": 2, "instance_id": "b", "command": "x", "payload": None},
+            {"id": 3, "instance_id": "a", "command": "x", "payload": None},
+            {"id": 4, "instance_id": "c", "command": "x", "payload": None},
+            {"id": 5, "instance_id": "gone", "command": "x", "payload": None},
+        ]
+    )
+    running = {"now": 0, "max": 0}
+    order = []
+
+    def fake_worker(instance_id):
+        async def run_bot_command(cmd):
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+            order.append((instance_id, cmd["id"]))
+            await asyncio.sleep(0.05)
+            running["now"] -= 1
+            await db.complete_bot_command(cmd["id"])
+
+        return types.SimpleNamespace(run_bot_command=run_bot_command)
+
+    workers = {i: fake_worker(i) for i in ("a", "b", "c")}
+
+    async def get_worker(cache, db_, instance_id):
+        return workers.get(instance_id)
+
+    with patch("queue_worker._get_or_create_worker", side_effect=get_worker):
+        task = asyncio.create_task(
+            queue_worker.bot_commands_loop(
+                db, {}, "replica-1", asyncio.Event(), fallback_seconds=60, concurrency=2
+            )
+        )
+        for _ in range(100):
+            if all(c["status"] in ("completed", "failed") for c in db.commands.values()):
+                break
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    assert {i: c["status"] for i, c in db.commands.items()} == {
+        1: "completed", 2: "completed", 3: "completed", 4: "completed", 5: "failed",
+    }
+    assert running["max"] == 2
+    assert [cmd_id for inst, cmd_id in order if inst == "a"] == [1, 3]
+
+
+@pytest.mark.asyncio
+async def test_bots_share_one_http_pool_that_survives_bot_close():
+    """
+    Все Bot процесса ходят через один ClientSession с лимитами из settings;
+    bot.session.close() его не закрывает — только close_shared_session().
+    """
+    from aiogram import Bot
+
+    from shared import settings
+    from shared.telegram_session import close_shared_session, get_shared_session
+
+    await close_shared_session()
+    bot_a = Bot(token="123:AAA", session=get_shared_session())
+    bot_b = Bot(token="456:BBB", session=get_shared_session())
+    assert bot_a.session is bot_b.session
+
+    pool = await bot_a.session.create_session()
+    assert await bot_b.session.create_session() is pool
+    assert pool.connector.limit == settings.TELEGRAM_HTTP_POOL_LIMIT
+    assert pool.connector.limit_per_host == settings.TELEGRAM_HTTP_POOL_PER_HOST
+
+    await bot_a.session.close()
+    assert not pool.closed
+    assert await bot_b.session.create_session() is pool
+
+    await close_shared_session()
+    assert pool.closed
+    assert get_shared_session() is not bot_b.session
+    await close_shared_session()